@@ -1,9 +1,202 @@
-// This is an empty python module. It gets linked to ql2.pb.o, whose functions get
-// exposed and used by the C++ implementation of the google.protobuf package.
+// This python module gets linked to ql2.pb.o, whose functions get exposed and
+// used by the C++ implementation of the google.protobuf package.
+//
+// It also exports decode_response, which parses a response without going
+// through the Python protobuf objects. The R_JSON datums the server normally
+// sends come back as their JSON text, for the driver to decode, and native
+// datums are converted straight to Python objects.
 
 #include <python2.7/Python.h>
 
+#include <climits>
+#include <cmath>
+#include <string>
+
+#include "ql2.pb.h"
+
+struct decode_state_t {
+    // Set when the response has something only the Python code knows how to
+    // decode, like R_JSON datums
+    bool unsupported;
+    // Set when an object has a "$reql_type$" key. Converting pseudo-types
+    // depends on the run options, so it's left to the caller.
+    bool has_pseudotypes;
+};
+
+static PyObject *decode_string(const std::string &str) {
+    return PyUnicode_DecodeUTF8(str.data(), str.size(), "strict");
+}
+
+static PyObject *decode_num(double num) {
+    // Like Datum.deconstruct, numbers without a fractional part become ints
+    if (std::isfinite(num) && std::floor(num) == num) {
+        if (num >= static_cast<double>(LONG_MIN) && num < static_cast<double>(LONG_MAX)) {
+            return PyInt_FromLong(static_cast<long>(num));
+        }
+        return PyLong_FromDouble(num);
+    }
+    return PyFloat_FromDouble(num);
+}
+
+// Returns a new reference, or NULL if there was a Python error or the datum
+// is not supported
+static PyObject *decode_datum(const Datum &datum, decode_state_t *state) {
+    switch (datum.type()) {
+    case Datum::R_NULL:
+        Py_RETURN_NONE;
+    case Datum::R_BOOL:
+        return PyBool_FromLong(datum.r_bool());
+    case Datum::R_NUM:
+        return decode_num(datum.r_num());
+    case Datum::R_STR:
+        return decode_string(datum.r_str());
+    case Datum::R_ARRAY: {
+        PyObject *list = PyList_New(datum.r_array_size());
+        if (list == NULL) {
+            return NULL;
+        }
+        for (int i = 0; i < datum.r_array_size(); ++i) {
+            PyObject *item = decode_datum(datum.r_array(i), state);
+            if (item == NULL) {
+                Py_DECREF(list);
+                return NULL;
+            }
+            PyList_SET_ITEM(list, i, item);
+        }
+        return list;
+    }
+    case Datum::R_OBJECT: {
+        PyObject *dict = PyDict_New();
+        if (dict == NULL) {
+            return NULL;
+        }
+        for (int i = 0; i < datum.r_object_size(); ++i) {
+            const Datum_AssocPair &pair = datum.r_object(i);
+            if (pair.key() == "$reql_type$") {
+                state->has_pseudotypes = true;
+            }
+            PyObject *key = decode_string(pair.key());
+            if (key == NULL) {
+                Py_DECREF(dict);
+                return NULL;
+            }
+            PyObject *val = decode_datum(pair.val(), state);
+            if (val == NULL) {
+                Py_DECREF(key);
+                Py_DECREF(dict);
+                return NULL;
+            }
+            int res = PyDict_SetItem(dict, key, val);
+            Py_DECREF(key);
+            Py_DECREF(val);
+            if (res != 0) {
+                Py_DECREF(dict);
+                return NULL;
+            }
+        }
+        return dict;
+    }
+    default:
+        state->unsupported = true;
+        return NULL;
+    }
+}
+
+// decode_response(buffer) parses a serialized Response. It returns a tuple
+// (token, type, values, profile, has_pseudotypes, json_texts), or None if the
+// response should be parsed by the Python code instead: errors (which carry a
+// backtrace), responses mixing R_JSON and native datums, R_JSON profiles and
+// anything that fails to parse. With json_texts, values holds the UTF-8 text
+// of each R_JSON datum as a str.
+static PyObject *decode_response(PyObject *self, PyObject *args) {
+    Py_buffer buffer;
+    if (!PyArg_ParseTuple(args, "s*:decode_response", &buffer)) {
+        return NULL;
+    }
+
+    Response response;
+    bool parsed;
+    Py_BEGIN_ALLOW_THREADS
+    parsed = response.ParseFromArray(buffer.buf, static_cast<int>(buffer.len));
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&buffer);
+
+    if (!parsed || response.has_backtrace()) {
+        Py_RETURN_NONE;
+    }
+    switch (response.type()) {
+    case Response::SUCCESS_ATOM:
+    case Response::SUCCESS_SEQUENCE:
+    case Response::SUCCESS_PARTIAL:
+    case Response::WAIT_COMPLETE:
+        break;
+    default:
+        Py_RETURN_NONE;
+    }
+
+    decode_state_t state;
+    state.unsupported = false;
+    state.has_pseudotypes = false;
+
+    int json_texts = 0;
+    for (int i = 0; i < response.response_size(); ++i) {
+        if (response.response(i).type() == Datum::R_JSON) {
+            ++json_texts;
+        }
+    }
+    if (json_texts != 0 && json_texts != response.response_size()) {
+        Py_RETURN_NONE;
+    }
+
+    PyObject *values = PyList_New(response.response_size());
+    if (values == NULL) {
+        return NULL;
+    }
+    for (int i = 0; i < response.response_size(); ++i) {
+        const Datum &datum = response.response(i);
+        PyObject *value;
+        if (json_texts != 0) {
+            value = PyString_FromStringAndSize(datum.r_str().data(), datum.r_str().size());
+        } else {
+            value = decode_datum(datum, &state);
+        }
+        if (value == NULL) {
+            Py_DECREF(values);
+            if (PyErr_Occurred()) {
+                return NULL;
+            }
+            Py_RETURN_NONE;
+        }
+        PyList_SET_ITEM(values, i, value);
+    }
+
+    PyObject *profile;
+    if (response.has_profile()) {
+        profile = decode_datum(response.profile(), &state);
+        if (profile == NULL) {
+            Py_DECREF(values);
+            if (PyErr_Occurred()) {
+                return NULL;
+            }
+            Py_RETURN_NONE;
+        }
+    } else {
+        Py_INCREF(Py_None);
+        profile = Py_None;
+    }
+
+    return Py_BuildValue("(LiNNOO)",
+                         static_cast<PY_LONG_LONG>(response.token()),
+                         static_cast<int>(response.type()),
+                         values,
+                         profile,
+                         state.has_pseudotypes ? Py_True : Py_False,
+                         json_texts != 0 ? Py_True : Py_False);
+}
+
 static PyMethodDef PbMethods[] = {
+    {"decode_response", decode_response, METH_VARARGS,
+     "Parse a serialized Response, converting its datums to Python objects."},
     {NULL, NULL, 0, NULL}
 };
 
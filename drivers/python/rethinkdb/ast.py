@@ -6,10 +6,12 @@ import numbers
 import collections
 import time
 import re
+import math
 import json as py_json
-from threading import Lock
+import itertools
 from .errors import *
 from . import repl # For the repl connection
+from .bulk import insert_many
 
 # This is both an external function and one used extensively
 # internally to convert coerce python values to RQL types
@@ -20,72 +22,307 @@ def expr(val, nesting_depth=20):
     if nesting_depth <= 0:
         raise RqlDriverError("Nesting depth limit exceeded")
 
+    converter = expr_converters.get(type(val))
+    if converter is None:
+        converter = _converter_for(val)
+    return converter(val, nesting_depth)
+
+# How expr converts values, by the exact type of the value. Term classes are
+# added by RqlQueryMeta; other types are added by _converter_for the first
+# time expr sees them, which saves the chain of isinstance checks.
+def _expr_term(val, nesting_depth):
+    return val
+
+def _expr_time(val, nesting_depth):
+    if not hasattr(val, 'tzinfo') or not val.tzinfo:
+        raise RqlDriverError("""Cannot convert %s to ReQL time object
+        without timezone information. You can add timezone information with
+        the third party module \"pytz\" or by constructing ReQL compatible
+        timezone values with r.make_timezone(\"[+-]HH:MM\"). Alternatively,
+        use one of ReQL's bultin time constructors, r.now, r.time, or r.iso8601.
+        """ % (type(val).__name__))
+    return ISO8601(val.isoformat())
+
+def _expr_container(val, nesting_depth):
+    return _expr_tree(val, nesting_depth, json_term_threshold)
+
+def _expr_func(val, nesting_depth):
+    return _cached_func(val)
+
+def _expr_int(val, nesting_depth):
+    if -1024 <= val <= 1024:
+        return _interned_datum(val)
+    return Datum(val)
+
+def _expr_string(val, nesting_depth):
+    if len(val) <= 32:
+        return _interned_datum(val)
+    return Datum(val)
+
+def _expr_constant(val, nesting_depth):
+    return _interned_datum(val)
+
+def _expr_datum(val, nesting_depth):
+    return Datum(val)
+
+expr_converters = {
+    types.NoneType: _expr_constant,
+    bool: _expr_constant,
+    int: _expr_int,
+    long: _expr_datum,
+    float: _expr_datum,
+    str: _expr_string,
+    unicode: _expr_string,
+    list: _expr_container,
+    dict: _expr_container,
+    datetime.datetime: _expr_time,
+    datetime.date: _expr_time,
+    types.FunctionType: _expr_func
+}
+
+def _converter_for(val):
     if isinstance(val, RqlQuery):
-        return val
+        converter = _expr_term
     elif isinstance(val, datetime.datetime) or isinstance(val, datetime.date):
-        if not hasattr(val, 'tzinfo') or not val.tzinfo:
-            raise RqlDriverError("""Cannot convert %s to ReQL time object
-            without timezone information. You can add timezone information with
-            the third party module \"pytz\" or by constructing ReQL compatible
-            timezone values with r.make_timezone(\"[+-]HH:MM\"). Alternatively,
-            use one of ReQL's bultin time constructors, r.now, r.time, or r.iso8601.
-            """ % (type(val).__name__))
-        return ISO8601(val.isoformat())
-    elif isinstance(val, list):
-        val = [expr(v, nesting_depth - 1) for v in val]
-        return MakeArray(*val)
-    elif isinstance(val, dict):
-        # MakeObj doesn't take the dict as a keyword args to avoid
-        # conflicting with the `self` parameter.
-        obj = {}
-        for k in val.keys():
-            obj[k] = expr(val[k], nesting_depth - 1)
-        return MakeObj(obj)
+        converter = _expr_time
+    elif isinstance(val, (list, dict)):
+        converter = _expr_container
     elif isinstance(val, collections.Callable):
-        return Func(val)
+        converter = _expr_func
     else:
-        return Datum(val)
+        converter = _expr_datum
+
+    # Instances of old-style classes all share one type
+    if type(val) is not types.InstanceType:
+        expr_converters[type(val)] = converter
+    return converter
+
+# Datums of small immutable values are shared by all the queries that use
+# them; terms are never changed once built. The cache is keyed by type as
+# well, since 1, 1.0 and True are equal but are different datums.
+interned_datums = {}
+
+def _interned_datum(val):
+    key = (type(val), val)
+    datum = interned_datums.get(key)
+    if datum is None:
+        datum = Datum(val)
+        # Short strings are unbounded in number, so stop adding at some point
+        if len(interned_datums) < 10000:
+            interned_datums[key] = datum
+    return datum
 
 # Like expr but attempts to serialize as much of the value as JSON
 # as possible.
 def exprJSON(val, nesting_depth=20):
-    if nesting_depth <= 0:
-        raise RqlDriverError("Nesting depth limit exceeded")
-
-    if isinstance(val, RqlQuery):
-        return val
-    elif isJSON(val, nesting_depth):
+    return _expr_tree(val, nesting_depth, 0)
+
+# Number of values a pure JSON list or dict must hold for expr to send it as a
+# single Json term rather than as a tree of MakeArray, MakeObj and Datum
+# terms, which costs a Python object and a protobuf message per value. None
+# turns this off. Scalars are always sent as Datums. (See the expr and
+# convert benchmarks in test/performance/driver_bench.py.)
+json_term_threshold = 32
+
+def _is_json_scalar(val):
+    if isinstance(val, float):
+        # JSON has no NaN or infinity
+        return not (math.isnan(val) or math.isinf(val))
+    return val is None or isinstance(val, (int, long, bool, str, unicode))
+
+json_scalar_types = frozenset([types.NoneType, bool, int, long, str, unicode])
+string_types = frozenset([str, unicode])
+
+# The keys of a dict, or None for a list, and the values
+def _container_items(val):
+    if isinstance(val, dict):
+        keys = val.keys()
+        return keys, [val[k] for k in keys]
+    return None, val
+
+# Returns a Json term for a pure JSON list or dict, or None if the json
+# module can't encode it
+def _json_term(val):
+    try:
         return Json(py_json.dumps(val))
-    elif isinstance(val, dict):
-        copy = val.copy()
-        for k,v in copy.items():
-            copy[k] = exprJSON(v, nesting_depth)
-        return MakeObj(copy)
-    elif isinstance(val, list):
-        copy = []
-        for v in val:
-            copy.append(exprJSON(v, nesting_depth))
-        return MakeArray(*copy)
-    else:
-        # Default to datum serialization
-        return expr(val, nesting_depth - 1)
-
-def isJSON(val, nesting_depth=20):
+    except UnicodeDecodeError:
+        # A byte string that isn't UTF-8 can't go in JSON
+        return None
+    except RuntimeError:
+        # The json module recurses, so values nested more deeply than
+        # Python's recursion limit are built as terms
+        return None
+
+# Builds the term for `val` in one walk over it, sending the lists and dicts
+# that are pure JSON and hold at least `threshold` values as Json terms.
+#
+# Nested lists and dicts are walked with an explicit stack rather than by
+# recursion. Each one is numbered as it is reached, so going through them
+# backwards sees every list or dict before the one holding it, with its size
+# known by then. A pure JSON one is left to the one holding it, since that
+# is sent as Json as a whole if it is pure JSON as well; no terms are made
+# for what it holds. Scalars are left for MakeArray and MakeObj to convert.
+def _expr_tree(val, nesting_depth, threshold):
     if nesting_depth <= 0:
         raise RqlDriverError("Nesting depth limit exceeded")
-
-    if isinstance(val, RqlQuery):
-        return False
-    elif isinstance(val, dict):
-        return all([isinstance(k, types.StringTypes) and isJSON(v, nesting_depth - 1) for k,v in val.items()])
-    elif isinstance(val, list):
-        return all([isJSON(v, nesting_depth - 1) for v in val])
-    elif isinstance(val, (int, float, str, unicode, bool)):
-        return True
+    if not isinstance(val, (list, dict)):
+        return expr(val, nesting_depth)
+
+    # (list or dict, keys, its values with the lists and dicts replaced by
+    # their terms once built, number of the holder, position in the holder)
+    containers = [ ]
+    sizes = [ ] # The number of values in each, or None if it isn't pure JSON
+    stack = [(val, nesting_depth, -1, None)]
+    while stack:
+        val, depth, parent, position = stack.pop()
+        index = len(containers)
+        keys, values = _container_items(val)
+        if values and depth <= 1:
+            raise RqlDriverError("Nesting depth limit exceeded")
+
+        # The lists and dicts in it add their own sizes later
+        size = None if threshold is None else 1 + len(values)
+        if size is not None and keys is not None:
+            # Pseudo-types are left to the server's usual conversion
+            if '$reql_type$' in val:
+                size = None
+            for k in keys:
+                if type(k) not in string_types and not isinstance(k, types.StringTypes):
+                    size = None
+                    break
+
+        terms = list(values)
+        for i, v in enumerate(terms):
+            if isinstance(v, (list, dict)):
+                stack.append((v, depth - 1, index, i))
+                if size is not None:
+                    size -= 1
+            elif size is not None and type(v) not in json_scalar_types:
+                # NaN and infinity aren't JSON; they give NaN when subtracted
+                if type(v) is float:
+                    if v - v != 0:
+                        size = None
+                elif not _is_json_scalar(v):
+                    size = None
+        containers.append((val, keys, terms, parent, position))
+        sizes.append(size)
+
+    # Most values are pure JSON but too small to send as Json, and for those
+    # every list and dict is built as usual
+    if threshold is None or (None not in sizes and sum(sizes) < threshold):
+        for index in xrange(len(containers) - 1, -1, -1):
+            term = _make_container(containers, index)
+        return term
+
+    left = [[] for c in containers] # The pure JSON ones left in each
+    counts = [1] * len(containers)  # The lists and dicts in each, itself included
+    for index in xrange(len(containers) - 1, -1, -1):
+        parent = containers[index][3]
+        size = sizes[index]
+        if size is not None:
+            if parent < 0:
+                return _finish_json(containers, sizes, counts, left, threshold, index)
+            if sizes[parent] is not None:
+                sizes[parent] += size
+                counts[parent] += counts[index]
+            left[parent].append(index)
+            continue
+
+        if parent >= 0:
+            sizes[parent] = None
+        for child in left[index]:
+            if sizes[child] < threshold:
+                # As in _finish_json
+                for inner in xrange(child + counts[child] - 1, child - 1, -1):
+                    _make_container(containers, inner)
+            else:
+                _finish_json(containers, sizes, counts, left, threshold, child)
+        term = _make_container(containers, index)
+    return term
+
+# Builds the MakeArray or MakeObj for one of the lists and dicts of
+# _expr_tree, once the terms of those it holds are in place
+def _make_container(containers, index):
+    val, keys, terms, parent, position = containers[index]
+    if keys is None:
+        term = MakeArray(*terms)
     else:
-        return False
+        # MakeObj doesn't take the dict as a keyword args to avoid
+        # conflicting with the `self` parameter.
+        obj = {}
+        for k, t in zip(keys, terms):
+            obj[k] = t
+        term = MakeObj(obj)
+    if parent >= 0:
+        containers[parent][2][position] = term
+    return term
+
+# Builds the term for a pure JSON list or dict left by _expr_tree: a Json
+# term if it is big enough, else a MakeArray or MakeObj of what it holds
+def _finish_json(containers, sizes, counts, left, threshold, index):
+    todo = [(index, False)]
+    while todo:
+        index, ready = todo.pop()
+        if ready:
+            term = _make_container(containers, index)
+        elif sizes[index] < threshold:
+            # Then so is everything in it, which is numbered right after it
+            for inner in xrange(index + counts[index] - 1, index - 1, -1):
+                term = _make_container(containers, inner)
+        else:
+            term = _json_term(containers[index][0])
+            if term is None:
+                # Built as terms after all, once what it holds is
+                todo.append((index, True))
+                for child in left[index]:
+                    todo.append((child, False))
+            else:
+                parent, position = containers[index][3:]
+                if parent >= 0:
+                    containers[parent][2][position] = term
+    return term
+
+# Gives the term classes defined in this module and in query.py empty
+# __slots__ unless they declare their own, so that terms don't each carry a
+# __dict__. Subclasses defined elsewhere get a __dict__ as usual. Every term
+# class is also added to expr_converters, so that expr returns its terms as
+# they are.
+slotted_modules = (__name__, __name__.rpartition('.')[0] + '.query')
+
+class RqlQueryMeta(type):
+    def __new__(mcs, name, bases, namespace):
+        # Classes made by calling type(), like the time names in query.py,
+        # don't have a __module__ yet: type takes it from the caller
+        module = namespace.get('__module__')
+        if module is None:
+            module = sys._getframe(1).f_globals.get('__name__')
+        if module in slotted_modules and '__slots__' not in namespace:
+            namespace['__slots__'] = ()
+        cls = type.__new__(mcs, name, bases, namespace)
+        expr_converters[cls] = _expr_term
+        return cls
+
+# Whether any of the terms contain r.row, found from the flag each term
+# sets when it is built
+def _any_implicit_var(args, optargs):
+    for arg in args:
+        if _contains_implicit_var(arg):
+            return True
+    for arg in optargs.itervalues():
+        if _contains_implicit_var(arg):
+            return True
+    return False
+
+def _contains_implicit_var(node):
+    try:
+        return node.has_implicit_var
+    except AttributeError:
+        # A term of a class that sets its arguments without RqlQuery.__init__
+        return _any_implicit_var(node.args, node.optargs)
 
 class RqlQuery(object):
+    __metaclass__ = RqlQueryMeta
+    __slots__ = ('args', 'optargs', 'has_implicit_var')
 
     # Instantiate this AST node with the given pos and opt args
     def __init__(self, *args, **optargs):
@@ -97,6 +334,8 @@ class RqlQuery(object):
                 continue
             self.optargs[k] = expr(optargs[k])
 
+        self.has_implicit_var = _any_implicit_var(self.args, self.optargs)
+
     # Send this query to the server to be executed
     def run(self, c=None, **global_opt_args):
         if not c:
@@ -505,6 +744,8 @@ def needs_wrap(arg):
     return isinstance(arg, Datum) or isinstance(arg, MakeArray) or isinstance(arg, MakeObj)
 
 class RqlBoolOperQuery(RqlQuery):
+    __slots__ = ('infix',)
+
     def __init__(self, *args, **optargs):
         if 'infix' in optargs:
             self.infix = optargs['infix']
@@ -560,6 +801,8 @@ class RqlMethodQuery(RqlQuery):
         return T(args[0], '.', self.st, '(', restargs, ')')
 
 class RqlBracketQuery(RqlMethodQuery):
+    __slots__ = ('bracket_operator',)
+
     def __init__(self, *args, **optargs):
         if 'bracket_operator' in optargs:
             self.bracket_operator = optargs['bracket_operator']
@@ -585,11 +828,12 @@ class RqlTzinfo(datetime.tzinfo):
         self.offsetstr = offsetstr
         self.delta = datetime.timedelta(hours=hours, minutes=minutes)
 
+    # Instances never change, so copies can share them
     def __copy__(self):
-        return RqlTzinfo(self.offsetstr)
+        return self
 
     def __deepcopy__(self, memo):
-        return RqlTzinfo(self.offsetstr)
+        return self
 
     def utcoffset(self, dt):
         return self.delta
@@ -600,15 +844,34 @@ class RqlTzinfo(datetime.tzinfo):
     def dst(self, dt):
         return datetime.timedelta(0)
 
+# The RqlTzinfo for each offset string seen so far, shared by all the times
+# converted with that offset
+tzinfos = { }
+
+def rql_tzinfo(offsetstr):
+    tz = tzinfos.get(offsetstr)
+    if tz is None:
+        tz = tzinfos[offsetstr] = RqlTzinfo(offsetstr)
+    return tz
+
 def reql_type_time_to_datetime(obj):
     if not 'epoch_time' in obj:
         raise RqlDriverError('pseudo-type TIME object %s does not have expected field "epoch_time".' % py_json.dumps(obj))
 
     if 'timezone' in obj:
-        return datetime.datetime.fromtimestamp(obj['epoch_time'], RqlTzinfo(obj['timezone']))
+        # The same as datetime.fromtimestamp(epoch_time, tz), without going
+        # through tz.fromutc
+        tz = rql_tzinfo(obj['timezone'])
+        return datetime.datetime.utcfromtimestamp(obj['epoch_time']).replace(tzinfo=tz) + tz.delta
     else:
         return datetime.datetime.utcfromtimestamp(obj['epoch_time'])
 
+def reql_type_time_to_epoch(obj):
+    if not 'epoch_time' in obj:
+        raise RqlDriverError('pseudo-type TIME object %s does not have expected field "epoch_time".' % py_json.dumps(obj))
+
+    return obj['epoch_time']
+
 # Python only allows immutable built-in types to be hashed, such as for keys in a dict
 # This means we can't use lists or dicts as keys in grouped data objects, so we convert
 # them to tuples and frozensets, respectively.
@@ -627,6 +890,114 @@ def reql_type_grouped_data_to_object(obj):
 
     return dict([(recursively_make_hashable(k),v) for (k,v) in obj['data']])
 
+# The result of a `group` with the `group_format='lazy'` run option. It keeps
+# the [key, value] pairs sent by the server and only makes the keys hashable,
+# to index them, the first time a group is looked up. Iterating over it
+# yields the (key, value) pairs as they were sent, with list and dict keys
+# left as they are.
+class GroupedResult(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.index = None
+
+    def _lookup(self):
+        if self.index is None:
+            self.index = dict([(recursively_make_hashable(k),v) for (k,v) in self.data])
+        return self.index
+
+    def __getitem__(self, key):
+        return self._lookup()[recursively_make_hashable(key)]
+
+    def get(self, key, default=None):
+        return self._lookup().get(recursively_make_hashable(key), default)
+
+    def __contains__(self, key):
+        return recursively_make_hashable(key) in self._lookup()
+
+    def __iter__(self):
+        for (k,v) in self.data:
+            yield (k, v)
+
+    def __len__(self):
+        return len(self.data)
+
+    def keys(self):
+        return [k for (k,v) in self.data]
+
+    def values(self):
+        return [v for (k,v) in self.data]
+
+    def items(self):
+        return [(k, v) for (k,v) in self.data]
+
+    # The dict that the 'native' group format returns
+    def to_dict(self):
+        return dict(self._lookup())
+
+    def __eq__(self, other):
+        if isinstance(other, GroupedResult):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "GroupedResult(%r)" % (self.items(),)
+
+def reql_type_grouped_data_to_result(obj):
+    if not 'data' in obj:
+        raise RqlDriverError('pseudo-type GROUPED_DATA object %s does not have the expected field "data".' % py_json.dumps(obj))
+
+    return GroupedResult(obj['data'])
+
+# Decodes the JSON text of R_JSON datums, converting pseudo-types as it goes.
+# `name` picks the JSON library used: 'json' (the default), 'simplejson' or
+# 'ujson'. The last one has no object hook, so pseudo-types are converted in a
+# second pass over the result as before.
+class JsonDecoder(object):
+
+    def __init__(self, name='json'):
+        self.name = name
+        self.object_hook = True
+        if name == 'json':
+            self.loads = py_json.loads
+        elif name == 'simplejson':
+            try:
+                import simplejson
+            except ImportError:
+                raise RqlDriverError("The simplejson package is not installed.")
+            self.loads = simplejson.loads
+        elif name == 'ujson':
+            try:
+                import ujson
+            except ImportError:
+                raise RqlDriverError("The ujson package is not installed.")
+            self.object_hook = False
+            # Older versions round floats unless asked not to
+            try:
+                ujson.loads('0.1', precise_float=True)
+                self.loads = lambda text: ujson.loads(text, precise_float=True)
+            except TypeError:
+                self.loads = ujson.loads
+        else:
+            raise RqlDriverError("Unknown JSON decoder \"%s\"." % name)
+
+    def decode(self, text, format_opts={}):
+        # Most rows contain no pseudo-types at all, and for those there is
+        # nothing to convert
+        if '$reql_type$' not in text:
+            return self.loads(text)
+        if self.object_hook:
+            convert = Datum._convert_pseudotype
+            return self.loads(text, object_hook=lambda obj: convert(obj, format_opts))
+        return Datum._recursively_convert_pseudotypes(self.loads(text), format_opts)
+
+default_json_decoder = JsonDecoder()
+
 # This class handles the conversion of RQL terminal types in both directions
 # Going to the server though it does not support R_ARRAY or R_OBJECT as those
 # are alternately handled by the MakeArray and MakeObject nodes. Why do this?
@@ -635,8 +1006,10 @@ def reql_type_grouped_data_to_object(obj):
 # R_ARRAYs and R_OBJECTs would require verifying that at all nested levels
 # our arrays and objects are composed only of basic types.
 class Datum(RqlQuery):
+    __slots__ = ('data',)
     args = []
     optargs = {}
+    has_implicit_var = False
 
     def __init__(self, val):
         self.data = val
@@ -670,12 +1043,17 @@ class Datum(RqlQuery):
                 if time_format is None or time_format == 'native':
                     # Convert to native python datetime object
                     return reql_type_time_to_datetime(obj)
+                elif time_format == 'epoch':
+                    # Seconds since the epoch, as a float
+                    return reql_type_time_to_epoch(obj)
                 elif time_format != 'raw':
                     raise RqlDriverError("Unknown time_format run option \"%s\"." % time_format)
             elif reql_type == 'GROUPED_DATA':
                 group_format = format_opts.get('group_format')
                 if group_format is None or group_format == 'native':
                     return reql_type_grouped_data_to_object(obj)
+                elif group_format == 'lazy':
+                    return reql_type_grouped_data_to_result(obj)
                 elif group_format != 'raw':
                     raise RqlDriverError("Unknown group_format run option \"%s\"." % group_format)
             else:
@@ -694,12 +1072,24 @@ class Datum(RqlQuery):
                 obj[i] = Datum._recursively_convert_pseudotypes(obj[i], format_opts)
         return obj
 
+    # Converts the datums of a batch. The R_JSON datums that the server
+    # normally sends are decoded together, as one JSON array, which saves
+    # setting up the decoder and its pseudo-type hook for each row.
+    @staticmethod
+    def deconstruct_many(datums, format_opts={}):
+        if len(datums) > 1:
+            texts = [datum.r_str for datum in datums if datum.type == p.Datum.R_JSON]
+            if len(texts) == len(datums):
+                decoder = format_opts.get('json_decoder', default_json_decoder)
+                return decoder.decode(u'[' + u','.join(texts) + u']', format_opts)
+        return [Datum.deconstruct(datum, format_opts) for datum in datums]
+
     @staticmethod
     def deconstruct(datum, format_opts={}):
         d_type = datum.type
         if d_type == p.Datum.R_JSON:
-            obj = py_json.loads(datum.r_str)
-            return Datum._recursively_convert_pseudotypes(obj, format_opts)
+            decoder = format_opts.get('json_decoder', default_json_decoder)
+            return decoder.decode(datum.r_str, format_opts)
         elif d_type == p.Datum.R_OBJECT:
             obj = { }
             for pair in datum.r_object:
@@ -709,8 +1099,7 @@ class Datum(RqlQuery):
             # be an object or something else. We need a second layer of type switching, this
             # time on an obfuscated field "$reql_type$" rather than the datum type field we
             # already switched on.
-            Datum._convert_pseudotype(obj, format_opts)
-            return obj
+            return Datum._convert_pseudotype(obj, format_opts)
         elif d_type == p.Datum.R_ARRAY:
             array = datum.r_array
             return [Datum.deconstruct(e, format_opts) for e in array]
@@ -757,6 +1146,8 @@ class MakeObj(RqlQuery):
                 raise RqlDriverError("Object keys must be strings.");
             self.optargs[k] = expr(obj_dict[k])
 
+        self.has_implicit_var = _any_implicit_var(self.args, self.optargs)
+
     def compose(self, args, optargs):
         return T('{', T(*[T(repr(name), ': ', optargs[name]) for name in optargs.keys()], intsp=', '), '}')
 
@@ -779,8 +1170,14 @@ class Default(RqlMethodQuery):
     st = "default"
 
 class ImplicitVar(RqlQuery):
+    # r.row is the one instance, and docs.py gives it a docstring
+    __slots__ = ('__dict__',)
     tt = p.Term.IMPLICIT_VAR
 
+    def __init__(self):
+        RqlQuery.__init__(self)
+        self.has_implicit_var = True
+
     def compose(self, args, optargs):
         return 'r.row'
 
@@ -961,6 +1358,12 @@ class Table(RqlQuery):
         return Insert(self, exprJSON(records), upsert=upsert,
                       durability=durability, return_vals=return_vals)
 
+    # Inserts documents from any iterable in batches; see bulk.insert_many
+    def insert_many(self, docs, c=None, batch_rows=200, batch_bytes=500000, max_in_flight=4,
+                    target_latency=0.5, upsert=(), durability=()):
+        return insert_many(self, docs, c, batch_rows, batch_bytes, max_in_flight, target_latency,
+                           upsert=upsert, durability=durability)
+
     def get(self, key):
         return Get(self, key)
 
@@ -1311,47 +1714,137 @@ class ToEpochTime(RqlMethodQuery):
 def func_wrap(val):
     val = expr(val)
 
-    # Scan for IMPLICIT_VAR or JS
-    def ivar_scan(node):
-        if not isinstance(node, RqlQuery):
-            return False
-
-        if isinstance(node, ImplicitVar):
-            return True
-        if any([ivar_scan(arg) for arg in node.args]):
-            return True
-        if any([ivar_scan(arg) for k,arg in node.optargs.items()]):
-            return True
-        return False
-
-    if ivar_scan(val):
+    # Uses of IMPLICIT_VAR need a function around them
+    if _contains_implicit_var(val):
         return Func(lambda x: val)
 
     return val
 
 class Func(RqlQuery):
+    __slots__ = ('vrs',)
     tt = p.Term.FUNC
-    lock = Lock()
-    nextVarId = 1
+
+    # Taking the next id is atomic, so the counter needs no lock
+    var_ids = itertools.count(1)
 
     def __init__(self, lmbd):
         vrs = []
         vrids = []
         for i in range(lmbd.func_code.co_argcount):
-            Func.lock.acquire()
-            var_id = Func.nextVarId
-            Func.nextVarId += 1
-            Func.lock.release()
+            var_id = next(Func.var_ids)
             vrs.append(Var(var_id))
             vrids.append(var_id)
 
         self.vrs = vrs
         self.args = [MakeArray(*vrids), expr(lmbd(*vrs))]
         self.optargs = {}
+        self.has_implicit_var = _any_implicit_var(self.args, self.optargs)
 
     def compose(self, args, optargs):
             return T('lambda ', T(*[v.compose([v.args[0].compose(None, None)], []) for v in self.vrs], intsp=', '), ': ', args[1])
 
+# Functions built from lambdas, so that running the same query again doesn't
+# call its lambdas again. A lambda's term only depends on its code and on the
+# values it refers to, so those make the key. Lambdas are only cached when
+# every such value is known not to change, or to give the same term each time
+# it's used: immutable values, terms, and the driver's own functions. Anything
+# else, like calling time.time() in a lambda, makes it uncacheable. Setting
+# func_cache_size to 0 turns caching off.
+func_cache = {}
+func_cache_size = 1024
+
+class _Uncacheable(Exception):
+    pass
+
+# Builtins that give the same result for the same immutable arguments
+pure_builtins = frozenset(['len', 'abs', 'min', 'max', 'round', 'sum', 'repr'])
+
+def _is_driver_value(value):
+    if isinstance(value, types.ModuleType):
+        module = value.__name__
+    else:
+        module = getattr(value, '__module__', None) or ''
+    return module == 'rethinkdb' or module.startswith('rethinkdb.')
+
+# Returns a hashable stand-in for a value a lambda refers to. Values that
+# are only known by identity are added to `pinned`, which the cache keeps
+# alive so that their ids aren't reused.
+def _cache_key_of(value, pinned):
+    t = type(value)
+    if t in (types.NoneType, bool, int, long, float, str, unicode):
+        return (t, value)
+    elif t is tuple:
+        return (t, tuple([_cache_key_of(v, pinned) for v in value]))
+    elif isinstance(value, RqlQuery) or _is_driver_value(value):
+        # Terms overload ==, so they must not be compared
+        pinned.append(value)
+        return (id(value),)
+    elif isinstance(value, (type, types.BuiltinFunctionType)) and value.__module__ == '__builtin__':
+        if isinstance(value, type) or value.__name__ in pure_builtins:
+            return (id(value),)
+    raise _Uncacheable()
+
+# The names a code object uses, including in the functions defined in it.
+# These are the globals it may load, along with attribute names, which don't
+# refer to anything outside of the code.
+code_names = {}
+
+def _code_names(code):
+    if code in code_names:
+        return code_names[code]
+
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _code_names(const)
+
+    if len(code_names) >= 4096:
+        code_names.clear()
+    code_names[code] = names
+    return names
+
+def _func_cache_key(lmbd, pinned):
+    code = lmbd.func_code
+    builtins = lmbd.func_globals.get('__builtins__', {})
+    if isinstance(builtins, types.ModuleType):
+        builtins = builtins.__dict__
+    global_keys = [ ]
+    for name in sorted(_code_names(code)):
+        if name in lmbd.func_globals:
+            global_keys.append((name, _cache_key_of(lmbd.func_globals[name], pinned)))
+        elif name in builtins:
+            global_keys.append((name, _cache_key_of(builtins[name], pinned)))
+
+    closure_keys = [ ]
+    for cell in lmbd.func_closure or ():
+        try:
+            closure_keys.append(_cache_key_of(cell.cell_contents, pinned))
+        except ValueError:
+            # The variable isn't bound yet
+            raise _Uncacheable()
+
+    return (code, _cache_key_of(lmbd.func_defaults, pinned), tuple(closure_keys), tuple(global_keys))
+
+def _cached_func(lmbd):
+    if func_cache_size <= 0:
+        return Func(lmbd)
+
+    pinned = [ ]
+    try:
+        key = _func_cache_key(lmbd, pinned)
+    except (_Uncacheable, AttributeError):
+        return Func(lmbd)
+
+    try:
+        return func_cache[key][0]
+    except KeyError:
+        pass
+    func = Func(lmbd)
+    if len(func_cache) >= func_cache_size:
+        func_cache.clear()
+    func_cache[key] = (func, pinned)
+    return func
+
 class Asc(RqlTopLevelQuery):
     tt = p.Term.ASC
     st = 'asc'
@@ -0,0 +1,407 @@
+# Copyright 2010-2013 RethinkDB, all rights reserved.
+
+# An event loop based connection, speaking the same protocol as net.Connection
+# over asyncio streams. This driver supports Python 2, so it is written against
+# trollius, the Python 2 port of asyncio, and is only usable when that package
+# is installed: coroutines `yield From(...)` and `raise Return(...)` instead of
+# using `await` and `return`.
+
+__all__ = ['AsyncConnection', 'AsyncCursor']
+
+import struct
+from collections import deque
+
+import trollius as asyncio
+from trollius import From, Return
+
+from rethinkdb import ql2_pb2 as p
+
+from rethinkdb.errors import *
+from rethinkdb.ast import Datum, JsonDecoder
+from rethinkdb.net import serialize_start_query, driver_opts_from, format_opts_from, convert_datum, check_error_response, \
+    default_prefetch, continue_count
+
+class AsyncCursor(object):
+    def __init__(self, conn, token, term, format_opts, prefetch, timeout=None):
+        self.conn = conn
+        self.token = token
+        self.term = term
+        self.format_opts = format_opts
+        self.prefetch = prefetch
+        self.timeout = timeout
+        self.responses = deque()
+        self.rows = deque()
+        self.outstanding_requests = 0
+        self.end_flag = False
+        self.error = None
+        self.waiter = None
+        self.continues = set() # Tasks sending this cursor's CONTINUEs
+
+    # Called by the connection for each response to this cursor's token
+    def _extend(self, response):
+        if response.type != p.Response.SUCCESS_PARTIAL:
+            self.end_flag = True
+        self.responses.append(response)
+        self._prefetch()
+        self._wake()
+
+    def _fail(self, err):
+        self.error = err
+        self._wake()
+
+    # Called when a task sending CONTINUEs is done. If the send failed, the
+    # batches it asked for won't come, so the error goes to the reader.
+    def _continue_sent(self, task):
+        self.continues.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self._fail(task.exception())
+
+    def _wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    # Keep the prefetch window full, as net.Cursor does. The batch being read
+    # has already been moved to `rows`.
+    def _prefetch(self):
+        count = continue_count(self.prefetch, self.outstanding_requests, len(self.responses))
+        if not self.end_flag and count > 0:
+            self.conn._continue_cursor(self, count)
+
+    # Waits until a row can be returned by `next`. Returns False once the
+    # cursor is exhausted.
+    @asyncio.coroutine
+    def fetch_next(self):
+        while not self.rows:
+            if self.responses:
+                response = self.responses.popleft()
+                check_error_response(response, self.term)
+                if response.type != p.Response.SUCCESS_PARTIAL and response.type != p.Response.SUCCESS_SEQUENCE:
+                    raise RqlDriverError("Unexpected response type received for cursor")
+                self.rows.extend(response.response)
+                self._prefetch()
+            elif self.error is not None:
+                raise self.error
+            elif self.end_flag:
+                raise Return(False)
+            else:
+                self._prefetch()
+                self.waiter = asyncio.Future(loop=self.conn.loop)
+                try:
+                    yield From(asyncio.wait_for(self.waiter, self.timeout, loop=self.conn.loop))
+                except asyncio.TimeoutError:
+                    err = RqlTimeoutError(self.timeout)
+                    self.conn._cancel_cursor(self, err)
+                    raise err
+                finally:
+                    self.waiter = None
+        raise Return(True)
+
+    # Returns the next row, raising RqlCursorEmpty when there are none left
+    @asyncio.coroutine
+    def next(self):
+        if not (yield From(self.fetch_next())):
+            raise RqlCursorEmpty()
+        raise Return(convert_datum(self.rows.popleft(), self.format_opts))
+
+    @asyncio.coroutine
+    def to_list(self):
+        rows = [ ]
+        while (yield From(self.fetch_next())):
+            rows.append(convert_datum(self.rows.popleft(), self.format_opts))
+        raise Return(rows)
+
+    @asyncio.coroutine
+    def close(self):
+        if not self.end_flag:
+            self.end_flag = True
+            yield From(self.conn._end_cursor(self))
+
+class AsyncConnection(object):
+    def __init__(self, host, port, db, auth_key, timeout, loop=None, json_decoder='json'):
+        self.host = host
+        self.db = db
+        self.auth_key = auth_key
+        self.timeout = timeout
+        self.json_decoder = JsonDecoder(json_decoder)
+        self.loop = loop or asyncio.get_event_loop()
+        self.next_token = 1
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.futures = { }
+        self.cursor_cache = { }
+
+        # Token -> number of responses still to come that nobody is waiting for
+        self.ignored_responses = { }
+
+        # Try to convert the port to an integer
+        try:
+          self.port = int(port)
+        except ValueError as err:
+          raise RqlDriverError("Could not convert port %s to an integer." % port)
+
+    @asyncio.coroutine
+    def reconnect(self, noreply_wait=True):
+        yield From(self.close(noreply_wait))
+
+        try:
+            self.reader, self.writer = yield From(asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, loop=self.loop),
+                self.timeout, loop=self.loop))
+        except Exception as err:
+            raise RqlDriverError("Could not connect to %s:%s. Error: %s" % (self.host, self.port, err))
+
+        self.writer.write(struct.pack("<L", p.VersionDummy.V0_2))
+        self.writer.write(struct.pack("<L", len(self.auth_key)) + str.encode(self.auth_key, 'ascii'))
+
+        # Read out the response from the server, which will be a null-terminated
+        # string. The server sends nothing after it until it gets a query, so
+        # it can be read in chunks. (trollius streams have no readuntil.)
+        response = b""
+        while True:
+            chunk = yield From(self.reader.read(1024))
+            response += chunk
+            end = response.find(b"\0")
+            if end != -1:
+                if end != len(response) - 1:
+                    yield From(self.close(noreply_wait=False))
+                    raise RqlDriverError("Unexpected response received.")
+                response = response[:end]
+                break
+            if chunk == b"":
+                break
+
+        if response != b"SUCCESS":
+            yield From(self.close(noreply_wait=False))
+            raise RqlDriverError("Server dropped connection with message: \"%s\"" % response.strip())
+
+        # Connection is now initialized
+        self.reader_task = asyncio.ensure_future(self._reader_loop(), loop=self.loop)
+        raise Return(self)
+
+    @asyncio.coroutine
+    def close(self, noreply_wait=True):
+        if self.writer is not None:
+            if noreply_wait:
+                yield From(self.noreply_wait())
+            self.writer.close()
+            self.writer = None
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            self.reader_task = None
+        self._fail_all(RqlDriverError("Connection is closed."))
+
+    def use(self, db):
+        self.db = db
+
+    @asyncio.coroutine
+    def noreply_wait(self):
+        query = p.Query()
+        query.type = p.Query.NOREPLY_WAIT
+        query.token = self._new_token()
+        yield From(self._send_query(query))
+
+    def _new_token(self):
+        token = self.next_token
+        self.next_token += 1
+        return token
+
+    # RqlQuery.run calls this, so `yield From(query.run(conn))` runs a query
+    # on this connection. The `prefetch` run option sets how many batches a
+    # cursor reads ahead in the background. With the `timeout` run option,
+    # the query, or a cursor waiting for its next batch, raises
+    # RqlTimeoutError when the server takes longer than that many seconds to
+    # answer. As with net.Connection, the server keeps running the query,
+    # and the queries sent after it on this connection wait until it is done.
+    @asyncio.coroutine
+    def _start(self, term, **global_opt_args):
+        driver_opts = driver_opts_from(global_opt_args)
+        query, query_protobuf = serialize_start_query(self._new_token(), term, self.db, global_opt_args, True)
+        value = yield From(self._run_query(query, term, global_opt_args, driver_opts, query_protobuf))
+        raise Return(value)
+
+    # PreparedQuery.run calls this
+    @asyncio.coroutine
+    def _start_prepared(self, prepared, params, **global_opt_args):
+        driver_opts = driver_opts_from(global_opt_args)
+
+        query = p.Query()
+        query.type = p.Query.START
+        query.token = self._new_token()
+        query_protobuf = prepared._serialize(query.token, params, self.db, global_opt_args, True)
+        value = yield From(self._run_query(query, prepared.term, global_opt_args, driver_opts, query_protobuf))
+        raise Return(value)
+
+    @asyncio.coroutine
+    def _run_query(self, query, term, global_opt_args, driver_opts, query_protobuf=None):
+        prefetch = driver_opts.get('prefetch', default_prefetch)
+        timeout = driver_opts.get('timeout')
+
+        if global_opt_args.get('noreply'):
+            yield From(self._send_query(query, expect_response=False, query_protobuf=query_protobuf))
+            raise Return(None)
+
+        response = yield From(self._send_query(query, query_protobuf=query_protobuf, timeout=timeout))
+        check_error_response(response, term)
+        format_opts = format_opts_from(dict(global_opt_args, **driver_opts), self.json_decoder)
+
+        if response.type == p.Response.SUCCESS_PARTIAL or response.type == p.Response.SUCCESS_SEQUENCE:
+            value = AsyncCursor(self, query.token, term, format_opts, prefetch, timeout)
+            if response.type == p.Response.SUCCESS_PARTIAL:
+                self.cursor_cache[query.token] = value
+            value._extend(response)
+        elif response.type == p.Response.SUCCESS_ATOM:
+            value = convert_datum(response.response[0], format_opts)
+        else:
+            raise RqlDriverError("Unknown Response type %d encountered in response." % response.type)
+
+        if response.HasField('profile'):
+            value = {"value": value, "profile": Datum.deconstruct(response.profile)}
+        raise Return(value)
+
+    # Sends `count` copies of a query in one write and, if `expect_response`,
+    # waits for the response to it, for up to `timeout` seconds
+    @asyncio.coroutine
+    def _send_query(self, query, expect_response=True, query_protobuf=None, timeout=None, count=1):
+        # Error if this connection has closed
+        if self.writer is None:
+            raise RqlDriverError("Connection is closed.")
+
+        if query_protobuf is None:
+            query.accepts_r_json = True
+            query_protobuf = query.SerializeToString()
+
+        future = None
+        if expect_response:
+            future = asyncio.Future(loop=self.loop)
+            self.futures[query.token] = future
+
+        self.writer.write((struct.pack("<L", len(query_protobuf)) + query_protobuf) * count)
+        yield From(self.writer.drain())
+
+        if future is not None:
+            try:
+                response = yield From(asyncio.wait_for(future, timeout, loop=self.loop))
+            except asyncio.TimeoutError:
+                err = RqlTimeoutError(timeout)
+                self._cancel_query(query.token)
+                raise err
+            raise Return(response)
+
+    def _continue_cursor(self, cursor, count=1):
+        cursor.outstanding_requests += count
+
+        query = p.Query()
+        query.type = p.Query.CONTINUE
+        query.token = cursor.token
+        task = asyncio.ensure_future(self._send_query(query, expect_response=False, count=count), loop=self.loop)
+        cursor.continues.add(task)
+        task.add_done_callback(cursor._continue_sent)
+
+    # Gives up on a query that timed out: the server is sent a STOP for it,
+    # and its response and the one to the STOP are dropped as they arrive
+    def _cancel_query(self, token):
+        self.futures.pop(token, None)
+        self._stop_ignored(token, 2)
+
+    # Ends a cursor that timed out waiting for a batch, dropping the responses
+    # to its CONTINUEs still in flight and to the STOP
+    def _cancel_cursor(self, cursor, err):
+        cursor.end_flag = True
+        cursor.error = err
+        if self.cursor_cache.pop(cursor.token, None) is not None:
+            self._stop_ignored(cursor.token, cursor.outstanding_requests + 1)
+
+    def _stop_ignored(self, token, pending):
+        self.ignored_responses[token] = self.ignored_responses.get(token, 0) + pending
+        if self.writer is None:
+            return
+        query = p.Query()
+        query.type = p.Query.STOP
+        query.token = token
+        asyncio.ensure_future(self._send_query(query, expect_response=False), loop=self.loop)
+
+    # Returns whether a response for `token` was expected to be ignored
+    def _skip_ignored_response(self, token):
+        remaining = self.ignored_responses.get(token)
+        if remaining is None:
+            return False
+        if remaining > 1:
+            self.ignored_responses[token] = remaining - 1
+        else:
+            del self.ignored_responses[token]
+        return True
+
+    @asyncio.coroutine
+    def _end_cursor(self, cursor):
+        cursor.outstanding_requests += 1
+
+        query = p.Query()
+        query.type = p.Query.STOP
+        query.token = cursor.token
+        yield From(self._send_query(query, expect_response=False))
+
+        # Wait for the STOP, and any CONTINUE still in flight, to be answered
+        while cursor.token in self.cursor_cache and cursor.error is None:
+            cursor.waiter = asyncio.Future(loop=self.loop)
+            yield From(cursor.waiter)
+            cursor.waiter = None
+
+    @asyncio.coroutine
+    def _reader_loop(self):
+        try:
+            while True:
+                header = yield From(self.reader.readexactly(4))
+                (response_len,) = struct.unpack("<L", header)
+                response_buf = yield From(self.reader.readexactly(response_len))
+
+                response = p.Response()
+                response.ParseFromString(response_buf)
+                self._dispatch(response)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            if not isinstance(err, RqlDriverError):
+                err = RqlDriverError("Connection is closed.")
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            self._fail_all(err)
+
+    def _dispatch(self, response):
+        future = self.futures.pop(response.token, None)
+        if future is not None:
+            if not future.cancelled():
+                future.set_result(response)
+        elif response.token in self.cursor_cache:
+            cursor = self.cursor_cache[response.token]
+            cursor.outstanding_requests -= 1
+            if response.type != p.Response.SUCCESS_PARTIAL:
+                del self.cursor_cache[response.token]
+                # Responses to CONTINUEs sent past the end of the stream
+                if cursor.outstanding_requests > 0:
+                    self.ignored_responses[response.token] = cursor.outstanding_requests
+            if cursor.end_flag:
+                # The cursor has been closed, which drops its rows
+                cursor._wake()
+            else:
+                cursor._extend(response)
+        elif not self._skip_ignored_response(response.token):
+            # This response is corrupted or not intended for us.
+            raise RqlDriverError("Unexpected response received.")
+
+    def _fail_all(self, err):
+        futures, self.futures = self.futures, { }
+        for future in futures.values():
+            if not future.done():
+                future.set_exception(err)
+        cursors, self.cursor_cache = self.cursor_cache, { }
+        for cursor in cursors.values():
+            cursor._fail(err)
+        self.ignored_responses = { }
+
+@asyncio.coroutine
+def connect(host='localhost', port=28015, db=None, auth_key="", timeout=20, loop=None, json_decoder='json'):
+    conn = AsyncConnection(host, port, db, auth_key, timeout, loop, json_decoder)
+    yield From(conn.reconnect(noreply_wait=False))
+    raise Return(conn)
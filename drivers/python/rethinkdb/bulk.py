@@ -0,0 +1,135 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+__all__ = ['insert_many']
+
+import json
+import time
+import threading
+
+from rethinkdb.errors import *
+from rethinkdb import repl # For the repl connection
+
+# With `batch_bytes`, batches are cut using the average size of one document
+# in this many, rather than encoding every document only to measure it
+size_sample_interval = 16
+
+# Cuts an iterable of documents into batches for the insert workers. The
+# batch size starts at `batch_rows` and then follows the write latency:
+# batches shrink when a round of writes takes longer than `target_latency`
+# and grow back (up to `batch_rows`) when it is faster.
+class Batcher(object):
+    def __init__(self, docs, batch_rows, batch_bytes, target_latency):
+        self.docs = iter(docs)
+        self.max_rows = batch_rows
+        self.batch_bytes = batch_bytes
+        self.target_latency = target_latency
+        self.rows = batch_rows
+        self.next_index = 0
+        self.exhausted = False
+        self.seen = 0           # Documents taken so far
+        self.sampled_docs = 0   # How many of them were measured
+        self.sampled_bytes = 0  # and their total size
+        self.lock = threading.Lock()
+
+    # Returns up to `count` (index, documents) pairs, indexed in the order
+    # the documents came in
+    def take(self, count):
+        batches = [ ]
+        with self.lock:
+            while len(batches) < count and not self.exhausted:
+                batch = [ ]
+                size = 0
+                while len(batch) < self.rows and (self.batch_bytes is None or size < self.batch_bytes):
+                    try:
+                        doc = next(self.docs)
+                    except StopIteration:
+                        self.exhausted = True
+                        break
+                    batch.append(doc)
+                    if self.batch_bytes is not None:
+                        # Only an estimate: what the server gets isn't JSON
+                        if self.seen % size_sample_interval == 0:
+                            self.sampled_docs += 1
+                            self.sampled_bytes += len(json.dumps(doc, default=str))
+                        size = len(batch) * self.sampled_bytes / self.sampled_docs
+                    self.seen += 1
+                if batch:
+                    batches.append((self.next_index, batch))
+                    self.next_index += 1
+        return batches
+
+    def record_latency(self, latency):
+        if self.target_latency is None:
+            return
+        with self.lock:
+            scale = self.target_latency / max(latency, 1e-6)
+            scale = min(max(scale, 0.5), 2.0)
+            self.rows = min(max(int(self.rows * scale), 1), self.max_rows)
+
+# Adds up the results of the insert batches, in batch order
+def merge_results(results):
+    merged = {"inserted": 0, "errors": 0}
+    for result in results:
+        for key, value in result.iteritems():
+            if key not in merged:
+                merged[key] = list(value) if isinstance(value, list) else value
+            elif isinstance(value, bool):
+                pass
+            elif isinstance(value, (int, long, float)):
+                merged[key] += value
+            elif isinstance(value, list):
+                merged[key].extend(value)
+            # Anything else, like `first_error`, keeps its first value
+    return merged
+
+# Inserts the documents from an iterable in batches of at most `batch_rows`
+# documents and about `batch_bytes` bytes, pipelining up to `max_in_flight`
+# batches on each connection (see `Connection.run_many`). `c` may also be a
+# list of connections, which then insert side by side, each in its own
+# thread. Returns the merged results of all the batches, as one insert of
+# all the documents would; if a batch fails as a whole, its error is raised
+# once the batches in flight have been answered.
+def insert_many(table, docs, c=None, batch_rows=200, batch_bytes=500000, max_in_flight=4,
+                target_latency=0.5, **insert_opts):
+    if not c:
+        if repl.default_connection:
+            c = repl.default_connection
+        else:
+            raise RqlDriverError("Table.insert_many must be given a connection to run on.")
+    conns = c if isinstance(c, (list, tuple)) else [c]
+
+    if batch_rows < 1 or max_in_flight < 1:
+        raise RqlDriverError("Invalid batching: batch_rows=%s, max_in_flight=%s." % (batch_rows, max_in_flight))
+
+    batcher = Batcher(docs, batch_rows, batch_bytes, target_latency)
+    results = { }
+    errors = [ ]
+
+    def worker(conn):
+        try:
+            while not errors:
+                batches = batcher.take(max_in_flight)
+                if not batches:
+                    return
+                start = time.time()
+                responses = conn.run_many([table.insert(batch, **insert_opts) for index, batch in batches])
+                batcher.record_latency(time.time() - start)
+                for (index, batch), response in zip(batches, responses):
+                    if isinstance(response, RqlError):
+                        raise response
+                    results[index] = response
+        except Exception as err:
+            errors.append(err)
+
+    if len(conns) == 1:
+        worker(conns[0])
+    else:
+        threads = [threading.Thread(target=worker, args=(conn,)) for conn in conns]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return merge_results(results[index] for index in sorted(results))
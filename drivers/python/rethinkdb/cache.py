@@ -0,0 +1,172 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# An opt-in cache of query results for a connection (see
+# Connection.enable_cache). Only queries made of deterministic read terms are
+# cached, keyed by their serialized form. A write run on the same connection
+# drops the results read from the tables it touches; writes made by anyone
+# else are only seen once an entry's `ttl` runs out.
+
+__all__ = ['QueryCache']
+
+import threading
+import time
+from collections import OrderedDict
+
+from rethinkdb import ast
+
+# Terms that read the same result each time as long as the tables they read
+# don't change
+cacheable_terms = frozenset([
+    ast.Datum, ast.MakeArray, ast.MakeObj, ast.Var, ast.ImplicitVar, ast.Func, ast.FunCall,
+    ast.Default, ast.Eq, ast.Ne, ast.Lt, ast.Le, ast.Gt, ast.Ge, ast.Not, ast.Add, ast.Sub,
+    ast.Mul, ast.Div, ast.Mod, ast.Append, ast.Prepend, ast.Difference, ast.SetInsert,
+    ast.SetUnion, ast.SetIntersection, ast.SetDifference, ast.Slice, ast.Skip, ast.Limit,
+    ast.GetField, ast.Contains, ast.HasFields, ast.WithFields, ast.Keys, ast.Object, ast.Pluck,
+    ast.Without, ast.Merge, ast.Between, ast.DB, ast.Table, ast.Get, ast.GetAll, ast.Reduce,
+    ast.Sum, ast.Avg, ast.Min, ast.Max, ast.Map, ast.Filter, ast.ConcatMap, ast.OrderBy,
+    ast.Distinct, ast.Count, ast.Union, ast.Nth, ast.Match, ast.Split, ast.Upcase,
+    ast.Downcase, ast.IndexesOf, ast.IsEmpty, ast.Group, ast.InnerJoin, ast.OuterJoin,
+    ast.EqJoin, ast.Zip, ast.CoerceTo, ast.Ungroup, ast.TypeOf, ast.Branch, ast.Any, ast.All,
+    ast.InsertAt, ast.SpliceAt, ast.DeleteAt, ast.ChangeAt, ast.Json, ast.ToISO8601,
+    ast.During, ast.Date, ast.TimeOfDay, ast.Timezone, ast.Year, ast.Month, ast.Day,
+    ast.DayOfWeek, ast.DayOfYear, ast.Hours, ast.Minutes, ast.Seconds, ast.Time, ast.ISO8601,
+    ast.EpochTime, ast.InTimezone, ast.ToEpochTime, ast.Asc, ast.Desc, ast.Literal
+])
+
+# Terms that write to the tables in the query
+write_terms = frozenset([ast.Insert, ast.Update, ast.Replace, ast.Delete, ast.ForEach,
+                         ast.IndexCreate, ast.IndexDrop, ast.Sync])
+
+# Terms that create or drop databases and tables, after which no cached
+# result can be trusted
+schema_terms = frozenset([ast.DbCreate, ast.DbDrop, ast.TableCreate, ast.TableCreateTL,
+                          ast.TableDrop, ast.TableDropTL])
+
+# Returns the name held by a Datum term, or None if the term is computed
+def literal_name(term):
+    if type(term) is ast.Datum and isinstance(term.data, basestring):
+        return term.data
+    return None
+
+# Returns (db, table) for a Table term, or None if its names are computed.
+# The db is None when the table is in the query's default database.
+def table_name(term, default_db):
+    if len(term.args) > 1:
+        if type(term.args[0]) is not ast.DB:
+            return None
+        db = literal_name(term.args[0].args[0])
+        if db is None:
+            return None
+        name = term.args[1]
+    else:
+        db = default_db
+        name = term.args[0]
+    name = literal_name(name)
+    if name is None:
+        return None
+    return (db, name)
+
+# Sorts a query by the use it can make of the cache. Returns whether its
+# result can be cached, whether it writes, and the set of tables it uses
+# (None if some of them aren't known).
+def classify(term, default_db):
+    cacheable = True
+    writes = False
+    tables = set()
+
+    stack = [term]
+    while stack:
+        node = stack.pop()
+        cls = type(node)
+        if cls not in cacheable_terms:
+            cacheable = False
+            if cls in write_terms:
+                writes = True
+            elif cls in schema_terms:
+                writes = True
+                tables = None
+        if cls is ast.Table and tables is not None:
+            table = table_name(node, default_db)
+            if table is None:
+                tables = None
+            else:
+                tables.add(table)
+        stack.extend(node.args)
+        stack.extend(node.optargs.itervalues())
+
+    return cacheable and tables is not None, writes, tables
+
+# Whether a table read by a cached query is one of the `tables` written to.
+# A table in the default database (db None) matches the same table in any
+# database, as the default can change between queries.
+def touches(read_tables, tables):
+    for db, name in read_tables:
+        for write_db, write_name in tables:
+            if name == write_name and (db == write_db or db is None or write_db is None):
+                return True
+    return False
+
+# A least recently used cache of responses, each kept for at most `ttl`
+# seconds (forever if None). Safe to share between threads.
+class QueryCache(object):
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (expiry time, tables read, response)
+        self.lock = threading.Lock()
+
+        # Counts the invalidations, so that a result read while a write was
+        # in flight isn't stored
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    # Returns the cached response for `key`, or None
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] is not None and entry[0] <= time.time():
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            # Move the entry to the most recently used end
+            self.entries[key] = entry
+            self.hits += 1
+        return entry[2]
+
+    # Stores a response, unless the cache was invalidated since `generation`
+    def put(self, key, tables, response, generation):
+        expiry = None if self.ttl is None else time.time() + self.ttl
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (expiry, tables, response)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    # Drops the results read from any of `tables`, or every result if None
+    def invalidate(self, tables):
+        with self.lock:
+            self.generation += 1
+            if tables is None:
+                self.invalidations += len(self.entries)
+                self.entries.clear()
+                return
+            for key, entry in self.entries.items():
+                if touches(entry[1], tables):
+                    del self.entries[key]
+                    self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'expirations': self.expirations,
+                    'invalidations': self.invalidations}
@@ -0,0 +1,135 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# Merges point reads made at about the same time by different threads into
+# one query (see MultiplexedConnection.enable_coalescing). The first `get` on
+# a table opens a batch and, if other gets are in flight, waits up to
+# `window` seconds for more keys to join it, or until it holds `max_keys` of
+# them; then it runs a single `get_all` for the whole batch and hands each
+# thread the row for its key, found by the table's primary key, or None if
+# there is none. A get with no others in flight runs at once.
+
+__all__ = ['GetCoalescer']
+
+import copy
+import threading
+
+from rethinkdb.errors import *
+from rethinkdb import ast
+from rethinkdb.cache import table_name
+from rethinkdb.wire import encode_term
+
+# Run options that change the rows a batch reads or how they are returned
+# to each caller. Gets run with any of them aren't coalesced.
+uncoalesced_opts = frozenset(['noreply', 'profile', 'format'])
+
+class GetBatch(object):
+    def __init__(self):
+        self.keys = [ ]
+        self.requests = { }  # Key -> number of gets asking for it
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.rows = None     # Primary key -> row, once the batch has run
+        self.error = None
+
+    # Returns the row for `key`. When several threads asked for the same key,
+    # each gets its own copy and the row itself is never handed out, so that
+    # they can't change each other's rows.
+    def take(self, key):
+        row = self.rows.get(key)
+        if self.requests[key] > 1:
+            return copy.deepcopy(row)
+        return row
+
+class GetCoalescer(object):
+    # `run(term, global_opt_args)` runs a query without coalescing it
+    def __init__(self, run, window, max_keys):
+        self.run = run
+        self.window = window
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.batches = { }      # Batch key -> the batch still open for it
+        self.primary_keys = { } # (db, table) -> name of the primary key
+
+        self.queries = 0
+        self.gets = 0
+        self.in_flight = 0      # Gets that have started and not returned
+
+    # Returns the batch key of a query that can be coalesced, or None. Only
+    # `get`s with a literal key on a table named by literal names qualify.
+    def batch_key(self, term, global_opt_args, default_db):
+        if type(term) is not ast.Get or type(term.args[0]) is not ast.Table:
+            return None
+        key = term.args[1]
+        # True and 1 are the same key to Python but not to the server
+        if type(key) is not ast.Datum or not isinstance(key.data, (basestring, int, long, float)) or \
+           isinstance(key.data, bool) or table_name(term.args[0], None) is None:
+            return None
+        for k, v in global_opt_args.iteritems():
+            if k in uncoalesced_opts or not isinstance(v, (basestring, bool, int, long, float)):
+                return None
+        return (encode_term(term.args[0]), default_db, tuple(sorted(global_opt_args.items())))
+
+    def get(self, term, global_opt_args, batch_key):
+        key = term.args[1].data
+        with self.lock:
+            self.gets += 1
+            self.in_flight += 1
+            batch = self.batches.get(batch_key)
+            leader = batch is None
+            if leader:
+                batch = self.batches[batch_key] = GetBatch()
+                # Nothing is likely to join the batch of a get on its own
+                alone = self.in_flight == 1
+            if key not in batch.requests:
+                batch.keys.append(key)
+                batch.requests[key] = 0
+            batch.requests[key] += 1
+            if len(batch.keys) >= self.max_keys:
+                # Nobody else can join a full batch
+                del self.batches[batch_key]
+                batch.full.set()
+
+        try:
+            if leader:
+                if not alone:
+                    batch.full.wait(self.window)
+                with self.lock:
+                    if self.batches.get(batch_key) is batch:
+                        del self.batches[batch_key]
+                self._run_batch(batch, term.args[0], global_opt_args, batch_key[1])
+            else:
+                batch.done.wait()
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+        if batch.error is not None:
+            # Run the get on its own, so that it fails with its own error
+            return self.run(term, dict(global_opt_args))
+        return batch.take(key)
+
+    def _run_batch(self, batch, table, global_opt_args, default_db):
+        try:
+            primary_key = self._primary_key(table, global_opt_args, default_db)
+            rows = self.run(table.get_all(*batch.keys), dict(global_opt_args))
+            batch.rows = dict((row[primary_key], row) for row in rows)
+            with self.lock:
+                self.queries += 1
+        except Exception as err:
+            batch.error = err
+        finally:
+            batch.done.set()
+
+    # The primary key of a table, which is looked up once per table
+    def _primary_key(self, table, global_opt_args, default_db):
+        db = global_opt_args.get('db', default_db)
+        name = table_name(table, db)
+        primary_key = self.primary_keys.get(name)
+        if primary_key is None:
+            info = self.run(table.info(), dict(global_opt_args))
+            primary_key = self.primary_keys[name] = info['primary_key']
+        return primary_key
+
+    def stats(self):
+        with self.lock:
+            return {'gets': self.gets, 'queries': self.queries}
@@ -0,0 +1,184 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# Collects fields of the rows of a cursor into columns (see Cursor.to_columns).
+# A field holding only numbers, and missing or null values, becomes an
+# array.array of doubles, with NaN where the value is missing. Any other field
+# becomes a list of the converted values, with None where the value is
+# missing. Each column comes with a mask that is 1 where the value is missing.
+# Numbers sent as native datums are copied straight into their columns,
+# without building the rows they belong to, which is where the speedup over
+# reading the rows comes from. Rows sent as R_JSON, as the server normally
+# does, still have to be parsed whole, so for those the columns save memory
+# but take about as long as the rows. They are parsed without the pseudo-type
+# hook, and only the values of the fields are checked for pseudo-types.
+
+__all__ = ['Column', 'ColumnBuilder']
+
+import array
+
+from rethinkdb import ql2_pb2 as p
+
+from rethinkdb.errors import *
+from rethinkdb.ast import Datum, default_json_decoder
+
+nan = float('nan')
+number_types = frozenset([int, long, float])
+
+class Column(object):
+    __slots__ = ['values', 'mask']
+
+    def __init__(self, values, mask):
+        self.values = values
+        self.mask = mask
+
+    def __len__(self):
+        return len(self.mask)
+
+    # The values as a list, with None for the missing ones
+    def to_list(self):
+        return [None if missing else value for value, missing in zip(self.values, self.mask)]
+
+    def __repr__(self):
+        return "Column(%r)" % (self.to_list(),)
+
+class ColumnBuilder(object):
+    def __init__(self, fields, format_opts):
+        for field in fields:
+            if not isinstance(field, basestring):
+                raise RqlDriverError("Column names must be strings, got %r." % (field,))
+        self.fields = list(fields)
+        self.format_opts = format_opts
+        self.numbers = dict((field, array.array('d')) for field in self.fields)
+        self.objects = { }  # Field -> values, for the fields that aren't all numbers
+        self.masks = dict((field, array.array('b')) for field in self.fields)
+
+    # Adds the rows of a response. `rows` are its converted rows if it was
+    # decoded by the C++ extension, and None if it holds datums.
+    def add_response(self, response, rows):
+        if rows is None:
+            datums = response.response
+            if all(datum.type == p.Datum.R_JSON for datum in datums):
+                self.add_json([datum.r_str for datum in datums])
+                return
+            if any(datum.type == p.Datum.R_JSON for datum in datums):
+                rows = Datum.deconstruct_many(datums, self.format_opts)
+            else:
+                for datum in datums:
+                    self._add_datum(datum)
+                return
+        self._add_rows(rows)
+
+    # Adds rows given as JSON texts
+    def add_json(self, texts):
+        if not texts:
+            return
+        text = '[' + ','.join(texts) + ']'
+        rows = self.format_opts.get('json_decoder', default_json_decoder).loads(text)
+        if '$reql_type$' not in text:
+            self._add_rows(rows)
+            return
+
+        convert = Datum._recursively_convert_pseudotypes
+        rows = [convert(row, self.format_opts) if isinstance(row, dict) and '$reql_type$' in row else row
+                for row in rows]
+        rows = [row if isinstance(row, dict) else { } for row in rows]
+        for field in self.fields:
+            values = [row.get(field) for row in rows]
+            if any(isinstance(value, (dict, list)) for value in values):
+                values = [convert(value, self.format_opts) for value in values]
+            self._add_values(field, values)
+
+    def _add_rows(self, rows):
+        rows = [row if isinstance(row, dict) else { } for row in rows]
+        for field in self.fields:
+            self._add_values(field, [row.get(field) for row in rows])
+
+    # Adds a batch of values of a field
+    def _add_values(self, field, values):
+        objects = self.objects.get(field)
+        if objects is None and all(type(value) in number_types for value in values if value is not None):
+            self.numbers[field].extend([nan if value is None else value for value in values])
+        else:
+            if objects is None:
+                self.objects[field] = objects = self._to_objects(field)
+            objects.extend(values)
+        self.masks[field].extend([value is None for value in values])
+
+    def _add_datum(self, datum):
+        found = { }
+        if datum.type == p.Datum.R_OBJECT:
+            for pair in datum.r_object:
+                if pair.key in self.masks:
+                    found[pair.key] = pair.val
+        for field in self.fields:
+            value = found.get(field)
+            if value is None or value.type == p.Datum.R_NULL:
+                self._add_value(field, None)
+            elif value.type == p.Datum.R_NUM and field not in self.objects:
+                self.numbers[field].append(value.r_num)
+                self.masks[field].append(0)
+            else:
+                self._add_value(field, Datum.deconstruct(value, self.format_opts))
+
+    def _add_value(self, field, value):
+        mask = self.masks[field]
+        objects = self.objects.get(field)
+        if objects is not None:
+            objects.append(value)
+        elif value is None:
+            self.numbers[field].append(nan)
+        elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            self.numbers[field].append(value)
+        else:
+            # Not a number column after all
+            self.objects[field] = objects = self._to_objects(field)
+            objects.append(value)
+        mask.append(1 if value is None else 0)
+
+    # The values of a number column so far, converted as Datum.deconstruct
+    # would have
+    def _to_objects(self, field):
+        objects = [ ]
+        for value, missing in zip(self.numbers.pop(field), self.masks[field]):
+            if missing:
+                objects.append(None)
+            elif value % 1 == 0:
+                objects.append(int(value))
+            else:
+                objects.append(value)
+        return objects
+
+    # Returns the columns by field. With `numpy`, the values and masks are
+    # NumPy arrays: float64 or object values, and boolean masks.
+    def columns(self, numpy=None):
+        if numpy:
+            return dict((field, self._numpy_column(numpy, field)) for field in self.fields)
+        return dict((field, Column(self.numbers[field] if field in self.numbers else self.objects[field],
+                                   self.masks[field])) for field in self.fields)
+
+    def _numpy_column(self, numpy, field):
+        mask = self.masks[field]
+        if len(mask) == 0:
+            return Column(numpy.zeros(0, dtype=numpy.float64), numpy.zeros(0, dtype=numpy.bool_))
+        if field in self.objects:
+            values = numpy.empty(len(mask), dtype=object)
+            # One at a time, so that list values aren't taken as dimensions
+            for i, value in enumerate(self.objects[field]):
+                values[i] = value
+        else:
+            # The array shares the memory of the array.array
+            values = numpy.frombuffer(self.numbers[field], dtype=numpy.float64)
+        return Column(values, numpy.frombuffer(mask, dtype=numpy.int8).astype(numpy.bool_))
+
+# Returns the numpy module for Cursor.to_columns: None when `use_numpy` is
+# False, and when it is None and NumPy isn't installed
+def numpy_module(use_numpy):
+    if use_numpy is False:
+        return None
+    try:
+        import numpy
+    except ImportError:
+        if use_numpy:
+            raise RqlDriverError("The numpy package is not installed.")
+        return None
+    return numpy
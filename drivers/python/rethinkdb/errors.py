@@ -29,6 +29,15 @@ class RqlDriverError(Exception):
     def __str__(self):
         return self.message
 
+class RqlCursorEmpty(RqlDriverError):
+    def __init__(self):
+        RqlDriverError.__init__(self, "Cursor is empty.")
+
+class RqlTimeoutError(RqlDriverError):
+    def __init__(self, timeout):
+        RqlDriverError.__init__(self, "Query timed out after %s seconds." % timeout)
+        self.timeout = timeout
+
 class QueryPrinter(object):
     def __init__(self, root, frames=[]):
         self.root = root
@@ -0,0 +1,130 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# Connections to a cluster through several of its nodes (see the `hosts`
+# argument of r.connect). Each new connection goes to the node picked by the
+# balancing policy: 'round_robin' takes the nodes in turn, and
+# 'least_outstanding' takes the node with the fewest queries in flight on the
+# connections already open to it. When a node can't be reached the next one
+# is tried, after a random backoff that grows with each failure, and the
+# node is tried last for a while.
+
+__all__ = ['HostList']
+
+import random
+import socket
+import threading
+import time
+import weakref
+
+from rethinkdb.errors import *
+
+balance_policies = ('round_robin', 'least_outstanding')
+
+# The backoff before trying the next node is random, up to this many seconds
+# doubled with each failed attempt, and at most `max_failover_backoff`
+failover_backoff = 0.05
+max_failover_backoff = 2.0
+
+# For how many seconds a node that couldn't be reached is tried last
+failed_host_penalty = 5.0
+
+# Returns (host, port) for an entry of a host list: a host name, a
+# 'host:port' string or a (host, port) pair
+def parse_address(address, default_port):
+    if isinstance(address, (tuple, list)):
+        host, port = address
+    elif address.startswith('[') and ']' in address:
+        # An IPv6 address, with or without a port
+        host, rest = address[1:].split(']', 1)
+        port = rest[1:] if rest.startswith(':') else default_port
+    elif address.count(':') == 1:
+        host, port = address.split(':')
+    else:
+        host, port = address, default_port
+    try:
+        return (host, int(port))
+    except ValueError:
+        raise RqlDriverError("Could not convert port %s to an integer." % port)
+
+class HostList(object):
+    def __init__(self, addresses, balance):
+        if not addresses:
+            raise RqlDriverError("The list of hosts is empty.")
+        if balance not in balance_policies:
+            raise RqlDriverError("Unknown balance policy \"%s\"." % balance)
+        self.addresses = addresses
+        self.balance = balance
+        self.lock = threading.Lock()
+        self.next_index = 0
+        self.failures = { } # Address -> when it last couldn't be reached
+        # Address -> the open connections to it
+        self.connections = dict((address, weakref.WeakSet()) for address in addresses)
+
+    # The addresses in the order to try them for a new connection. The nodes
+    # that couldn't be reached lately come last, and are left out of the
+    # rotation so that the others still get their share.
+    def candidates(self):
+        with self.lock:
+            recent = time.time() - failed_host_penalty
+            healthy = [address for address in self.addresses if self.failures.get(address, 0) <= recent]
+            failed = [address for address in self.addresses if self.failures.get(address, 0) > recent]
+            if healthy:
+                start = self.next_index % len(healthy)
+                healthy = healthy[start:] + healthy[:start]
+            self.next_index += 1
+            if self.balance == 'least_outstanding':
+                # Sorting is stable, so ties are still taken in turn
+                healthy.sort(key=self._load)
+        return healthy + failed
+
+    # Returns the number of queries in flight on the connections to a node
+    def outstanding(self, address):
+        with self.lock:
+            return self._load(address)
+
+    # Must be called with the lock held
+    def _load(self, address):
+        return sum(conn.outstanding_queries() for conn in self.connections[address])
+
+    # Opens a socket to the first node that accepts it. Returns its address
+    # and the socket.
+    def open_socket(self, timeout):
+        errors = [ ]
+        for attempt, address in enumerate(self.candidates()):
+            if attempt > 0:
+                time.sleep(random.uniform(0, min(max_failover_backoff, failover_backoff * 2 ** (attempt - 1))))
+            try:
+                sock = socket.create_connection(address, timeout)
+            except Exception as err:
+                errors.append("%s:%s (%s)" % (address[0], address[1], err))
+                with self.lock:
+                    self.failures[address] = time.time()
+                continue
+            with self.lock:
+                self.failures.pop(address, None)
+            return address, sock
+        raise RqlDriverError("Could not connect to any host. Errors: %s" % ", ".join(errors))
+
+    def add(self, address, conn):
+        with self.lock:
+            self.connections[address].add(conn)
+
+    def remove(self, address, conn):
+        with self.lock:
+            connections = self.connections.get(address)
+            if connections is not None:
+                connections.discard(conn)
+
+# Host lists by their addresses and policy, so that all the connections made
+# with the same hosts are spread across them together
+host_lists = { }
+host_lists_lock = threading.Lock()
+
+def host_list_for(hosts, default_port, balance):
+    addresses = [parse_address(address, default_port) for address in hosts]
+    key = (tuple(addresses), balance)
+    with host_lists_lock:
+        host_list = host_lists.get(key)
+        if host_list is None:
+            host_list = host_lists[key] = HostList(addresses, balance)
+    return host_list
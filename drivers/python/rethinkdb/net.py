@@ -1,10 +1,15 @@
 # Copyright 2010-2012 RethinkDB, all rights reserved.
 
-__all__ = ['connect', 'Connection', 'Cursor', 'protobuf_implementation']
+__all__ = ['connect', 'connect_async', 'Connection', 'MultiplexedConnection', 'Cursor', 'protobuf_implementation']
 
+import copy
 import errno
+import json as py_json
 import socket
 import struct
+import threading
+import time
+from Queue import Queue, Empty
 from os import environ
 
 try:
@@ -13,11 +18,220 @@ try:
 except ImportError:
     protobuf_implementation = 'python'
 
+# The C++ extension can also decode responses straight into Python objects
+try:
+    from rethinkdb._pbcpp import decode_response
+except ImportError:
+    decode_response = None
+
 from rethinkdb import ql2_pb2 as p
 
 from rethinkdb import repl # For the repl connection
 from rethinkdb.errors import *
-from rethinkdb.ast import Datum, DB, expr
+from rethinkdb.ast import Datum, DB, JsonDecoder, default_json_decoder, expr
+from rethinkdb.wire import encode_start_query
+from rethinkdb.cache import QueryCache, classify, literal_name
+from rethinkdb.coalesce import GetCoalescer
+from rethinkdb.stats import QueryStats
+from rethinkdb.hosts import host_list_for
+from rethinkdb.columns import ColumnBuilder, numpy_module
+
+# Responses are parsed straight out of the connection's read buffer through a
+# memoryview. Older versions of the C++ protobuf backend only accept strings,
+# in which case each frame has to be copied out first.
+try:
+    p.Response().ParseFromString(memoryview(bytearray()))
+    parse_from_view = True
+except TypeError:
+    parse_from_view = False
+
+# Builds the START query for `term`. Note that this adds the connection's
+# default database to `global_opt_args` if the query doesn't specify one.
+def start_query(token, term, default_db, global_opt_args):
+    # Construct query
+    query = p.Query()
+    query.type = p.Query.START
+    query.token = token
+
+    # Set global opt args
+    set_default_db(default_db, global_opt_args)
+
+    for k,v in global_opt_args.items():
+        pair = query.global_optargs.add()
+        pair.key = k
+        expr(v).build(pair.val)
+
+    # Compile query to protobuf
+    term.build(query.query)
+    return query
+
+# The 'db' option will default to this connection's default
+# if not otherwise specified.
+def set_default_db(default_db, global_opt_args):
+    if 'db' in global_opt_args:
+        global_opt_args['db'] = DB(global_opt_args['db'])
+    else:
+        if default_db:
+           global_opt_args['db'] = DB(default_db)
+
+# The name of the database a query runs in by default, once set_default_db
+# has filled in its global optargs
+def default_db_name(global_opt_args):
+    db = global_opt_args.get('db')
+    return None if db is None else literal_name(db.args[0])
+
+# Like start_query, but encodes the query straight to its wire format (see
+# wire.py). Returns the query, with only its type and token set, and the
+# serialized query.
+def serialize_start_query(token, term, default_db, global_opt_args, accepts_r_json):
+    query = p.Query()
+    query.type = p.Query.START
+    query.token = token
+
+    set_default_db(default_db, global_opt_args)
+    return query, encode_start_query(token, term, global_opt_args, accepts_r_json)
+
+# How many batches a cursor keeps either requested or buffered, unless the
+# `prefetch` run option says otherwise
+default_prefetch = 1
+
+# The number of CONTINUEs a cursor should send to keep `prefetch` batches it
+# hasn't started reading, buffered or in flight. Shared by Cursor and
+# asyncio_net.AsyncCursor.
+def continue_count(prefetch, outstanding_requests, unread_batches):
+    return prefetch - outstanding_requests - unread_batches
+
+# Run options that only affect the driver. These are taken out of the global
+# optargs before the query is sent to the server. Note that a `timeout` only
+# stops the driver waiting: the server runs a connection's queries one at a
+# time, so a query that timed out keeps running there, and the queries sent
+# after it on the same connection wait until it is done.
+def driver_opts_from(global_opt_args):
+    driver_opts = {}
+    if 'prefetch' in global_opt_args:
+        prefetch = global_opt_args.pop('prefetch')
+        if not isinstance(prefetch, (int, long)) or isinstance(prefetch, bool) or prefetch < 1:
+            raise RqlDriverError("The prefetch run option must be a positive integer, got %r." % (prefetch,))
+        driver_opts['prefetch'] = prefetch
+    if 'format' in global_opt_args:
+        result_format = global_opt_args.pop('format')
+        if result_format not in ('native', 'raw_json'):
+            raise RqlDriverError("Unknown format run option \"%s\"." % result_format)
+        driver_opts['format'] = result_format
+    if 'timeout' in global_opt_args:
+        timeout = global_opt_args.pop('timeout')
+        if not isinstance(timeout, (int, long, float)) or isinstance(timeout, bool) or timeout <= 0:
+            raise RqlDriverError("The timeout run option must be a positive number, got %r." % (timeout,))
+        driver_opts['timeout'] = timeout
+    return driver_opts
+
+# The run options that control how results are converted to Python values,
+# along with the connection's JSON decoder if it has one
+def format_opts_from(opts, json_decoder=None):
+    format_opts = {}
+    if json_decoder is not None:
+        format_opts['json_decoder'] = json_decoder
+    if 'time_format' in opts:
+        format_opts['time_format'] = opts['time_format']
+    if 'group_format' in opts:
+        format_opts['group_format'] = opts['group_format']
+    if 'format' in opts:
+        format_opts['format'] = opts['format']
+    return format_opts
+
+# Returns the JSON text of a datum. The server sends every datum as R_JSON
+# when the driver accepts it, so this is normally the text as received.
+def datum_to_json(datum):
+    if datum.type == p.Datum.R_JSON:
+        return datum.r_str
+    return py_json.dumps(Datum.deconstruct(datum, raw_format_opts))
+
+raw_format_opts = {'time_format': 'raw', 'group_format': 'raw'}
+
+# Converts a datum to a Python value, or to its JSON text with the
+# `format='raw_json'` run option
+def convert_datum(datum, format_opts):
+    if format_opts.get('format') == 'raw_json':
+        return datum_to_json(datum)
+    return Datum.deconstruct(datum, format_opts)
+
+# A response parsed by the C++ extension. With `json_texts`, its `response`
+# list holds the UTF-8 JSON text of each R_JSON datum, as the server sends
+# them. Otherwise it holds Python values rather than datums, with any
+# pseudo-types left as they were sent, and `pseudotypes` says whether there
+# are any to convert.
+class DecodedResponse(object):
+    __slots__ = ['token', 'type', 'response', 'profile', 'pseudotypes', 'json_texts']
+
+    def __init__(self, token, type, response, profile, pseudotypes, json_texts):
+        self.token = token
+        self.type = type
+        self.response = response
+        self.profile = profile
+        self.pseudotypes = pseudotypes
+        self.json_texts = json_texts
+
+# A copy of a response for the query cache, which the values converted from
+# it can't change. Datums are converted afresh each time, but a response
+# decoded by the C++ extension already holds the Python values, and their
+# pseudo-types are converted in place.
+def response_copy(response):
+    if isinstance(response, DecodedResponse):
+        return DecodedResponse(response.token, response.type, copy.deepcopy(response.response),
+                               response.profile, response.pseudotypes, response.json_texts)
+    return response
+
+# Returns the rows of a response as JSON text
+def response_json_rows(response):
+    if isinstance(response, DecodedResponse):
+        if response.json_texts:
+            return [text.decode('utf-8') for text in response.response]
+        return [py_json.dumps(value) for value in response.response]
+    return [datum_to_json(datum) for datum in response.response]
+
+# Returns the rows of a response converted according to the format options
+def response_rows(response, format_opts):
+    if format_opts.get('format') == 'raw_json':
+        return response_json_rows(response)
+    if isinstance(response, DecodedResponse):
+        if response.json_texts:
+            return decode_json_rows(response.response, format_opts)
+        if response.pseudotypes:
+            convert = Datum._recursively_convert_pseudotypes
+            return [convert(value, format_opts) for value in response.response]
+        return response.response
+    return Datum.deconstruct_many(response.response, format_opts)
+
+# Decodes the JSON texts of a batch of rows together, as one JSON array, like
+# Datum.deconstruct_many does for R_JSON datums
+def decode_json_rows(texts, format_opts):
+    decoder = format_opts.get('json_decoder', default_json_decoder)
+    if len(texts) == 1:
+        return [decoder.decode(texts[0], format_opts)]
+    return decoder.decode(b'[' + b','.join(texts) + b']', format_opts)
+
+def check_error_response(response, term):
+    if response.type == p.Response.RUNTIME_ERROR:
+        message = Datum.deconstruct(response.response[0])
+        backtrace = response.backtrace
+        frames = backtrace.frames or []
+        raise RqlRuntimeError(message, term, frames)
+    elif response.type == p.Response.COMPILE_ERROR:
+        message = Datum.deconstruct(response.response[0])
+        backtrace = response.backtrace
+        frames = backtrace.frames or []
+        raise RqlCompileError(message, term, frames)
+    elif response.type == p.Response.CLIENT_ERROR:
+        message = Datum.deconstruct(response.response[0])
+        backtrace = response.backtrace
+        frames = backtrace.frames or []
+        raise RqlClientError(message, term, frames)
+
+# The read buffer starts at this size and doubles whenever a response won't
+# fit. Once it is empty it goes back to its initial size if it grew past the
+# idle limit.
+initial_read_buffer_size = 64 * 1024
+max_idle_read_buffer_size = 4 * 1024 * 1024
 
 class Cursor(object):
     def __init__(self, conn, query, term, format_opts, opts):
@@ -29,48 +243,180 @@ class Cursor(object):
         self.responses = [ ]
         self.outstanding_requests = 0
         self.end_flag = False
+        self.last_received = False
+        self.stats = None # The QueryStats of the query when it is tracked
+
+        # How many batches to have requested or waiting in `responses` on top
+        # of the one being read. This also bounds how many batches the cursor
+        # will hold in memory. More than one CONTINUE in flight can reach the
+        # server after the stream has finished; the connection drops the
+        # errors it answers those with.
+        self.prefetch = opts.get('prefetch', default_prefetch)
 
     def _extend(self, response):
-        self.end_flag = response.type != p.Response.SUCCESS_PARTIAL
+        # Once the cursor has ended (or been closed) it stays ended, even if a
+        # partial response to an earlier CONTINUE arrives afterwards
+        if response.type != p.Response.SUCCESS_PARTIAL:
+            self.end_flag = True
+            self.last_received = True
         self.responses.append(response)
 
-        if len(self.responses) == 1 and not self.end_flag:
+        if not self.end_flag:
             self.conn._async_continue_cursor(self)
 
-    def __iter__(self):
-        format_opts = self.format_opts
-        deconstruct = Datum.deconstruct
-        while True:
-            if len(self.responses) == 0 and not self.end_flag:
-                self.conn._continue_cursor(self)
-            if len(self.responses) == 1 and not self.end_flag:
-                self.conn._async_continue_cursor(self)
+    # Yields the responses of this cursor in order. Each response stays at
+    # the front of `responses` until the caller is done with it.
+    def _responses(self):
+        try:
+            while True:
+                if len(self.responses) == 0 and not self.end_flag:
+                    self.conn._continue_cursor(self)
+                if not self.end_flag:
+                    self.conn._async_continue_cursor(self)
 
-            if len(self.responses) == 0 and self.end_flag:
-                break
+                if len(self.responses) == 0 and self.end_flag:
+                    break
+
+                self.conn._check_error_response(self.responses[0], self.term)
+                if self.responses[0].type != p.Response.SUCCESS_PARTIAL and self.responses[0].type != p.Response.SUCCESS_SEQUENCE:
+                    raise RqlDriverError("Unexpected response type received for cursor")
 
-            self.conn._check_error_response(self.responses[0], self.term)
-            if self.responses[0].type != p.Response.SUCCESS_PARTIAL and self.responses[0].type != p.Response.SUCCESS_SEQUENCE:
-                raise RqlDriverError("Unexpected response type received for cursor")
+                yield self.responses[0]
+                del self.responses[0]
+        except Exception as err:
+            self._finish_stats(err)
+            raise
+        finally:
+            self._finish_stats()
+
+    # Reports the query to the connection's listeners once the cursor is done
+    def _finish_stats(self, error=None):
+        if self.stats is not None:
+            self.stats = None
+            self.conn._finish_query(self.query.token, error)
+
+    def _rows(self, response):
+        if self.stats is None:
+            return response_rows(response, self.format_opts)
+        start = time.time()
+        rows = response_rows(response, self.format_opts)
+        self.stats.convert_time += time.time() - start
+        return rows
 
-            for datum in self.responses[0].response:
-                yield deconstruct(datum, format_opts)
-            del self.responses[0]
+    def __iter__(self):
+        for response in self._responses():
+            for row in self._rows(response):
+                yield row
+
+    # Yields the rows of each batch sent by the server as a list, or as the
+    # text of a JSON array with the `format='raw_json'` run option
+    def batches(self):
+        raw_json = self.format_opts.get('format') == 'raw_json'
+        for response in self._responses():
+            rows = self._rows(response)
+            if raw_json:
+                yield u'[' + u','.join(rows) + u']'
+            else:
+                yield rows
+
+    # Writes all the remaining rows to the file-like object `fileobj` as one
+    # UTF-8 encoded JSON array, a batch at a time. The JSON text sent by the
+    # server is copied out as is, whatever the `format` run option.
+    def write_json(self, fileobj):
+        fileobj.write(b'[')
+        separator = u''
+        for response in self._responses():
+            if len(response.response) > 0:
+                rows = u','.join(response_json_rows(response))
+                fileobj.write((separator + rows).encode('utf-8'))
+                separator = u','
+        fileobj.write(b']')
+
+    # Returns the rows of the batches received so far without waiting for
+    # more, and asks for the next ones. Meant for event loops that call the
+    # connection's `poll` when its `fileno` is readable; `done` says when
+    # the last batch has been returned.
+    def ready_rows(self):
+        rows = [ ]
+        try:
+            while self.responses:
+                response = self.responses[0]
+                self.conn._check_error_response(response, self.term)
+                if response.type != p.Response.SUCCESS_PARTIAL and response.type != p.Response.SUCCESS_SEQUENCE:
+                    raise RqlDriverError("Unexpected response type received for cursor")
+                rows.extend(self._rows(response))
+                del self.responses[0]
+            if not self.end_flag:
+                self.conn._async_continue_cursor(self)
+        except Exception as err:
+            self._finish_stats(err)
+            raise
+        if self.end_flag:
+            self._finish_stats()
+        return rows
+
+    # Whether all the rows of this cursor have been returned
+    def done(self):
+        return self.end_flag and len(self.responses) == 0
+
+    # Reads all the remaining rows and returns the given top-level fields of
+    # them as columns, by field name (see columns.py). The columns hold NumPy
+    # arrays if NumPy is installed, unless `numpy` is False.
+    def to_columns(self, fields, numpy=None):
+        numpy = numpy_module(numpy)
+        format_opts = dict(self.format_opts)
+        format_opts.pop('format', None)
+        builder = ColumnBuilder(fields, format_opts)
+        for response in self._responses():
+            start = time.time() if self.stats is not None else None
+            if not isinstance(response, DecodedResponse):
+                builder.add_response(response, None)
+            elif response.json_texts:
+                builder.add_json(response.response)
+            else:
+                builder.add_response(response, response_rows(response, format_opts))
+            if start is not None:
+                self.stats.convert_time += time.time() - start
+        return builder.columns(numpy)
 
     def close(self):
         if not self.end_flag:
             self.end_flag = True
             self.conn._end_cursor(self)
+        self._finish_stats()
 
 class Connection(object):
-    def __init__(self, host, port, db, auth_key, timeout):
+    def __init__(self, host, port, db, auth_key, timeout, json_decoder='json', host_list=None):
         self.socket = None
         self.host = host
+        self.host_list = host_list # The nodes to pick from, if there are several
         self.next_token = 1
         self.db = db
         self.auth_key = auth_key
         self.timeout = timeout
+        self.json_decoder = JsonDecoder(json_decoder)
         self.cursor_cache = { }
+        self.query_cache = None
+
+        # Objects told about each query once it is done (see stats.py), and
+        # token -> QueryStats of the queries being timed for them
+        self.listeners = [ ]
+        self.query_stats = { }
+
+        # Token -> number of responses still to come that nobody is waiting for
+        self.ignored_responses = { }
+
+        # Tokens of the queries that timed out, until all of their responses
+        # have arrived. The server may still be running them.
+        self.timed_out = set()
+
+        # The number of queries whose responses are being waited for
+        self.waiting = 0
+
+        # Bytes received but not yet parsed are kept in read_buf[read_start:read_end]
+        self.read_buf = bytearray(initial_read_buffer_size)
+        self.read_start = 0
+        self.read_end = 0
 
         # Try to convert the port to an integer
         try:
@@ -92,21 +438,29 @@ class Connection(object):
     def reconnect(self, noreply_wait=True):
         self.close(noreply_wait)
 
-        try:
-            self.socket = socket.create_connection((self.host, self.port), self.timeout)
-        except Exception as err:
-            raise RqlDriverError("Could not connect to %s:%s. Error: %s" % (self.host, self.port, err))
+        if self.host_list is None:
+            try:
+                self.socket = socket.create_connection((self.host, self.port), self.timeout)
+            except Exception as err:
+                raise RqlDriverError("Could not connect to %s:%s. Error: %s" % (self.host, self.port, err))
+        else:
+            (self.host, self.port), self.socket = self.host_list.open_socket(self.timeout)
+            self.host_list.add((self.host, self.port), self)
 
         self._sock_sendall(struct.pack("<L", p.VersionDummy.V0_2))
         self._sock_sendall(struct.pack("<L", len(self.auth_key)) + str.encode(self.auth_key, 'ascii'))
 
         # Read out the response from the server, which will be a null-terminated string
-        response = b""
+        self.read_start = self.read_end = 0
         while True:
-            char = self._sock_recv(1)
-            if char == b"\0":
+            end = self.read_buf.find(b"\0", self.read_start, self.read_end)
+            if end != -1:
+                response = bytes(self.read_buf[self.read_start:end])
+                self.read_start = end + 1
+                break
+            if self._recv_into_buffer() == 0:
+                response = bytes(self.read_buf[self.read_start:self.read_end])
                 break
-            response += char
 
         if response != b"SUCCESS":
             self.close(noreply_wait=False)
@@ -127,11 +481,15 @@ class Connection(object):
                 pass
             self.socket.close()
             self.socket = None
+            if self.host_list is not None:
+                self.host_list.remove((self.host, self.port), self)
         self.cursor_cache = { }
+        self.ignored_responses = { }
+        self.timed_out = set()
+        self.query_stats = { }
 
     def noreply_wait(self):
-        token = self.next_token
-        self.next_token += 1
+        token = self._new_token()
 
         # Construct query
         query = p.Query()
@@ -141,6 +499,61 @@ class Connection(object):
         # Send the request
         return self._send_query(query, 'noreply_wait')
 
+    # Caches the results of the deterministic reads run on this connection,
+    # keeping up to `max_entries` of them for at most `ttl` seconds each
+    # (forever if None). A write run on this connection drops the results
+    # read from the tables it writes to; writes made elsewhere are only seen
+    # once the results they changed expire. See cache.py.
+    def enable_cache(self, max_entries=1000, ttl=1.0):
+        if max_entries < 1 or (ttl is not None and ttl <= 0):
+            raise RqlDriverError("Invalid cache settings: max_entries=%s, ttl=%s." % (max_entries, ttl))
+        self.query_cache = QueryCache(max_entries, ttl)
+        return self
+
+    def disable_cache(self):
+        self.query_cache = None
+
+    # Returns the counters of the query cache: the number of entries, and of
+    # hits, misses, evictions (of the least recently used entries when the
+    # cache is full), expirations and invalidations by writes. None if the
+    # cache isn't enabled.
+    def cache_stats(self):
+        if self.query_cache is None:
+            return None
+        return self.query_cache.stats()
+
+    # Adds an object whose `query_finished(stats)` method is called with the
+    # timings of each query run on this connection from now on. See stats.py,
+    # which also has a listener that aggregates them.
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+        return listener
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    # Starts timing a query for the listeners. `start` is when the driver
+    # started building it; it has just been serialized.
+    def _track_query(self, token, term, start):
+        stats = QueryStats(token, type(term).__name__, start, time.time() - start)
+        self.query_stats[token] = stats
+        return stats
+
+    # Reports a query to the listeners, if it is being timed
+    def _finish_query(self, token, error=None):
+        stats = self.query_stats.pop(token, None)
+        if stats is None:
+            return
+        stats.error = error
+        stats.total_time = time.time() - stats.start_time
+        for listener in list(self.listeners):
+            listener.query_finished(stats)
+
+    # The number of queries still waiting for a response on this connection,
+    # counting each open cursor as one
+    def outstanding_queries(self):
+        return self.waiting + len(self.cursor_cache)
+
     # Not thread safe. Sets this connection as global state that will be used
     # by subsequence calls to `query.run`. Useful for trying out RethinkDB in
     # a Python repl environment.
@@ -148,13 +561,25 @@ class Connection(object):
         repl.default_connection = self
         return self
 
-    def _sock_recv(self, length):
-        while True:
-            try:
-                return self.socket.recv(length)
-            except IOError as e:
-                if e.errno != errno.EINTR:
+    # Raises socket.timeout if nothing arrives before the `deadline`
+    def _sock_recv_into(self, view, deadline=None):
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout("timed out")
+            self.socket.settimeout(remaining)
+        try:
+            while True:
+                try:
+                    return self.socket.recv_into(view)
+                except socket.timeout:
                     raise
+                except IOError as e:
+                    if e.errno != errno.EINTR:
+                        raise
+        finally:
+            if deadline is not None:
+                self.socket.settimeout(None)
 
     def _sock_sendall(self, data):
         while True:
@@ -164,53 +589,206 @@ class Connection(object):
                 if e.errno != errno.EINTR:
                     raise
 
-    def _start(self, term, **global_opt_args):
+    def _new_token(self):
         token = self.next_token
         self.next_token += 1
+        return token
+
+    def _start(self, term, **global_opt_args):
+        start = time.time() if self.listeners else None
+        driver_opts = driver_opts_from(global_opt_args)
+        opts = dict(global_opt_args, **driver_opts)
+        if self.query_cache is not None:
+            return self._start_cached(self.query_cache, term, global_opt_args, opts, start)
+        query, query_protobuf = serialize_start_query(self._new_token(), term, self.db,
+                                                      global_opt_args, True)
+        if start is not None:
+            self._track_query(query.token, term, start)
+        return self._send_query(query, term, opts, query_protobuf=query_protobuf)
+
+    # Runs a query with the query cache enabled. Reads are looked up by their
+    # serialized form, without the token, and by the result format. Writes
+    # invalidate the cache once they are done, whether they succeed or not.
+    def _start_cached(self, cache, term, global_opt_args, opts, start):
+        set_default_db(self.db, global_opt_args)
+        cacheable, writes, tables = classify(term, default_db_name(global_opt_args))
+        if cacheable and not opts.get('noreply') and not opts.get('profile'):
+            key = (encode_start_query(0, term, global_opt_args, True), opts.get('format'))
+            query = p.Query()
+            query.type = p.Query.START
+            query.token = self._new_token()
+
+            response = cache.get(key)
+            if response is not None:
+                if start is not None:
+                    self._track_query(query.token, term, start).cached = True
+                return self._process_response(response_copy(response), query, term, opts)
+
+            generation = cache.generation
+            query_protobuf = encode_start_query(query.token, term, global_opt_args, True)
+            if start is not None:
+                self._track_query(query.token, term, start)
+            self._send_batch([query.token], struct.pack("<L", len(query_protobuf)) + query_protobuf, True)
+            response = self._read_responses([query.token], opts.get('timeout'))[query.token]
+            if isinstance(response, RqlTimeoutError):
+                raise response
+            # Only complete results can be replayed
+            if response.type == p.Response.SUCCESS_ATOM or response.type == p.Response.SUCCESS_SEQUENCE:
+                cache.put(key, tables, response_copy(response), generation)
+            return self._process_response(response, query, term, opts)
+
+        query, query_protobuf = serialize_start_query(self._new_token(), term, self.db,
+                                                      global_opt_args, True)
+        if start is not None:
+            self._track_query(query.token, term, start)
+        try:
+            return self._send_query(query, term, opts, query_protobuf=query_protobuf)
+        finally:
+            if writes:
+                cache.invalidate(tables)
+
+    # Returns the tables that the queries may write to, for invalidating the
+    # query cache: an empty set when they only read, None when it isn't
+    # known which
+    def _written_tables(self, terms, global_opt_args):
+        global_opt_args = dict(global_opt_args)
+        set_default_db(self.db, global_opt_args)
+        default_db = default_db_name(global_opt_args)
+
+        written = set()
+        for term in terms:
+            cacheable, writes, tables = classify(term, default_db)
+            if writes and tables is None:
+                return None
+            elif writes:
+                written.update(tables)
+        return written
+
+    # Runs a PreparedQuery, whose serialized form only needs the parameter
+    # values and the token filled in
+    def _start_prepared(self, prepared, params, **global_opt_args):
+        start = time.time() if self.listeners else None
+        driver_opts = driver_opts_from(global_opt_args)
+        opts = dict(global_opt_args, **driver_opts)
 
-        # Construct query
         query = p.Query()
         query.type = p.Query.START
-        query.token = token
-
-        # Set global opt args
-
-        # The 'db' option will default to this connection's default
-        # if not otherwise specified.
-        if 'db' in global_opt_args:
-            global_opt_args['db'] = DB(global_opt_args['db'])
-        else:
-            if self.db:
-               global_opt_args['db'] = DB(self.db)
-
-        for k,v in global_opt_args.items():
-            pair = query.global_optargs.add()
-            pair.key = k
-            expr(v).build(pair.val)
-
-        # Compile query to protobuf
-        term.build(query.query)
-        return self._send_query(query, term, global_opt_args)
+        query.token = self._new_token()
+        query_protobuf = prepared._serialize(query.token, params, self.db, global_opt_args, True)
+        if start is not None:
+            self._track_query(query.token, prepared.term, start)
+        cache = self.query_cache
+        if cache is None:
+            return self._send_query(query, prepared.term, opts, query_protobuf=query_protobuf)
+
+        # Prepared queries aren't cached, but their writes still invalidate
+        written = self._written_tables([prepared.term], global_opt_args)
+        try:
+            return self._send_query(query, prepared.term, opts, query_protobuf=query_protobuf)
+        finally:
+            if written != set():
+                cache.invalidate(written)
+
+    # Sends all the queries in a single write, then waits for all of their
+    # responses. The server still runs a connection's queries one after the
+    # other, so this saves round trips rather than server time. Returns the
+    # result of each query in order: its value, a cursor, or the RqlError it
+    # failed with. The run options apply to every query, except for the
+    # timeout which applies to the batch as a whole: the queries that haven't
+    # answered by then get an RqlTimeoutError.
+    def run_many(self, queries, **global_opt_args):
+        driver_opts = driver_opts_from(global_opt_args)
+        opts = dict(global_opt_args, **driver_opts)
+
+        started = [ ]
+        frames = [ ]
+        cache = self.query_cache
+        written = set()
+        expect_response = not opts.get('noreply')
+        try:
+            for term in queries:
+                start = time.time() if self.listeners else None
+                query, query_protobuf = serialize_start_query(self._new_token(), term, self.db,
+                                                              dict(global_opt_args), True)
+                if start is not None:
+                    self._track_query(query.token, term, start)
+                started.append((query, term))
+                frames.append(struct.pack("<L", len(query_protobuf)) + query_protobuf)
+
+            if cache is not None:
+                written = self._written_tables([term for query, term in started], global_opt_args)
+
+            tokens = [query.token for query, term in started]
+            self._send_batch(tokens, b''.join(frames), expect_response)
+            if not expect_response:
+                for token in tokens:
+                    self._finish_query(token)
+                return [None] * len(started)
+            responses = self._read_responses(tokens, opts.get('timeout'))
+        except Exception as err:
+            # Report the queries that won't get an answer now. Those already
+            # reported, like the ones that timed out, are skipped.
+            for query, term in started:
+                self._finish_query(query.token, err)
+            raise
+        finally:
+            if written != set():
+                cache.invalidate(written)
+
+        results = [ ]
+        for query, term in started:
+            if isinstance(responses[query.token], RqlTimeoutError):
+                results.append(responses[query.token])
+                continue
+            try:
+                results.append(self._process_response(responses[query.token], query, term, opts))
+            except RqlError as err:
+                results.append(err)
+        return results
 
     def _handle_cursor_response(self, response):
         cursor = self.cursor_cache[response.token]
-        cursor._extend(response)
         cursor.outstanding_requests -= 1
+        cursor._extend(response)
 
-        if response.type != p.Response.SUCCESS_PARTIAL and cursor.outstanding_requests == 0:
+        if cursor.last_received:
             del self.cursor_cache[response.token]
+            # Responses to CONTINUEs sent past the end of the stream
+            if cursor.outstanding_requests > 0:
+                self.ignored_responses[response.token] = cursor.outstanding_requests
+
+    # Returns whether a response for `token` was expected to be ignored
+    def _skip_ignored_response(self, token):
+        remaining = self.ignored_responses.get(token)
+        if remaining is None:
+            return False
+        if remaining > 1:
+            self.ignored_responses[token] = remaining - 1
+        else:
+            del self.ignored_responses[token]
+            self.timed_out.discard(token)
+        return True
 
     def _continue_cursor(self, cursor):
+        # Error if this connection has closed
+        if not self.socket:
+            raise RqlDriverError("Connection is closed.")
         self._async_continue_cursor(cursor)
-        self._handle_cursor_response(self._read_response(cursor.query.token))
+        self._handle_cursor_response(self._read_response(cursor.query.token, cursor.opts.get('timeout')))
 
     def _async_continue_cursor(self, cursor):
-        self.cursor_cache[cursor.query.token].outstanding_requests += 1
+        # Keep the cursor's prefetch window full. The batch at the front of
+        # `responses` is the one being read.
+        count = continue_count(cursor.prefetch, cursor.outstanding_requests, max(len(cursor.responses) - 1, 0))
+        if count <= 0 or cursor.query.token not in self.cursor_cache:
+            return
+
+        cursor.outstanding_requests += count
 
         query = p.Query()
         query.type = p.Query.CONTINUE
         query.token = cursor.query.token
-        self._send_query(query, cursor.term, cursor.opts, async=True)
+        self._send_queries(query, count, cursor.opts)
 
     def _end_cursor(self, cursor):
         self.cursor_cache[cursor.query.token].outstanding_requests += 1
@@ -218,104 +796,345 @@ class Connection(object):
         query = p.Query()
         query.type = p.Query.STOP
         query.token = cursor.query.token
-        self._send_query(cursor.query, cursor.term, async=True)
-        self._handle_cursor_response(self._read_response(cursor.query.token))
-
-    def _read_response(self, token):
-        # We may get an async continue result, in which case we save it and read the next response
-        while True:
-            response_buf = b''
-            try:
-                response_header = b''
-                while len(response_header) < 4:
-                    chunk = self._sock_recv(4)
-                    if len(chunk) == 0:
-                        raise RqlDriverError("Connection is closed.")
-                    response_header += chunk
-
-                # The first 4 bytes give the expected length of this response
-                (response_len,) = struct.unpack("<L", response_header)
-
-                while len(response_buf) < response_len:
-                    chunk = self._sock_recv(response_len - len(response_buf))
-                    if len(chunk) == 0:
-                        raise RqlDriverError("Connection is broken.")
-                    response_buf += chunk
-            except KeyboardInterrupt as err:
-                # When interrupted while waiting for a response cancel the outstanding
-                # requests by resetting this connection
-                self.reconnect()
-                raise err
-
-            # Construct response
+        self._send_query(query, cursor.term, async=True)
+
+        # Read the responses to any CONTINUE still in flight as well as the STOP
+        while cursor.query.token in self.cursor_cache:
+            self._handle_cursor_response(self._read_response(cursor.query.token))
+
+    # Reads responses until the one for `token` arrives. With a `timeout`,
+    # the query is given up on if it doesn't arrive within that many seconds
+    # (see _cancel_query).
+    def _read_response(self, token, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        self.waiting += 1
+        try:
+            # We may get an async continue result, in which case we save it and read the next response
+            while True:
+                try:
+                    response = self._recv_response(deadline)
+                except KeyboardInterrupt as err:
+                    # When interrupted while waiting for a response cancel the outstanding
+                    # requests by resetting this connection
+                    self.reconnect()
+                    raise err
+                except socket.timeout:
+                    err = RqlTimeoutError(timeout)
+                    self._cancel_query(token, err)
+                    raise err
+
+                # Check that this is the response we were expecting
+                if response.token == token:
+                    return response
+                self._handle_other_response(response)
+        finally:
+            self.waiting -= 1
+
+    # Like _read_response, but for several queries at once. Returns their
+    # responses by token. The queries still waiting when the timeout runs
+    # out are given up on, and get an RqlTimeoutError in place of a response.
+    def _read_responses(self, tokens, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        waiting = set(tokens)
+        responses = { }
+        self.waiting += len(tokens)
+        try:
+            while waiting:
+                try:
+                    response = self._recv_response(deadline)
+                except KeyboardInterrupt as err:
+                    self.reconnect()
+                    raise err
+                except socket.timeout:
+                    for token in tokens:
+                        if token in waiting:
+                            responses[token] = RqlTimeoutError(timeout)
+                            self._cancel_query(token, responses[token])
+                    break
+
+                if response.token in waiting:
+                    waiting.remove(response.token)
+                    responses[response.token] = response
+                else:
+                    self._handle_other_response(response)
+        finally:
+            self.waiting -= len(tokens)
+        return responses
+
+    # Gives up on a query that timed out, without resetting the connection or
+    # disturbing its other queries: the server is sent a STOP for the token,
+    # and the responses still to come for it are dropped as they arrive. The
+    # server only reads the STOP once the query is done, so this doesn't
+    # interrupt it. That ends a cursor's stream, but a query that is still
+    # running holds up every query sent after it on this connection, which is
+    # why the pool closes a connection that has queries in `timed_out`.
+    def _cancel_query(self, token, error):
+        self.timed_out.add(token)
+        self._ignore_query(token)
+        query = p.Query()
+        query.type = p.Query.STOP
+        query.token = token
+        try:
+            self._send_query(query, None, async=True)
+        finally:
+            self._finish_query(token, error)
+
+    # Stops every cursor still open on this connection without waiting for
+    # them to end. Like _cancel_query, each gets a STOP, and the responses
+    # still to come for it are dropped as they arrive.
+    def _stop_cursors(self):
+        for token, cursor in list(self.cursor_cache.items()):
+            self._ignore_query(token)
+            cursor._finish_stats()
+            query = p.Query()
+            query.type = p.Query.STOP
+            query.token = token
+            self._send_query(query, None, async=True)
+
+    # Forgets a query, and its cursor if it has one, so that its remaining
+    # responses are ignored, along with the one to the STOP sent for it if
+    # it was `stopped`
+    def _ignore_query(self, token, stopped=True):
+        cursor = self.cursor_cache.pop(token, None)
+        pending = 1
+        if cursor is not None:
+            cursor.end_flag = True
+            pending = cursor.outstanding_requests
+        if stopped:
+            pending += 1
+        if pending > 0:
+            self.ignored_responses[token] = self.ignored_responses.get(token, 0) + pending
+
+    # Handles a response for a query that isn't being waited on
+    def _handle_other_response(self, response):
+        if response.token in self.cursor_cache:
+            self._handle_cursor_response(response)
+        elif not self._skip_ignored_response(response.token):
+            # This response is corrupted or not intended for us.
+            raise RqlDriverError("Unexpected response received.")
+
+    # Reads the next response off the socket, whichever query it belongs to.
+    # If the `deadline` passes first, the bytes of the response received so
+    # far stay in the read buffer for the next call.
+    def _recv_response(self, deadline=None):
+        while self.read_end - self.read_start < 4:
+            if self._recv_into_buffer(0, deadline) == 0:
+                if self.read_end == self.read_start:
+                    raise RqlDriverError("Connection is closed.")
+                raise RqlDriverError("Connection is broken.")
+
+        # When the response started to arrive, for timing it
+        header_time = time.time() if self.query_stats else None
+
+        # The first 4 bytes give the expected length of this response
+        (response_len,) = struct.unpack_from("<L", self.read_buf, self.read_start)
+
+        while self.read_end - self.read_start < 4 + response_len:
+            if self._recv_into_buffer(4 + response_len, deadline) == 0:
+                raise RqlDriverError("Connection is broken.")
+
+        return self._parse_response(response_len, header_time)
+
+    # Parses the response whose frame, `response_len` bytes long after its
+    # header, is at the start of the read buffer
+    def _parse_response(self, response_len, header_time):
+        frame_end = self.read_start + 4 + response_len
+        frame = memoryview(self.read_buf)[frame_end - response_len:frame_end]
+        response = None
+        if decode_response is not None:
+            decoded = decode_response(frame)
+            if decoded is not None:
+                response = DecodedResponse(*decoded)
+        if response is None:
             response = p.Response()
-            response.ParseFromString(response_buf)
+            response.ParseFromString(frame if parse_from_view else frame.tobytes())
+        del frame
+
+        if frame_end == self.read_end:
+            self.read_start = self.read_end = 0
+            # Don't hold on to the memory used for an unusually large response
+            if len(self.read_buf) > max_idle_read_buffer_size:
+                self.read_buf = bytearray(initial_read_buffer_size)
+        else:
+            self.read_start = frame_end
 
-            # Check that this is the response we were expecting
-            if response.token == token:
-                return response
-            elif response.token in self.cursor_cache:
-                self._handle_cursor_response(response)
+        if header_time is not None:
+            stats = self.query_stats.get(response.token)
+            if stats is not None:
+                stats.received(header_time, time.time(), 4 + response_len)
+        return response
+
+    # Returns the socket's file descriptor, to wait for responses with select
+    # or poll before calling `poll` on this connection
+    def fileno(self):
+        if not self.socket:
+            raise RqlDriverError("Connection is closed.")
+        return self.socket.fileno()
+
+    # Reads whatever responses have arrived without waiting for more, and
+    # hands them to their cursors, whose `ready_rows` then returns them.
+    # Returns the number of responses read. This lets one thread serve many
+    # cursors from an event loop, with no query being waited on meanwhile.
+    def poll(self):
+        if not self.socket:
+            raise RqlDriverError("Connection is closed.")
+
+        self.socket.settimeout(0.0)
+        try:
+            while True:
+                needed = 0
+                if self.read_end - self.read_start >= 4:
+                    (response_len,) = struct.unpack_from("<L", self.read_buf, self.read_start)
+                    needed = 4 + response_len
+                try:
+                    received = self._recv_into_buffer(needed)
+                except socket.error as err:
+                    if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                if received == 0:
+                    if self.read_end == self.read_start:
+                        raise RqlDriverError("Connection is closed.")
+                    raise RqlDriverError("Connection is broken.")
+        finally:
+            if self.socket:
+                self.socket.settimeout(None)
+
+        count = 0
+        while self.read_end - self.read_start >= 4:
+            (response_len,) = struct.unpack_from("<L", self.read_buf, self.read_start)
+            if self.read_end - self.read_start < 4 + response_len:
+                break
+            header_time = time.time() if self.query_stats else None
+            self._handle_other_response(self._parse_response(response_len, header_time))
+            count += 1
+        return count
+
+    # Does a single recv into the free space at the end of the read buffer,
+    # first making room for at least `needed` unparsed bytes. Returns the
+    # number of bytes received, which is 0 once the server closes the socket.
+    def _recv_into_buffer(self, needed=0, deadline=None):
+        buf = self.read_buf
+        pending = self.read_end - self.read_start
+        if self.read_end == len(buf) or needed > len(buf) - self.read_start:
+            # Move the unparsed bytes to the front, growing the buffer if the
+            # frame being read wouldn't fit otherwise
+            if needed > len(buf) or pending == len(buf):
+                size = len(buf)
+                while size < needed or size == pending:
+                    size *= 2
+                grown = bytearray(size)
+                grown[:pending] = buf[self.read_start:self.read_end]
+                self.read_buf = buf = grown
             else:
-                # This response is corrupted or not intended for us.
-                raise RqlDriverError("Unexpected response received.")
+                buf[:pending] = buf[self.read_start:self.read_end]
+            self.read_start = 0
+            self.read_end = pending
+
+        received = self._sock_recv_into(memoryview(buf)[self.read_end:], deadline)
+        self.read_end += received
+        return received
 
     def _check_error_response(self, response, term):
-        if response.type == p.Response.RUNTIME_ERROR:
-            message = Datum.deconstruct(response.response[0])
-            backtrace = response.backtrace
-            frames = backtrace.frames or []
-            raise RqlRuntimeError(message, term, frames)
-        elif response.type == p.Response.COMPILE_ERROR:
-            message = Datum.deconstruct(response.response[0])
-            backtrace = response.backtrace
-            frames = backtrace.frames or []
-            raise RqlCompileError(message, term, frames)
-        elif response.type == p.Response.CLIENT_ERROR:
-            message = Datum.deconstruct(response.response[0])
-            backtrace = response.backtrace
-            frames = backtrace.frames or []
-            raise RqlClientError(message, term, frames)
-
-    def _send_query(self, query, term, opts={}, async=False):
+        check_error_response(response, term)
+
+    def _send_query(self, query, term, opts={}, async=False, query_protobuf=None):
         # Error if this connection has closed
         if not self.socket:
             raise RqlDriverError("Connection is closed.")
 
-        query.accepts_r_json = True
-
         # Send protobuf
-        query_protobuf = query.SerializeToString()
+        if query_protobuf is None:
+            query.accepts_r_json = True
+            query_protobuf = query.SerializeToString()
         query_header = struct.pack("<L", len(query_protobuf))
-        self._sock_sendall(query_header + query_protobuf)
+        self._send_data([query.token], query_header + query_protobuf)
 
         if 'noreply' in opts and opts['noreply']:
+            self._finish_query(query.token)
             return None
         elif async:
             return None
 
         # Get response
-        response = self._read_response(query.token)
+        response = self._read_response(query.token, opts.get('timeout'))
+        return self._process_response(response, query, term, opts)
 
+    # Sends the already framed queries with the given tokens in one write
+    def _send_batch(self, tokens, data, expect_response):
+        # Error if this connection has closed
+        if not self.socket:
+            raise RqlDriverError("Connection is closed.")
+        self._send_data(tokens, data)
+
+    # Writes queries to the socket. When the queries with the given tokens
+    # are being timed, the time and bytes are counted for them, along with
+    # any CONTINUEs among them.
+    def _send_data(self, tokens, data, continues=0):
+        if not self.query_stats:
+            return self._sock_sendall(data)
+        start = time.time()
+        self._sock_sendall(data)
+        end = time.time()
+        for token in tokens:
+            stats = self.query_stats.get(token)
+            if stats is not None:
+                stats.sent(start, end, len(data) // len(tokens))
+                stats.continues += continues
+
+    # Sends `count` copies of a query that has no response of its own to wait
+    # for, in a single write
+    def _send_queries(self, query, count, opts={}):
+        # Error if this connection has closed
+        if not self.socket:
+            raise RqlDriverError("Connection is closed.")
+
+        query.accepts_r_json = True
+
+        query_protobuf = query.SerializeToString()
+        query_header = struct.pack("<L", len(query_protobuf))
+        self._send_data([query.token], (query_header + query_protobuf) * count,
+                        count if query.type == p.Query.CONTINUE else 0)
+
+    def _process_response(self, response, query, term, opts):
+        stats = self.query_stats.get(query.token) if self.query_stats else None
+        if stats is None:
+            return self._response_value(response, query, term, opts, None)
+
+        try:
+            value = self._response_value(response, query, term, opts, stats)
+        except Exception as err:
+            self._finish_query(query.token, err)
+            raise
+        # A cursor reports the query once it is done
+        if response.type != p.Response.SUCCESS_PARTIAL and response.type != p.Response.SUCCESS_SEQUENCE:
+            self._finish_query(query.token)
+        return value
+
+    def _response_value(self, response, query, term, opts, stats):
         self._check_error_response(response, term)
 
-        format_opts = {}
-        if 'time_format' in opts:
-            format_opts['time_format'] = opts['time_format']
-        if 'group_format' in opts:
-            format_opts['group_format'] = opts['group_format']
+        format_opts = format_opts_from(opts, self.json_decoder)
 
         # Sequence responses
         if response.type == p.Response.SUCCESS_PARTIAL or response.type == p.Response.SUCCESS_SEQUENCE:
             value = Cursor(self, query, term, format_opts, opts)
-            self.cursor_cache[query.token] = value
+            value.stats = stats
+            # Only a partial sequence has more responses coming for its token
+            if response.type == p.Response.SUCCESS_PARTIAL:
+                self.cursor_cache[query.token] = value
             value._extend(response)
 
         # Atom response
         elif response.type == p.Response.SUCCESS_ATOM:
             if len(response.response) < 1:
                 value = None
-            value = Datum.deconstruct(response.response[0], format_opts)
+            if stats is None:
+                value = response_rows(response, format_opts)[0]
+            else:
+                start = time.time()
+                value = response_rows(response, format_opts)[0]
+                stats.convert_time += time.time() - start
 
         # Noreply_wait response
         elif response.type == p.Response.WAIT_COMPLETE:
@@ -325,6 +1144,11 @@ class Connection(object):
         else:
             raise RqlDriverError("Unknown Response type %d encountered in response." % response.type)
 
+        if isinstance(response, DecodedResponse):
+            if response.profile is None:
+                return value
+            return {"value": value, "profile": response.profile}
+
         try:
             if  Datum.deconstruct(response.profile) == None:
                 return value
@@ -334,5 +1158,328 @@ class Connection(object):
             # response.profile does not exist
             return value
 
-def connect(host='localhost', port=28015, db=None, auth_key="", timeout=20):
-    return Connection(host, port, db, auth_key, timeout)
+# A connection that may be shared by many threads at once. Queries from all
+# threads are written to the same socket while a background reader thread
+# routes each response, by token, to the queue of the query or cursor that is
+# waiting for it.
+class MultiplexedConnection(Connection):
+    def __init__(self, host, port, db, auth_key, timeout, json_decoder='json', host_list=None):
+        self.lock = threading.RLock()
+        self.write_lock = threading.Lock()
+        self.reader = None
+        self.reader_error = None
+        self.queues = { }
+        self.coalescer = None
+        Connection.__init__(self, host, port, db, auth_key, timeout, json_decoder, host_list)
+
+    def reconnect(self, noreply_wait=True):
+        Connection.reconnect(self, noreply_wait)
+
+        self.reader_error = None
+        self.reader = threading.Thread(target=self._reader_loop, name="rethinkdb-reader")
+        self.reader.daemon = True
+        self.reader.start()
+
+    def close(self, noreply_wait=True):
+        # There is no point waiting on a connection that has already failed
+        if self.reader_error:
+            noreply_wait = False
+        Connection.close(self, noreply_wait)
+
+        # Shutting down the socket wakes the reader thread up so it can exit
+        reader = self.reader
+        if reader is not None and reader is not threading.current_thread():
+            reader.join()
+        self.reader = None
+        with self.lock:
+            self.queues = { }
+
+    def _new_token(self):
+        with self.lock:
+            return Connection._new_token(self)
+
+    # Each query waiting for a response, and each open cursor, has a queue
+    def outstanding_queries(self):
+        return len(self.queues)
+
+    # The reader thread reads the socket, so there is nothing to wait on.
+    # `poll` can still be called at any time.
+    def fileno(self):
+        raise RqlDriverError("A MultiplexedConnection has no file descriptor to wait on.")
+
+    # Hands the responses that the reader thread has queued to their cursors
+    def poll(self):
+        count = 0
+        with self.lock:
+            queues = [(token, self.queues.get(token)) for token in self.cursor_cache]
+        for token, queue in queues:
+            while queue is not None and token in self.cursor_cache:
+                try:
+                    response = self._get_response(queue, block=False)
+                except Empty:
+                    break
+                self._handle_cursor_response(response)
+                count += 1
+        return count
+
+    # Merges the `get`s that threads run on the same table within `window`
+    # seconds of each other into one `get_all` of up to `max_keys` keys (see
+    # coalesce.py). A get that starts while other gets are in flight waits
+    # up to `window` seconds longer, in exchange for far fewer queries; one
+    # on its own runs right away.
+    def enable_coalescing(self, window=0.001, max_keys=100):
+        if window < 0 or max_keys < 1:
+            raise RqlDriverError("Invalid coalescing settings: window=%s, max_keys=%s." % (window, max_keys))
+        self.coalescer = GetCoalescer(self._start_uncoalesced, window, max_keys)
+        return self
+
+    def disable_coalescing(self):
+        self.coalescer = None
+
+    # Returns the number of gets run through coalescing and of the queries
+    # they were merged into, or None if coalescing isn't enabled
+    def coalescing_stats(self):
+        if self.coalescer is None:
+            return None
+        return self.coalescer.stats()
+
+    def _start(self, term, **global_opt_args):
+        coalescer = self.coalescer
+        if coalescer is not None:
+            batch_key = coalescer.batch_key(term, global_opt_args, self.db)
+            if batch_key is not None:
+                return coalescer.get(term, global_opt_args, batch_key)
+        return Connection._start(self, term, **global_opt_args)
+
+    def _start_uncoalesced(self, term, global_opt_args):
+        return Connection._start(self, term, **global_opt_args)
+
+    def _reader_loop(self):
+        try:
+            while True:
+                response = self._recv_response()
+                with self.lock:
+                    queue = self.queues.get(response.token)
+                    if queue is None:
+                        if self._skip_ignored_response(response.token):
+                            continue
+                        # This response is corrupted or not intended for us.
+                        raise RqlDriverError("Unexpected response received.")
+                    queue.put(response)
+        except Exception as err:
+            if not isinstance(err, RqlDriverError):
+                err = RqlDriverError("Connection is closed.")
+            # Wake up everyone still waiting on this connection
+            with self.lock:
+                self.reader_error = err
+                for queue in self.queues.values():
+                    queue.put(err)
+
+    def _queue_for(self, token):
+        with self.lock:
+            queue = self.queues.get(token)
+        if queue is None:
+            raise RqlDriverError("Connection is closed.")
+        return queue
+
+    def _get_response(self, queue, block=True, timeout=None):
+        response = queue.get(block, timeout)
+        if isinstance(response, Exception):
+            # Leave the error for any other waiter on the same queue
+            queue.put(response)
+            raise response
+        return response
+
+    def _send_query(self, query, term, opts={}, async=False, query_protobuf=None):
+        expect_response = not async and not opts.get('noreply')
+
+        with self.lock:
+            # Error if this connection has closed
+            if not self.socket or self.reader_error:
+                raise RqlDriverError("Connection is closed.")
+            if expect_response:
+                self.queues[query.token] = Queue()
+
+        # Send protobuf
+        if query_protobuf is None:
+            query.accepts_r_json = True
+            query_protobuf = query.SerializeToString()
+        query_header = struct.pack("<L", len(query_protobuf))
+        try:
+            with self.write_lock:
+                self._send_data([query.token], query_header + query_protobuf)
+        except:
+            with self.lock:
+                self.queues.pop(query.token, None)
+            raise
+
+        if not expect_response:
+            if opts.get('noreply'):
+                self._finish_query(query.token)
+            return None
+
+        response = self._read_response(query.token, opts.get('timeout'))
+
+        # Cursors keep receiving responses on their token's queue
+        if response.type != p.Response.SUCCESS_PARTIAL:
+            with self.lock:
+                self.queues.pop(query.token, None)
+
+        return self._process_response(response, query, term, opts)
+
+    def _send_batch(self, tokens, data, expect_response):
+        with self.lock:
+            # Error if this connection has closed
+            if not self.socket or self.reader_error:
+                raise RqlDriverError("Connection is closed.")
+            if expect_response:
+                for token in tokens:
+                    self.queues[token] = Queue()
+
+        try:
+            with self.write_lock:
+                self._send_data(tokens, data)
+        except:
+            with self.lock:
+                for token in tokens:
+                    self.queues.pop(token, None)
+            raise
+
+    def _read_responses(self, tokens, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        responses = { }
+        for token in tokens:
+            try:
+                response = self._read_response(token, None if deadline is None else max(deadline - time.time(), 0))
+            except RqlTimeoutError:
+                responses[token] = RqlTimeoutError(timeout)
+                continue
+            # Cursors keep receiving responses on their token's queue
+            if response.type != p.Response.SUCCESS_PARTIAL:
+                with self.lock:
+                    self.queues.pop(token, None)
+            responses[token] = response
+        return responses
+
+    def _send_queries(self, query, count, opts={}):
+        with self.lock:
+            # Error if this connection has closed
+            if not self.socket or self.reader_error:
+                raise RqlDriverError("Connection is closed.")
+
+        query.accepts_r_json = True
+
+        query_protobuf = query.SerializeToString()
+        query_header = struct.pack("<L", len(query_protobuf))
+        with self.write_lock:
+            self._send_data([query.token], (query_header + query_protobuf) * count,
+                            count if query.type == p.Query.CONTINUE else 0)
+
+    def _read_response(self, token, timeout=None):
+        queue = self._queue_for(token)
+        try:
+            return self._wait_response(token, queue, timeout)
+        except KeyboardInterrupt:
+            # Unlike the single-threaded connection we can't reset the socket
+            # from under the other threads, so just forget about the query.
+            self._ignore_query(token, stopped=False)
+            raise
+
+    # Waits for the next response on a query's queue, giving up on the query
+    # if none arrives within `timeout` seconds
+    def _wait_response(self, token, queue, timeout):
+        try:
+            return self._get_response(queue, timeout=timeout)
+        except Empty:
+            err = RqlTimeoutError(timeout)
+            self._cancel_query(token, err)
+            raise err
+
+    def _ignore_query(self, token, stopped=True):
+        with self.lock:
+            queue = self.queues.pop(token, None)
+            cursor = self.cursor_cache.pop(token, None)
+            pending = 1
+            if cursor is not None:
+                cursor.end_flag = True
+                pending = cursor.outstanding_requests
+            # Responses the reader has already queued won't arrive again
+            while queue is not None:
+                try:
+                    item = queue.get(block=False)
+                except Empty:
+                    break
+                if not isinstance(item, Exception):
+                    pending -= 1
+            pending = max(pending, 0)
+            if stopped:
+                pending += 1
+            if pending > 0:
+                self.ignored_responses[token] = self.ignored_responses.get(token, 0) + pending
+
+    def _handle_cursor_response(self, response):
+        Connection._handle_cursor_response(self, response)
+        if response.token not in self.cursor_cache:
+            with self.lock:
+                queue = self.queues.pop(response.token, None)
+                # Account for ignored responses the reader has already queued
+                while queue is not None:
+                    try:
+                        item = queue.get(block=False)
+                    except Empty:
+                        break
+                    if not isinstance(item, Exception):
+                        self._skip_ignored_response(item.token)
+
+    def _continue_cursor(self, cursor):
+        token = cursor.query.token
+        queue = self._queue_for(token)
+
+        self._async_continue_cursor(cursor)
+        self._handle_cursor_response(self._wait_response(token, queue, cursor.opts.get('timeout')))
+
+        # Take whatever else has already arrived for this cursor
+        while token in self.cursor_cache:
+            try:
+                response = self._get_response(queue, block=False)
+            except Empty:
+                break
+            self._handle_cursor_response(response)
+
+    def _end_cursor(self, cursor):
+        token = cursor.query.token
+        queue = self._queue_for(token)
+
+        self.cursor_cache[token].outstanding_requests += 1
+
+        query = p.Query()
+        query.type = p.Query.STOP
+        query.token = token
+        self._send_query(query, cursor.term, async=True)
+
+        # Drain the responses to any CONTINUE still in flight as well as the STOP
+        while token in self.cursor_cache:
+            self._handle_cursor_response(self._get_response(queue))
+
+# With a list of `hosts`, each given as 'host', 'host:port' or (host, port),
+# the connection goes to one of them picked by the `balance` policy,
+# 'round_robin' or 'least_outstanding', and fails over to the others when it
+# can't be reached, then and on each reconnect. See hosts.py.
+def connect(host='localhost', port=28015, db=None, auth_key="", timeout=20, multiplex=False, json_decoder='json',
+            hosts=None, balance='round_robin'):
+    host_list = None
+    if hosts is not None:
+        host_list = host_list_for(hosts, port, balance)
+    if multiplex:
+        return MultiplexedConnection(host, port, db, auth_key, timeout, json_decoder, host_list)
+    return Connection(host, port, db, auth_key, timeout, json_decoder, host_list)
+
+# Returns a coroutine that opens an AsyncConnection, for use from an event
+# loop: `conn = yield From(r.connect_async())`. This needs the trollius
+# package, which is imported only when the function is first used.
+def connect_async(host='localhost', port=28015, db=None, auth_key="", timeout=20, loop=None, json_decoder='json'):
+    try:
+        from rethinkdb import asyncio_net
+    except ImportError:
+        raise RqlDriverError("connect_async requires the trollius package to be installed.")
+    return asyncio_net.connect(host, port, db, auth_key, timeout, loop, json_decoder)
@@ -0,0 +1,278 @@
+# Copyright 2010-2013 RethinkDB, all rights reserved.
+
+__all__ = ['ConnectionPool']
+
+import select
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from rethinkdb.errors import *
+from rethinkdb.net import connect, Cursor
+
+# Messages of the driver errors raised when the server went away under us
+closed_connection_messages = ("Connection is closed.", "Connection is broken.")
+
+# How often a caller waiting for a connection looks at the draining ones again,
+# since nothing wakes it up when their late responses arrive
+drain_check_interval = 0.05
+
+# A thread-safe pool of connections to a single server, or spread across the
+# nodes in `hosts` (see r.connect). Connections are created lazily up to
+# `max_size`, closed again after sitting idle for `idle_timeout` seconds
+# (keeping at least `min_size` around), and checked for liveness before being
+# handed out. A connection on which a query timed out is closed when it is
+# released rather than reused, since the server may still be running it.
+# Cursors left open on a connection are stopped when it is released, except
+# those returned by `run`, which keep their connection until they have been
+# read to the end or closed.
+class ConnectionPool(object):
+    def __init__(self, host='localhost', port=28015, db=None, auth_key="", timeout=20,
+                 min_size=0, max_size=10, idle_timeout=300, check_interval=30, json_decoder='json',
+                 hosts=None, balance='round_robin'):
+        if max_size < 1 or min_size > max_size:
+            raise RqlDriverError("Invalid pool size: min_size=%s, max_size=%s." % (min_size, max_size))
+
+        self.host = host
+        self.port = port
+        self.db = db
+        self.auth_key = auth_key
+        self.timeout = timeout
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.json_decoder = json_decoder
+        self.hosts = hosts
+        self.balance = balance
+
+        self.cond = threading.Condition()
+        self.idle = [ ]     # (connection, time it was released)
+        self.draining = [ ] # Released connections that still have responses to come
+        self.size = 0       # Connections that exist, whether idle or checked out
+        self.closed = False
+
+        try:
+            for i in xrange(min_size):
+                self.idle.append((self._connect(), time.time()))
+                self.size += 1
+        except:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _connect(self):
+        return connect(self.host, self.port, self.db, self.auth_key, self.timeout,
+                       json_decoder=self.json_decoder, hosts=self.hosts, balance=self.balance)
+
+    # Take a connection out of the pool, waiting up to `timeout` seconds
+    # (forever if None) for one to be released when the pool is at max_size.
+    # With `least_busy`, the idle connection taken is one to the node with
+    # the fewest queries in flight rather than the most recently used one.
+    def acquire(self, timeout=None, least_busy=False):
+        deadline = None if timeout is None else time.time() + timeout
+
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise RqlDriverError("Connection pool is closed.")
+
+                self._reclaim_drained()
+                self._evict_idle()
+
+                if self.idle:
+                    conn, released_at = self.idle.pop(self._least_busy_idle() if least_busy else -1)
+                    break
+
+                if self.size < self.max_size:
+                    # Reserve the slot, then connect without holding the lock
+                    self.size += 1
+                    conn, released_at = None, None
+                    break
+
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise RqlDriverError("Timed out waiting for a connection from the pool.")
+                if self.draining:
+                    remaining = drain_check_interval if remaining is None else min(remaining, drain_check_interval)
+                self.cond.wait(remaining)
+
+        try:
+            if conn is None:
+                conn = self._connect()
+            else:
+                self._check(conn, released_at)
+        except:
+            self._discard()
+            raise
+        return conn
+
+    # Return a connection to the pool. Its open cursors are stopped, and
+    # reading them further gives only the rows they had already received.
+    def release(self, conn):
+        self._release(conn, stop_cursors=True)
+
+    def _release(self, conn, stop_cursors):
+        with self.cond:
+            if conn.socket is not None and conn.cursor_cache and stop_cursors and not self.closed:
+                try:
+                    conn._stop_cursors()
+                except (RqlDriverError, socket.error):
+                    conn.close(noreply_wait=False)
+
+            if self.closed or conn.socket is None:
+                conn.close(noreply_wait=False)
+                self.size -= 1
+            elif conn.cursor_cache:
+                # A cursor returned by run is still reading from this
+                # connection, so it can't be given to anyone else until it
+                # is done.
+                self.draining.append(conn)
+            elif conn.timed_out:
+                # The server may still be running a query that timed out,
+                # which would hold up the next query on this connection
+                conn.close(noreply_wait=False)
+                self.size -= 1
+            elif self._late_responses(conn):
+                # Once idle its socket must not be readable (see _check)
+                self.draining.append(conn)
+            else:
+                self.idle.append((conn, time.time()))
+            self.cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None, least_busy=False):
+        conn = self.acquire(timeout, least_busy)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    # Run a query on a pooled connection. If the connection turns out to be
+    # closed, it is reopened and the query is sent once more. Note that this
+    # means a write may be applied twice if the server went away after
+    # receiving it but before replying. Reads with `use_outdated=True` can be
+    # answered by any node, so they go to the least busy one. A cursor
+    # returned holds on to its connection until it has been read to the end
+    # or closed.
+    def run(self, query, **global_opt_args):
+        conn = self.acquire(least_busy=bool(global_opt_args.get('use_outdated')))
+        result = None
+        try:
+            try:
+                result = query.run(conn, **global_opt_args)
+            except RqlDriverError as err:
+                if err.message not in closed_connection_messages:
+                    raise
+                conn.reconnect(noreply_wait=False)
+                result = query.run(conn, **global_opt_args)
+        finally:
+            self._release(conn, stop_cursors=not isinstance(result, Cursor))
+        return result
+
+    # Closes the idle connections, and those whose cursors are still being
+    # read, which end with a "Connection is closed." error. The connections
+    # that are checked out are closed as they are released.
+    def close(self):
+        with self.cond:
+            self.closed = True
+            for conn in [conn for conn, released_at in self.idle] + self.draining:
+                conn.close(noreply_wait=False)
+                self.size -= 1
+            self.idle = [ ]
+            self.draining = [ ]
+            self.cond.notify_all()
+
+    def _discard(self):
+        with self.cond:
+            self.size -= 1
+            self.cond.notify()
+
+    # Must be called with the lock held
+    def _reclaim_drained(self):
+        if not self.draining:
+            return
+        draining = [ ]
+        now = time.time()
+        for conn in self.draining:
+            if conn.socket is not None and not conn.cursor_cache and self._late_responses(conn):
+                # Nothing else reads the connection now, so take whatever
+                # has arrived
+                try:
+                    conn.poll()
+                except (RqlDriverError, socket.error):
+                    conn.close(noreply_wait=False)
+
+            if conn.socket is None:
+                self.size -= 1
+            elif conn.cursor_cache:
+                draining.append(conn)
+            elif conn.timed_out:
+                conn.close(noreply_wait=False)
+                self.size -= 1
+            elif self._late_responses(conn):
+                draining.append(conn)
+            else:
+                self.idle.append((conn, now))
+        self.draining = draining
+
+    # Whether responses nobody is waiting for are still to come on a
+    # connection, like those to the CONTINUEs a prefetching cursor sent past
+    # the end of its stream, or have only partly been read
+    def _late_responses(self, conn):
+        return bool(conn.ignored_responses) or conn.read_start != conn.read_end
+
+    # Must be called with the lock held. Returns the index in `idle` of a
+    # connection to the node with the fewest queries in flight, preferring
+    # the most recently used on ties.
+    def _least_busy_idle(self):
+        loads = { }
+        best, best_load = -1, None
+        for index in reversed(xrange(len(self.idle))):
+            conn = self.idle[index][0]
+            if conn.host_list is None:
+                return -1
+            address = (conn.host, conn.port)
+            if address not in loads:
+                loads[address] = conn.host_list.outstanding(address)
+            if best_load is None or loads[address] < best_load:
+                best, best_load = index, loads[address]
+        return best
+
+    # Must be called with the lock held
+    def _evict_idle(self):
+        if self.idle_timeout is None:
+            return
+        expiry = time.time() - self.idle_timeout
+        # The list is ordered by release time, oldest first
+        while self.idle and self.idle[0][1] < expiry and self.size > self.min_size:
+            conn, released_at = self.idle.pop(0)
+            conn.close(noreply_wait=False)
+            self.size -= 1
+
+    # Make sure an idle connection is still usable, reconnecting if it isn't
+    def _check(self, conn, released_at):
+        if conn.socket is None:
+            conn.reconnect(noreply_wait=False)
+            return
+
+        try:
+            # Nothing should be sent to an idle connection, so if its socket
+            # is readable the server has closed it (or it is out of sync).
+            readable, _, _ = select.select([conn.socket], [], [], 0)
+            if not readable and time.time() - released_at >= self.check_interval:
+                conn.noreply_wait()
+                return
+        except (RqlDriverError, socket.error, select.error):
+            readable = True
+
+        if readable:
+            conn.reconnect(noreply_wait=False)
@@ -0,0 +1,188 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+__all__ = ['prepare', 'PreparedQuery', 'Parameter']
+
+from rethinkdb import ql2_pb2 as p
+
+from rethinkdb import repl # For the repl connection
+
+from rethinkdb.errors import *
+from rethinkdb.ast import RqlQuery, DB, expr
+from rethinkdb.wire import encode_varint, encode_term, term_args_tag, term_optargs_tag, \
+                           term_assoc_val_tag, query_query_tag, query_token_tag
+
+# The fields of a START query that never change
+def start_header(accepts_r_json):
+    header = p.Query()
+    header.type = p.Query.START
+    header.accepts_r_json = accepts_r_json
+    return header.SerializeToString()
+
+start_headers = {True: start_header(True), False: start_header(False)}
+
+def serialize_field(build):
+    message = p.Term()
+    build(message)
+    return message.SerializeToString()
+
+# A placeholder for a value given each time a prepared query is run
+class Parameter(RqlQuery):
+    def __init__(self, name):
+        self.name = name
+        self.args = []
+        self.optargs = {}
+
+    def build(self, term):
+        raise RqlDriverError("Parameter %s can only be used in a prepared query." % self.name)
+
+    def compose(self, args, optargs):
+        return self.name
+
+# A query that is built and serialized once and then run any number of times
+# with different parameter values. Create one with `r.prepare`.
+#
+# The serialized query is kept as a template: the parts of the term tree that
+# don't contain a parameter are stored as serialized bytes, so running the
+# query only serializes the parameter values and recomputes the lengths of
+# the terms that enclose them.
+class PreparedQuery(object):
+    def __init__(self, func):
+        code = func.func_code
+        self.params = list(code.co_varnames[:code.co_argcount])
+        self.term = expr(func(*[Parameter(name) for name in self.params]))
+
+        has_params = { }
+        self._scan(self.term, has_params)
+        self.template = self._template(self.term, has_params)
+
+        # Serialized global optargs by (default database, optargs)
+        self.optargs_cache = { }
+
+    # Records which nodes of the term tree contain a parameter
+    def _scan(self, node, has_params):
+        found = isinstance(node, Parameter)
+        for arg in node.args:
+            found = self._scan(arg, has_params) or found
+        for value in node.optargs.values():
+            found = self._scan(value, has_params) or found
+        has_params[id(node)] = found
+        return found
+
+    # A template is a list of parts, each either serialized bytes, a
+    # Parameter, or a (tag, template) pair for a length-delimited field whose
+    # contents include a parameter
+    def _template(self, node, has_params):
+        if isinstance(node, Parameter):
+            return [node]
+        if not has_params[id(node)]:
+            term = p.Term()
+            node.build(term)
+            return [term.SerializeToString()]
+
+        parts = [serialize_field(lambda term: setattr(term, 'type', node.tt))]
+        for arg in node.args:
+            if has_params[id(arg)]:
+                parts.append((term_args_tag, self._template(arg, has_params)))
+            else:
+                parts.append(serialize_field(lambda term: arg.build(term.args.add())))
+        for key, value in node.optargs.items():
+            if has_params[id(value)]:
+                pair = p.Term.AssocPair()
+                pair.key = key
+                pair_parts = [pair.SerializeToString(), (term_assoc_val_tag, self._template(value, has_params))]
+                parts.append((term_optargs_tag, pair_parts))
+            else:
+                def build_optarg(term):
+                    pair = term.optargs.add()
+                    pair.key = key
+                    value.build(pair.val)
+                parts.append(serialize_field(build_optarg))
+        return parts
+
+    def _render(self, template, values):
+        chunks = [ ]
+        for part in template:
+            if isinstance(part, str):
+                chunks.append(part)
+            elif isinstance(part, Parameter):
+                chunks.append(values[part.name])
+            else:
+                tag, child = part
+                data = self._render(child, values)
+                chunks.append(tag + encode_varint(len(data)) + data)
+        return b''.join(chunks)
+
+    # Returns the serialized global optargs, which are cached when the options
+    # can be used as a dictionary key
+    def _serialize_optargs(self, default_db, global_opt_args):
+        try:
+            key = (default_db, tuple(sorted(global_opt_args.items())))
+            return self.optargs_cache[key]
+        except TypeError:
+            key = None
+        except KeyError:
+            pass
+
+        query = p.Query()
+        optargs = dict(global_opt_args)
+        if 'db' in optargs:
+            optargs['db'] = DB(optargs['db'])
+        elif default_db:
+            optargs['db'] = DB(default_db)
+        for k, v in optargs.items():
+            pair = query.global_optargs.add()
+            pair.key = k
+            expr(v).build(pair.val)
+        data = query.SerializeToString()
+
+        if key is not None:
+            # Don't let a query run with ever-changing options grow the cache forever
+            if len(self.optargs_cache) >= 64:
+                self.optargs_cache.clear()
+            self.optargs_cache[key] = data
+        return data
+
+    # Returns the serialized START query for the given parameter values
+    def _serialize(self, token, params, default_db, global_opt_args, accepts_r_json):
+        values = { }
+        for name in self.params:
+            values[name] = encode_term(expr(params[name]))
+
+        term = self._render(self.template, values)
+        return b''.join([start_headers[accepts_r_json],
+                         query_query_tag, encode_varint(len(term)), term,
+                         query_token_tag, encode_varint(token),
+                         self._serialize_optargs(default_db, global_opt_args)])
+
+    # Runs the query on a connection. Parameter values can be given in order
+    # or by name; any other keyword arguments are run options, as for
+    # `RqlQuery.run`.
+    def run(self, c=None, *args, **kwargs):
+        if not c:
+            if repl.default_connection:
+                c = repl.default_connection
+            else:
+                raise RqlDriverError("PreparedQuery.run must be given a connection to run on.")
+
+        if len(args) > len(self.params):
+            raise RqlDriverError("Expected at most %d parameters, got %d." % (len(self.params), len(args)))
+        params = dict(zip(self.params, args))
+        for name in self.params[len(args):]:
+            if name not in kwargs:
+                raise RqlDriverError("Missing value for parameter %s of the prepared query." % name)
+            params[name] = kwargs.pop(name)
+
+        return c._start_prepared(self, params, **kwargs)
+
+    def __str__(self):
+        return 'r.prepare(lambda %s: %s)' % (', '.join(self.params), self.term)
+
+    def __repr__(self):
+        return "<PreparedQuery instance: %s >" % str(self)
+
+# Builds a prepared query from a function of its parameters. For example:
+#
+#     get_user = r.prepare(lambda key: r.table('users').get(key))
+#     get_user.run(conn, key=5)
+def prepare(func):
+    return PreparedQuery(func)
@@ -150,7 +150,7 @@ november    = type('', (RqlTimeName,), {'tt': p.Term.NOVEMBER, 'st': 'november'}
 december    = type('', (RqlTimeName,), {'tt': p.Term.DECEMBER, 'st': 'december'})()
 
 def make_timezone(tzstring):
-    return RqlTzinfo(tzstring)
+    return rql_tzinfo(tzstring)
 
 # Merge values
 def literal(val=()):
@@ -0,0 +1,116 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# Timings of the queries run on a connection, for the listeners added with
+# Connection.add_listener. A listener is any object with a
+# `query_finished(stats)` method, which is called with the QueryStats of each
+# query once it is done: when its result has been converted, when the last
+# batch of its cursor has been read or the cursor closed, or when it fails.
+# Listeners are called on the thread that finishes the query.
+
+__all__ = ['QueryStats', 'StatsAggregator']
+
+import threading
+from collections import deque
+
+class QueryStats(object):
+    __slots__ = ['token', 'term_type', 'start_time', 'sent_at', 'total_time', 'serialize_time',
+                 'send_time', 'wait_time', 'read_time', 'convert_time', 'bytes_sent',
+                 'bytes_received', 'batches', 'continues', 'cached', 'error']
+
+    def __init__(self, token, term_type, start_time, serialize_time):
+        self.token = token
+        self.term_type = term_type   # The name of the query's term class, like 'Get'
+        self.start_time = start_time
+        self.sent_at = None          # When the query was first sent
+        self.total_time = None       # From before serializing to when the query finished
+
+        # Seconds spent building and serializing the query, writing it and its
+        # CONTINUEs to the socket, waiting for the first byte of the first
+        # response, reading and parsing the responses, and converting their
+        # datums to Python values
+        self.serialize_time = serialize_time
+        self.send_time = 0.0
+        self.wait_time = None
+        self.read_time = 0.0
+        self.convert_time = 0.0
+
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.batches = 0             # Responses received
+        self.continues = 0           # CONTINUE queries sent for the cursor
+        self.cached = False          # Whether the result came from the query cache
+        self.error = None            # The exception the query failed with
+
+    def sent(self, start, end, size):
+        if self.sent_at is None:
+            self.sent_at = end
+        self.send_time += end - start
+        self.bytes_sent += size
+
+    def received(self, header_time, end, size):
+        if self.wait_time is None and self.sent_at is not None:
+            self.wait_time = max(header_time - self.sent_at, 0.0)
+        self.read_time += end - header_time
+        self.bytes_received += size
+        self.batches += 1
+
+    def __repr__(self):
+        return "<QueryStats %s %s: %s>" % (self.token, self.term_type, ", ".join(
+            "%s=%r" % (name, getattr(self, name)) for name in self.__slots__[4:]))
+
+# A listener that keeps the timings of the last `max_samples` queries of each
+# term type, to report their percentiles
+class StatsAggregator(object):
+    phases = ['total_time', 'serialize_time', 'send_time', 'wait_time', 'read_time', 'convert_time']
+
+    def __init__(self, max_samples=1000):
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.samples = { } # Term type -> phase -> recent times
+        self.counts = { }  # Term type -> number of queries
+        self.errors = { }  # Term type -> number of failed queries
+
+    def query_finished(self, stats):
+        with self.lock:
+            samples = self.samples.get(stats.term_type)
+            if samples is None:
+                samples = self.samples[stats.term_type] = \
+                    dict((phase, deque(maxlen=self.max_samples)) for phase in self.phases)
+                self.counts[stats.term_type] = 0
+                self.errors[stats.term_type] = 0
+            for phase in self.phases:
+                value = getattr(stats, phase)
+                if value is not None:
+                    samples[phase].append(value)
+            self.counts[stats.term_type] += 1
+            if stats.error is not None:
+                self.errors[stats.term_type] += 1
+
+    # Returns the `pct` percentile of a phase's times for a term type, or None
+    # if there are none
+    def percentile(self, term_type, phase, pct):
+        with self.lock:
+            values = sorted(self.samples.get(term_type, {}).get(phase, []))
+        if not values:
+            return None
+        return values[min(int(len(values) * pct / 100.0), len(values) - 1)]
+
+    # Returns, for each term type, the number of queries and of errors and
+    # the p50 and p99 of each phase
+    def summary(self):
+        with self.lock:
+            term_types = list(self.samples)
+        result = { }
+        for term_type in term_types:
+            entry = {'count': self.counts[term_type], 'errors': self.errors[term_type]}
+            for phase in self.phases:
+                entry[phase] = {'p50': self.percentile(term_type, phase, 50),
+                                'p99': self.percentile(term_type, phase, 99)}
+            result[term_type] = entry
+        return result
+
+    def reset(self):
+        with self.lock:
+            self.samples = { }
+            self.counts = { }
+            self.errors = { }
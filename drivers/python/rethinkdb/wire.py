@@ -0,0 +1,186 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# Encodes queries straight to the protobuf wire format. Building the nested
+# p.Term messages with RqlQuery.build and then serializing them costs a
+# protobuf object per term, which dominates the time to send a query with the
+# pure Python protobuf implementation. The encoder here walks the query's
+# terms and writes the same bytes directly. Term classes with a build method
+# of their own that the encoder doesn't know still go through protobuf.
+
+__all__ = ['encode_term', 'encode_start_query']
+
+import numbers
+import struct
+import types
+
+from rethinkdb import ql2_pb2 as p
+
+from rethinkdb.errors import *
+from rethinkdb.ast import RqlQuery, Datum, expr
+
+def encode_varint(value):
+    if value < 0:
+        # int64 fields encode negative values in ten bytes
+        value += 1 << 64
+    if value < 0x80:
+        return chr(value)
+    data = bytearray()
+    while value > 0x7f:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+def encode_tag(descriptor, field_name, wire_type):
+    return encode_varint((descriptor.fields_by_name[field_name].number << 3) | wire_type)
+
+# Wire types of the protobuf encoding
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH_DELIMITED = 2
+
+term_type_tag = encode_tag(p.Term.DESCRIPTOR, 'type', WIRE_VARINT)
+term_datum_tag = encode_tag(p.Term.DESCRIPTOR, 'datum', WIRE_LENGTH_DELIMITED)
+term_args_tag = encode_tag(p.Term.DESCRIPTOR, 'args', WIRE_LENGTH_DELIMITED)
+term_optargs_tag = encode_tag(p.Term.DESCRIPTOR, 'optargs', WIRE_LENGTH_DELIMITED)
+term_assoc_key_tag = encode_tag(p.Term.AssocPair.DESCRIPTOR, 'key', WIRE_LENGTH_DELIMITED)
+term_assoc_val_tag = encode_tag(p.Term.AssocPair.DESCRIPTOR, 'val', WIRE_LENGTH_DELIMITED)
+
+datum_type_tag = encode_tag(p.Datum.DESCRIPTOR, 'type', WIRE_VARINT)
+datum_bool_tag = encode_tag(p.Datum.DESCRIPTOR, 'r_bool', WIRE_VARINT)
+datum_num_tag = encode_tag(p.Datum.DESCRIPTOR, 'r_num', WIRE_FIXED64)
+datum_str_tag = encode_tag(p.Datum.DESCRIPTOR, 'r_str', WIRE_LENGTH_DELIMITED)
+
+query_type_tag = encode_tag(p.Query.DESCRIPTOR, 'type', WIRE_VARINT)
+query_query_tag = encode_tag(p.Query.DESCRIPTOR, 'query', WIRE_LENGTH_DELIMITED)
+query_token_tag = encode_tag(p.Query.DESCRIPTOR, 'token', WIRE_VARINT)
+query_accepts_r_json_tag = encode_tag(p.Query.DESCRIPTOR, 'accepts_r_json', WIRE_VARINT)
+query_global_optargs_tag = encode_tag(p.Query.DESCRIPTOR, 'global_optargs', WIRE_LENGTH_DELIMITED)
+query_assoc_key_tag = encode_tag(p.Query.AssocPair.DESCRIPTOR, 'key', WIRE_LENGTH_DELIMITED)
+query_assoc_val_tag = encode_tag(p.Query.AssocPair.DESCRIPTOR, 'val', WIRE_LENGTH_DELIMITED)
+
+# The encoded `type` field of a term, by term type
+term_type_fields = { }
+
+def term_type_field(tt):
+    field = term_type_fields.get(tt)
+    if field is None:
+        field = term_type_fields[tt] = term_type_tag + encode_varint(tt)
+    return field
+
+datum_term_field = term_type_field(p.Term.DATUM)
+null_datum = datum_type_tag + encode_varint(p.Datum.R_NULL)
+true_datum = datum_type_tag + encode_varint(p.Datum.R_BOOL) + datum_bool_tag + encode_varint(1)
+false_datum = datum_type_tag + encode_varint(p.Datum.R_BOOL) + datum_bool_tag + encode_varint(0)
+num_datum_header = datum_type_tag + encode_varint(p.Datum.R_NUM) + datum_num_tag
+str_datum_header = datum_type_tag + encode_varint(p.Datum.R_STR) + datum_str_tag
+
+# Protobuf string fields hold UTF-8
+def encode_string(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    # Raises if a byte string isn't valid UTF-8, as protobuf does
+    value.decode('utf-8')
+    return value
+
+# The encoded `key` field of an optarg, by key. Besides optarg names, these
+# are the keys of MakeObj terms, which come from user data, so the cache is
+# bounded.
+optarg_keys = { }
+
+def optarg_key(key):
+    if len(optarg_keys) >= 4096:
+        optarg_keys.clear()
+    field = optarg_keys[key] = length_delimited(term_assoc_key_tag, encode_string(key))
+    return field
+
+def length_delimited(tag, data):
+    length = len(data)
+    return tag + (chr(length) if length < 0x80 else encode_varint(length)) + data
+
+# Encoders for the types of datum values that need no further checks
+def encode_str_datum(data):
+    return str_datum_header + length_delimited('', encode_string(data))
+
+def encode_num_datum(data):
+    return num_datum_header + struct.pack('<d', data)
+
+datum_encoders = {
+    types.NoneType: lambda data: null_datum,
+    bool: lambda data: true_datum if data else false_datum,
+    int: encode_num_datum,
+    long: encode_num_datum,
+    float: encode_num_datum,
+    str: encode_str_datum,
+    unicode: encode_str_datum
+}
+
+def encode_datum(term):
+    data = term.data
+    encoder = datum_encoders.get(type(data))
+    if encoder is not None:
+        datum = encoder(data)
+    elif data == None:
+        datum = null_datum
+    elif isinstance(data, bool):
+        datum = true_datum if data else false_datum
+    elif isinstance(data, numbers.Real):
+        datum = num_datum_header + struct.pack('<d', data)
+    elif isinstance(data, types.StringTypes):
+        datum = str_datum_header + length_delimited('', encode_string(data))
+    else:
+        raise RqlDriverError("Cannot build a query from a %s" % type(data).__name__)
+    return datum_term_field + length_delimited(term_datum_tag, datum)
+
+def encode_generic_term(term):
+    parts = [term_type_fields.get(term.tt) or term_type_field(term.tt)]
+    for arg in term.args:
+        encoder = encoders.get(type(arg)) or encoder_for(type(arg))
+        parts.append(length_delimited(term_args_tag, encoder(arg)))
+    optargs = term.optargs
+    if optargs:
+        for k in optargs.keys():
+            val = optargs[k]
+            encoder = encoders.get(type(val)) or encoder_for(type(val))
+            pair = (optarg_keys.get(k) or optarg_key(k)) + length_delimited(term_assoc_val_tag, encoder(val))
+            parts.append(length_delimited(term_optargs_tag, pair))
+    return b''.join(parts)
+
+def encode_protobuf_term(term):
+    message = p.Term()
+    term.build(message)
+    return message.SerializeToString()
+
+# How to encode the terms of each class, found from the class's build method
+encoders = { }
+
+def encoder_for(cls):
+    build = cls.build.im_func
+    if build is RqlQuery.build.im_func:
+        encoder = encode_generic_term
+    elif build is Datum.build.im_func:
+        encoder = encode_datum
+    else:
+        encoder = encode_protobuf_term
+    encoders[cls] = encoder
+    return encoder
+
+# Returns the serialized p.Term for an RqlQuery
+def encode_term(term):
+    encoder = encoders.get(type(term))
+    if encoder is None:
+        encoder = encoder_for(type(term))
+    return encoder(term)
+
+# Returns the serialized START query, the same bytes as the p.Query that
+# net.start_query builds. The 'db' global optarg must already be filled in.
+def encode_start_query(token, term, global_opt_args, accepts_r_json):
+    parts = [query_type_tag, encode_varint(p.Query.START),
+             length_delimited(query_query_tag, encode_term(term)),
+             query_token_tag, encode_varint(token),
+             query_accepts_r_json_tag, encode_varint(int(bool(accepts_r_json)))]
+    for k, v in global_opt_args.items():
+        pair = length_delimited(query_assoc_key_tag, encode_string(k)) + \
+               length_delimited(query_assoc_val_tag, encode_term(expr(v)))
+        parts.append(length_delimited(query_global_optargs_tag, pair))
+    return b''.join(parts)
@@ -0,0 +1,609 @@
+#!/usr/bin/python
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# Microbenchmarks for the Python driver that don't need a server. Each one
+# runs over a synthetic corpus and prints how many rows (or queries) per
+# second the driver manages. Run all of them with
+#
+#     python driver_bench.py
+#
+# or only some of them by passing their names on the command line.
+
+import sys
+import time
+import random
+import datetime
+import json
+import collections
+
+sys.path.insert(0, "../../drivers/python")
+
+import rethinkdb as r
+from rethinkdb import ql2_pb2 as p
+from rethinkdb import ast
+from rethinkdb.ast import Datum, JsonDecoder
+from rethinkdb.columns import ColumnBuilder
+from rethinkdb.net import decode_response, DecodedResponse, response_rows, start_query, serialize_start_query
+
+# Each measurement runs for at least this many seconds
+min_duration = 1.0
+
+def gen_row(i, rand):
+    row = {
+        "id": i,
+        "name": "user%d" % i,
+        "score": rand.random() * 1000,
+        "active": rand.random() > 0.5,
+        "tags": ["tag%d" % rand.randint(0, 20) for j in xrange(rand.randint(0, 8))],
+        "address": {
+            "street": "%d Main St" % rand.randint(1, 999),
+            "zip": "%05d" % rand.randint(0, 99999),
+            "geo": [rand.random() * 180 - 90, rand.random() * 360 - 180]
+        },
+        "parent": None
+    }
+    # Some rows carry pseudo-types, as rows with dates do
+    if i % 4 == 0:
+        row["created"] = {"$reql_type$": "TIME", "epoch_time": 1375115782.24 + i, "timezone": "+01:00"}
+    return row
+
+def gen_corpus(num_rows, seed=0):
+    rand = random.Random(seed)
+    return [gen_row(i, rand) for i in xrange(num_rows)]
+
+def json_datums(rows):
+    datums = [ ]
+    for row in rows:
+        datum = p.Datum()
+        datum.type = p.Datum.R_JSON
+        datum.r_str = json.dumps(row)
+        datums.append(datum)
+    return datums
+
+def native_datum(datum, val):
+    if val is None:
+        datum.type = p.Datum.R_NULL
+    elif isinstance(val, bool):
+        datum.type = p.Datum.R_BOOL
+        datum.r_bool = val
+    elif isinstance(val, (int, long, float)):
+        datum.type = p.Datum.R_NUM
+        datum.r_num = val
+    elif isinstance(val, basestring):
+        datum.type = p.Datum.R_STR
+        datum.r_str = val
+    elif isinstance(val, list):
+        datum.type = p.Datum.R_ARRAY
+        for item in val:
+            native_datum(datum.r_array.add(), item)
+    elif isinstance(val, dict):
+        datum.type = p.Datum.R_OBJECT
+        for key, item in val.iteritems():
+            pair = datum.r_object.add()
+            pair.key = key
+            native_datum(pair.val, item)
+    return datum
+
+# Serialized SUCCESS_PARTIAL responses holding the rows as native datums
+def native_frames(rows, batch_size=100):
+    frames = [ ]
+    for i in xrange(0, len(rows), batch_size):
+        response = p.Response()
+        response.type = p.Response.SUCCESS_PARTIAL
+        response.token = 1
+        for row in rows[i:i + batch_size]:
+            native_datum(response.response.add(), row)
+        frames.append(response.SerializeToString())
+    return frames
+
+# The same, with the rows as R_JSON datums, as the server sends them to a
+# query with accepts_r_json set
+def json_frames(rows, batch_size=100):
+    frames = [ ]
+    for i in xrange(0, len(rows), batch_size):
+        response = p.Response()
+        response.type = p.Response.SUCCESS_PARTIAL
+        response.token = 1
+        response.response.extend(json_datums(rows[i:i + batch_size]))
+        frames.append(response.SerializeToString())
+    return frames
+
+# Calls `fn` until `min_duration` has passed and returns the items per second,
+# given that each call handles `count` items
+def measure(fn, count):
+    calls = 0
+    start = time.time()
+    while True:
+        fn()
+        calls += 1
+        elapsed = time.time() - start
+        if elapsed >= min_duration:
+            return calls * count / elapsed
+
+def report(name, rate, baseline=None):
+    if baseline is None:
+        print "  %-40s %12.0f/s" % (name, rate)
+    else:
+        print "  %-40s %12.0f/s  (%.2fx)" % (name, rate, rate / baseline)
+
+def bench_decode():
+    print "Decoding R_JSON rows"
+    datums = json_datums(gen_corpus(2000))
+
+    # How every row was decoded before: parse, then walk the result again
+    def before():
+        for datum in datums:
+            Datum._recursively_convert_pseudotypes(json.loads(datum.r_str), {})
+    expected = [Datum._recursively_convert_pseudotypes(json.loads(datum.r_str), {}) for datum in datums]
+
+    baseline = measure(before, len(datums))
+    report("json.loads + recursive pass", baseline)
+
+    for name in ['json', 'simplejson', 'ujson']:
+        try:
+            format_opts = {'json_decoder': JsonDecoder(name)}
+        except r.RqlDriverError as err:
+            print "  %-40s skipped (%s)" % (name, err)
+            continue
+
+        result = [Datum.deconstruct(datum, format_opts) for datum in datums]
+        if result != expected:
+            raise Exception("The %s decoder gives different rows" % name)
+
+        def after():
+            for datum in datums:
+                Datum.deconstruct(datum, format_opts)
+        report("%s decoder" % name, measure(after, len(datums)), baseline)
+
+def parse_frames(frames):
+    result = [ ]
+    for frame in frames:
+        response = p.Response()
+        response.ParseFromString(frame)
+        result.extend(response_rows(response, {}))
+    return result
+
+def bench_native_decode():
+    print "Decoding responses"
+    rows = gen_corpus(2000)
+    frames = native_frames(rows)
+    r_json_frames = json_frames(rows)
+
+    # How responses are read by default: R_JSON datums, each parsed with json
+    expected = parse_frames(r_json_frames)
+    baseline = measure(lambda: parse_frames(r_json_frames), len(rows))
+    report("R_JSON: ParseFromString + json", baseline)
+
+    if parse_frames(frames) != expected:
+        raise Exception("Native datums give different rows")
+    report("native: ParseFromString + deconstruct", measure(lambda: parse_frames(frames), len(rows)), baseline)
+
+    if decode_response is None:
+        print "  %-40s skipped (the C++ extension is not built)" % "decode_response"
+        return
+
+    for name, c_frames in [("R_JSON", r_json_frames), ("native", frames)]:
+        def c_path():
+            result = [ ]
+            for frame in c_frames:
+                result.extend(response_rows(DecodedResponse(*decode_response(frame)), {}))
+            return result
+        if c_path() != expected:
+            raise Exception("decode_response gives different rows")
+
+        report("%s: decode_response" % name, measure(c_path, len(rows)), baseline)
+
+def bench_prepare():
+    print "Serializing point lookups"
+    count = 1000
+
+    def build():
+        for i in xrange(count):
+            query = start_query(i + 1, r.table('users').get_all(i, index='uid').limit(1), 'test', {})
+            query.accepts_r_json = True
+            query.SerializeToString()
+
+    prepared = r.prepare(lambda key: r.table('users').get_all(key, index='uid').limit(1))
+    def run_prepared():
+        for i in xrange(count):
+            prepared._serialize(i + 1, {'key': i}, 'test', {}, True)
+
+    # Both must produce the same query
+    query = start_query(1, r.table('users').get_all(5, index='uid').limit(1), 'test', {})
+    query.accepts_r_json = True
+    parsed = p.Query()
+    parsed.ParseFromString(prepared._serialize(1, {'key': 5}, 'test', {}, True))
+    if parsed != query:
+        raise Exception("The prepared query serializes differently")
+
+    baseline = measure(build, count)
+    report("build + SerializeToString", baseline)
+    report("prepared query", measure(run_prepared, count), baseline)
+
+def bench_expr():
+    print "Building and serializing literal documents"
+    rand = random.Random(0)
+    # Rows without pseudo-types, so they are pure JSON
+    rows = [row for row in gen_corpus(2000) if "created" not in row]
+    docs = [
+        ("one row", rows[0], 1000),
+        ("20 rows", rows[:20], 100),
+        ("10k numbers", [rand.random() for i in xrange(10000)], 10),
+        ("1000 rows", rows[:1000], 5)
+    ]
+
+    def serialize(doc):
+        query = start_query(1, r.table('users').insert(r.expr(doc)), 'test', {})
+        query.accepts_r_json = True
+        return query.SerializeToString()
+
+    threshold = ast.json_term_threshold
+    try:
+        for name, doc, count in docs:
+            def build():
+                for i in xrange(count):
+                    serialize(doc)
+
+            ast.json_term_threshold = None
+            before_size = len(serialize(doc))
+            baseline = measure(build, count)
+            ast.json_term_threshold = threshold
+            after_size = len(serialize(doc))
+
+            report("%s: expr tree (%d bytes)" % (name, before_size), baseline)
+            report("%s: with Json terms (%d bytes)" % (name, after_size), measure(build, count), baseline)
+    finally:
+        ast.json_term_threshold = threshold
+
+# How expr picked the conversion for a value before it had a table of
+# converters by type: a chain of isinstance checks on every value
+def chain_expr(val, nesting_depth=20):
+    if nesting_depth <= 0:
+        raise r.RqlDriverError("Nesting depth limit exceeded")
+
+    if isinstance(val, ast.RqlQuery):
+        return val
+    elif isinstance(val, datetime.datetime) or isinstance(val, datetime.date):
+        return ast._expr_time(val, nesting_depth)
+    elif isinstance(val, (list, dict)):
+        return ast._expr_container(val, nesting_depth)
+    elif isinstance(val, collections.Callable):
+        return ast._expr_func(val, nesting_depth)
+    elif chain_internable(val):
+        return ast._interned_datum(val)
+    else:
+        return ast.Datum(val)
+
+def chain_internable(val):
+    t = type(val)
+    if t is int:
+        return -1024 <= val <= 1024
+    elif t is str or t is unicode:
+        return len(val) <= 32
+    return val is None or t is bool
+
+def bench_convert():
+    print "Converting insert payloads with r.expr"
+    rows = gen_corpus(1000)
+    payloads = [
+        ("single rows", [[row] for row in rows[:200]]),
+        ("batches of 20 rows", [rows[i:i + 20] for i in xrange(0, 1000, 20)]),
+        ("scalars", [row[key] for row in rows[:200] for key in ["id", "name", "score", "active", "parent"]])
+    ]
+
+    def serialized(doc):
+        query = start_query(1, ast.expr(doc), 'test', {})
+        query.accepts_r_json = True
+        return query.SerializeToString()
+
+    # ast.expr is swapped out so that the terms built for nested values go
+    # through the isinstance chain as well
+    expr = ast.expr
+    threshold = ast.json_term_threshold
+    try:
+        for name, docs in payloads:
+            count = sum(len(doc) if isinstance(doc, list) else 1 for doc in docs)
+            def convert():
+                for doc in docs:
+                    ast.expr(doc)
+
+            ast.json_term_threshold = None
+            expected = [serialized(doc) for doc in docs]
+            ast.expr = chain_expr
+            if [serialized(doc) for doc in docs] != expected:
+                raise Exception("The isinstance chain builds different terms for the %s" % name)
+            baseline = measure(convert, count)
+            ast.expr = expr
+            report("%s: isinstance chain" % name, baseline)
+
+            table = measure(convert, count)
+            report("%s: converter table" % name, table, baseline)
+            ast.json_term_threshold = threshold
+            report("%s: with Json terms" % name, measure(convert, count), table)
+    finally:
+        ast.expr = expr
+        ast.json_term_threshold = threshold
+
+def bench_group():
+    print "Decoding grouped results"
+    rand = random.Random(0)
+    # 20k groups with compound keys, each with a count as its value
+    data = [[["user%d" % i, {"region": rand.randint(0, 50)}], rand.randint(1, 100)] for i in xrange(20000)]
+    datums = json_datums([{"$reql_type$": "GROUPED_DATA", "data": data}])
+
+    for label, group_format in [("native dict", "native"), ("lazy GroupedResult", "lazy")]:
+        format_opts = {'group_format': group_format}
+        def decode():
+            for datum in datums:
+                Datum.deconstruct(datum, format_opts)
+        rate = measure(decode, len(data))
+        if group_format == "native":
+            baseline = rate
+        report(label, rate, baseline)
+
+        # Decoding, then going through every group
+        def iterate():
+            for datum in datums:
+                result = Datum.deconstruct(datum, format_opts)
+                for item in result.items():
+                    pass
+        report("%s + items()" % label, measure(iterate, len(data)))
+
+# How TIME pseudo-types were converted before tzinfos were shared
+def old_time_to_datetime(obj):
+    if 'timezone' in obj:
+        return datetime.datetime.fromtimestamp(obj['epoch_time'], ast.RqlTzinfo(obj['timezone']))
+    return datetime.datetime.utcfromtimestamp(obj['epoch_time'])
+
+def bench_time():
+    print "Converting a million times"
+    rand = random.Random(0)
+    timezones = ["+00:00", "-07:00", "+01:00", "+05:30", "-03:00"]
+    times = [{"$reql_type$": "TIME", "epoch_time": 1375115782.24 + rand.random() * 1e7,
+              "timezone": rand.choice(timezones)} for i in xrange(1000000)]
+
+    expected = [old_time_to_datetime(obj) for obj in times[:1000]]
+    if [Datum._convert_pseudotype(obj, {}) for obj in times[:1000]] != expected:
+        raise Exception("The times convert to different datetimes")
+
+    def before():
+        for obj in times:
+            old_time_to_datetime(obj)
+    baseline = measure(before, len(times))
+    report("new RqlTzinfo per time", baseline)
+
+    for name, time_format in [("shared tzinfos", "native"), ("time_format='epoch'", "epoch")]:
+        format_opts = {'time_format': time_format}
+        def after():
+            convert = Datum._convert_pseudotype
+            for obj in times:
+                convert(obj, format_opts)
+        report(name, measure(after, len(times)), baseline)
+
+    # Event log rows, read from R_JSON batches of 1000 rows as a cursor does
+    print "Decoding batches of rows with times"
+    responses = [ ]
+    for i in xrange(0, 100000, 1000):
+        response = p.Response()
+        response.type = p.Response.SUCCESS_PARTIAL
+        response.token = 1
+        for datum in json_datums([{"id": j, "event": "click", "at": times[j]} for j in xrange(i, i + 1000)]):
+            response.response.add().CopyFrom(datum)
+        responses.append(response)
+    count = 100000
+
+    def per_row():
+        for response in responses:
+            [Datum.deconstruct(datum, {}) for datum in response.response]
+    if [response_rows(response, {}) for response in responses] != \
+       [[Datum.deconstruct(datum, {}) for datum in response.response] for response in responses]:
+        raise Exception("Batches decode to different rows")
+
+    baseline = measure(per_row, count)
+    report("one row at a time", baseline)
+    for name, time_format in [("whole batch", "native"), ("whole batch, time_format='epoch'", "epoch")]:
+        format_opts = {'time_format': time_format}
+        def batch():
+            for response in responses:
+                response_rows(response, format_opts)
+        report(name, measure(batch, count), baseline)
+
+def bench_columns():
+    print "Collecting fields into columns"
+    rows = gen_corpus(20000)
+    fields = ["id", "score", "active", "name"]
+
+    def parsed(frames):
+        responses = [ ]
+        for frame in frames:
+            response = p.Response()
+            response.ParseFromString(frame)
+            responses.append(response)
+        return responses
+
+    json_responses = [ ]
+    for i in xrange(0, len(rows), 1000):
+        response = p.Response()
+        for datum in json_datums(rows[i:i + 1000]):
+            response.response.add().CopyFrom(datum)
+        json_responses.append(response)
+
+    for name, responses in [("native datums", parsed(native_frames(rows, 1000))), ("R_JSON datums", json_responses)]:
+        # Building the rows, then a list per field
+        def from_rows():
+            columns = dict((field, [ ]) for field in fields)
+            for response in responses:
+                for row in response_rows(response, {}):
+                    for field in fields:
+                        columns[field].append(row.get(field))
+            return columns
+
+        def to_columns():
+            builder = ColumnBuilder(fields, {})
+            for response in responses:
+                builder.add_response(response, None)
+            return builder.columns()
+
+        columns = to_columns()
+        if dict((field, column.to_list()) for field, column in columns.iteritems()) != from_rows():
+            raise Exception("The columns hold different values than the rows")
+
+        baseline = measure(from_rows, len(rows))
+        report("%s: rows, then lists" % name, baseline)
+        report("%s: columns" % name, measure(to_columns, len(rows)), baseline)
+
+    # The memory held per row: each row as a dict with its top-level values,
+    # against the columns of the fields
+    row_bytes = sum(sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row.itervalues()) for row in rows)
+    column_bytes = 0
+    for column in columns.itervalues():
+        column_bytes += sys.getsizeof(column.values) + sys.getsizeof(column.mask)
+        if isinstance(column.values, list):
+            column_bytes += sum(sys.getsizeof(value) for value in column.values)
+    print "  %-40s %8.1f bytes/row" % ("rows", row_bytes / float(len(rows)))
+    print "  %-40s %8.1f bytes/row" % ("columns of %s" % ", ".join(fields), column_bytes / float(len(rows)))
+
+def bench_encode():
+    print "Serializing queries"
+    queries = [
+        ("point lookup", r.table('users').get(5), 2000),
+        ("filter + update", r.table('users').filter(lambda user: (user['age'] > 21) & user['active'])
+                             .update({'score': r.row['score'] + 1, 'tags': ['a', 'b', 'c'],
+                                      'seen': r.now()}, durability='soft'), 500),
+        ("30-row literal", r.table('users').insert(r.expr(gen_corpus(30)[1:])), 100)
+    ]
+
+    for name, term, count in queries:
+        def protobuf():
+            for i in xrange(count):
+                query = start_query(i + 1, term, 'test', {})
+                query.accepts_r_json = True
+                query.SerializeToString()
+
+        def wire():
+            for i in xrange(count):
+                serialize_start_query(i + 1, term, 'test', {}, True)
+
+        query = start_query(1, term, 'test', {})
+        query.accepts_r_json = True
+        if serialize_start_query(1, term, 'test', {}, True)[1] != query.SerializeToString():
+            raise Exception("The wire encoder gives different bytes for the %s" % name)
+
+        baseline = measure(protobuf, count)
+        report("%s: build + SerializeToString" % name, baseline)
+        report("%s: wire encoder" % name, measure(wire, count), baseline)
+
+# Returns the number of distinct terms in a query and the bytes they hold:
+# the term objects with their attribute dicts, argument lists and optarg
+# dicts, each counted once. (tracemalloc isn't available on Python 2.)
+#
+# With `unshared`, this gives the figure for the layout terms had before they
+# got __slots__ and small datums were shared: every term carries a __dict__
+# holding the attributes it sets, and every use of a datum is its own term.
+def term_memory(term, seen, unshared=False):
+    if id(term) in seen:
+        return 0, 0
+    if not unshared or not isinstance(term, ast.Datum):
+        seen.add(id(term))
+    nodes = 1
+    if unshared:
+        size = sys.getsizeof(DictTerm()) + sys.getsizeof(term_attributes(term))
+    else:
+        size = sys.getsizeof(term)
+        if hasattr(term, '__dict__'):
+            size += sys.getsizeof(term.__dict__)
+    for container in [term.args, term.optargs]:
+        if id(container) not in seen:
+            seen.add(id(container))
+            size += sys.getsizeof(container)
+    for child in list(term.args) + term.optargs.values():
+        child_nodes, child_size = term_memory(child, seen, unshared)
+        nodes += child_nodes
+        size += child_size
+    return nodes, size
+
+# A term object without __slots__
+class DictTerm(object):
+    pass
+
+# The attributes set in a term's slots, as a dict
+def term_attributes(term):
+    attributes = { }
+    for cls in type(term).__mro__:
+        for name in cls.__dict__.get('__slots__', ()):
+            if name == '__dict__':
+                continue
+            try:
+                attributes[name] = cls.__dict__[name].__get__(term, type(term))
+            except AttributeError:
+                # Not set, like the args of a Datum, which are a class attribute
+                pass
+    return attributes
+
+def bench_memory():
+    print "Memory held by query terms"
+    rand = random.Random(0)
+    values = [rand.choice([None, True, rand.randint(0, 100), "tag%d" % rand.randint(0, 20), rand.random()])
+              for i in xrange(10000)]
+
+    def chain():
+        query = r.table('users')
+        for i in xrange(200):
+            query = query.filter(lambda user: (user['age'] > i) & (user['name'] != 'x')).limit(1000)
+        return query
+
+    threshold = ast.json_term_threshold
+    ast.json_term_threshold = None
+    try:
+        queries = [
+            ("10k small values", r.expr(values)),
+            ("200 chained filters", chain())
+        ]
+    finally:
+        ast.json_term_threshold = threshold
+
+    for name, query in queries:
+        for label, unshared in [("dicts, own datums", True), ("slots, shared datums", False)]:
+            nodes, size = term_memory(query, set(), unshared)
+            print "  %-40s %8d terms %10d bytes  %6.1f bytes/term" % ("%s: %s" % (name, label), nodes, size,
+                                                                       float(size) / nodes)
+
+def bench_funcs():
+    print "Building queries with lambdas"
+    count = 2000
+
+    def with_lambdas():
+        for i in xrange(count):
+            r.table('users').filter(lambda user: (user['age'] > 21) & user['active']) \
+                .map(lambda user: user.merge({'score': user['score'] * 2})) \
+                .order_by(lambda user: user['name'])
+
+    cache_size = ast.func_cache_size
+    try:
+        ast.func_cache_size = 0
+        baseline = measure(with_lambdas, count)
+        ast.func_cache_size = cache_size
+        report("filter/map/order_by lambdas: uncached", baseline)
+        report("filter/map/order_by lambdas: cached", measure(with_lambdas, count), baseline)
+    finally:
+        ast.func_cache_size = cache_size
+
+benchmarks = [
+    ('decode', bench_decode),
+    ('native_decode', bench_native_decode),
+    ('prepare', bench_prepare),
+    ('expr', bench_expr),
+    ('convert', bench_convert),
+    ('group', bench_group),
+    ('time', bench_time),
+    ('columns', bench_columns),
+    ('encode', bench_encode),
+    ('memory', bench_memory),
+    ('funcs', bench_funcs)
+]
+
+if __name__ == '__main__':
+    names = sys.argv[1:]
+    for name, fn in benchmarks:
+        if not names or name in names:
+            fn()
@@ -139,16 +139,9 @@ def execute_queries():
         single_inserts = i
 
         # Finish inserting the remaining data
-        size_batch = 500
         if i < num_writes:
-            while i+size_batch < num_writes:
-                resutl = r.db('test').table(table['name']).insert(docs[i:i+size_batch]).run(connection)
-                table["ids"] += result["generated_keys"]
-                i += size_batch
-
-            if i < num_writes:
-                result = r.db('test').table(table['name']).insert(docs[i:len(docs)]).run(connection)
-                table["ids"] += result["generated_keys"]
+            result = r.db('test').table(table['name']).insert_many(docs[i:], connection, batch_rows=500)
+            table["ids"] += result.get("generated_keys", [])
 
         results["batch-inserts-"+table["name"]] = (len(docs)-single_inserts)/(time.time()-start)
     
@@ -4,9 +4,11 @@
 
 import random
 import socket
+import select
 import threading
 import SocketServer
 import datetime
+import json as py_json
 from sys import argv
 from subprocess import Popen
 from time import sleep, time
@@ -197,6 +199,59 @@ class TestConnection(TestWithConnection):
             r.RqlDriverError, "Connection is closed.",
             r.expr(1).run, c)
 
+    def test_json_decoder(self):
+        expected = r.epoch_time(1375115782.24).in_timezone('+00:00').run(r.connect(port=self.port))
+        for name in ['json', 'simplejson', 'ujson']:
+            try:
+                c = r.connect(port=self.port, json_decoder=name)
+            except r.RqlDriverError:
+                # The package isn't installed
+                continue
+            res = r.expr({'a':[1, None, 'b'], 't':r.epoch_time(1375115782.24).in_timezone('+00:00')}).run(c)
+            self.assertEqual(res, {'a':[1, None, 'b'], 't':expected})
+
+        self.assertRaisesRegexp(
+            r.RqlDriverError, "Unknown JSON decoder",
+            r.connect, port=self.port, json_decoder='yaml')
+
+    def test_run_many(self):
+        for multiplex in [False, True]:
+            c = r.connect(port=self.port, multiplex=multiplex)
+
+            # Count the writes to the socket
+            writes = []
+            sendall = c._sock_sendall
+            def counting_sendall(data):
+                writes.append(data)
+                return sendall(data)
+            c._sock_sendall = counting_sendall
+
+            # The server runs the queries of a connection one at a time, so
+            # this only saves round trips: the batch is sent in one write
+            res = c.run_many([r.expr(1), r.js('while(true);', timeout=0.1), r.expr(2), r.error('oops'),
+                              r.expr([0, 1, 2])])
+            self.assertEqual(len(writes), 1)
+            self.assertEqual(res[0], 1)
+            self.assertIsInstance(res[1], r.RqlRuntimeError)
+            self.assertEqual(res[2], 2)
+            self.assertIsInstance(res[3], r.RqlRuntimeError)
+            self.assertEqual(res[4], [0, 1, 2])
+            self.assertEqual(c.run_many([]), [])
+            self.assertEqual(c.run_many([r.expr(1)], noreply=True), [None])
+            c.close()
+
+    def test_large_literals(self):
+        c = r.connect(port=self.port)
+        # Big enough to be sent as Json terms, around values that aren't JSON
+        doc = {'rows':[{'id':i, 'name':'row%d' % i, 'tags':['a', None, 1.5]} for i in xrange(200)],
+               'time':r.epoch_time(0), 'nums':range(1000)}
+        term = r.expr(doc)
+        self.assertIsInstance(term.optargs['nums'], r.ast.Json)
+        res = term.run(c)
+        self.assertEqual(res['rows'], doc['rows'])
+        self.assertEqual(res['nums'], doc['nums'])
+        self.assertEqual(r.expr([doc['rows'], r.expr(1) + 1]).run(c), [doc['rows'], 2])
+
     def test_noreply_wait_waits(self):
         c = r.connect(port=self.port)
         t = time()
@@ -314,6 +369,494 @@ class TestConnection(TestWithConnection):
             "Could not convert port abc to an integer.",
             lambda: r.connect(port='abc'))
 
+class TestReadBuffer(TestWithConnection):
+    def test_large_responses(self):
+        # Start with a tiny buffer so that it has to grow and compact
+        initial_size = r.net.initial_read_buffer_size
+        r.net.initial_read_buffer_size = 16
+        try:
+            c = r.connect(port=self.port)
+        finally:
+            r.net.initial_read_buffer_size = initial_size
+
+        big = 'x' * 300000
+        for i in xrange(0, 3):
+            self.assertEqual(r.expr([big, i]).run(c), [big, i])
+            self.assertEqual(r.expr(i).run(c), i)
+        self.assertEqual(c.read_start, 0)
+        self.assertEqual(c.read_end, 0)
+
+class TestMultiplexedConnection(TestWithConnection):
+    def test_type(self):
+        c = r.connect(port=self.port, multiplex=True)
+        self.assertEqual(type(c), r.MultiplexedConnection)
+        self.assertEqual(type(r.connect(port=self.port)), r.Connection)
+
+    def test_concurrent_queries(self):
+        c = r.connect(port=self.port, multiplex=True)
+        r.db('test').table_create('t1').run(c)
+        r.table('t1').insert([{'id':i} for i in xrange(0, 100)]).run(c)
+
+        errors = []
+        def worker(n):
+            try:
+                for i in xrange(0, 50):
+                    self.assertEqual(r.expr(n * 100 + i).run(c), n * 100 + i)
+                    self.assertEqual(len(list(r.table('t1').run(c))), 100)
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in xrange(0, 8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(c.queues, {})
+        c.close()
+
+    def test_close_cursor(self):
+        c = r.connect(port=self.port, multiplex=True)
+        r.db('test').table_create('t1').run(c)
+        r.table('t1').insert([{'id':i} for i in xrange(0, 2000)]).run(c)
+
+        cursor = r.table('t1').run(c)
+        iter(cursor).next()
+        cursor.close()
+        self.assertEqual(r.expr(1).run(c), 1)
+
+    def test_close_wakes_waiters(self):
+        c = r.connect(port=self.port, multiplex=True)
+        t = threading.Thread(target=c.close, kwargs={'noreply_wait': False})
+        t.start()
+        t.join()
+        self.assertRaisesRegexp(
+            r.RqlDriverError, "Connection is closed.",
+            r.expr(1).run, c)
+
+class TestCoalescing(TestWithConnection):
+    def runTest(self):
+        c = r.connect(port=self.port, multiplex=True).enable_coalescing(window=0.05, max_keys=100)
+        r.db('test').table_create('coalesced', primary_key='key').run(c)
+        r.table('coalesced').insert([{'key':'k%d' % i} for i in xrange(0, 20)]).run(c)
+
+        results = {}
+        def worker(n):
+            results[n] = r.table('coalesced').get('k%d' % (n % 25)).run(c)
+        threads = [threading.Thread(target=worker, args=(n,)) for n in xrange(0, 50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for n in xrange(0, 50):
+            self.assertEqual(results[n], {'key':'k%d' % (n % 25)} if n % 25 < 20 else None)
+        self.assertIsNot(results[0], results[25])
+        self.assertLess(c.coalescing_stats()['queries'], 10)
+
+        # A get with no others in flight doesn't wait for the window
+        c.enable_coalescing(window=5)
+        start = datetime.datetime.now()
+        self.assertEqual(r.table('coalesced').get('k1').run(c), {'key':'k1'})
+        self.assertLess(datetime.datetime.now() - start, datetime.timedelta(seconds=1))
+
+        # A failing get still gets its own error
+        self.assertRaises(r.RqlRuntimeError, r.table('missing').get(1).run, c)
+
+class TestConnectionPool(TestWithConnection):
+    def test_run(self):
+        pool = r.ConnectionPool(port=self.port, min_size=1, max_size=2)
+        self.assertEqual(pool.size, 1)
+        self.assertEqual(pool.run(r.expr(1)), 1)
+        self.assertEqual(pool.size, 1)
+        pool.close()
+        self.assertRaisesRegexp(
+            r.RqlDriverError, "Connection pool is closed.",
+            pool.run, r.expr(1))
+
+    def test_checkout_limit(self):
+        pool = r.ConnectionPool(port=self.port, max_size=2)
+        c1 = pool.acquire()
+        c2 = pool.acquire()
+        self.assertRaisesRegexp(
+            r.RqlDriverError, "Timed out waiting for a connection from the pool.",
+            pool.acquire, timeout=0.1)
+        pool.release(c1)
+        self.assertIs(pool.acquire(timeout=0.1), c1)
+
+    def test_reconnects_closed_connection(self):
+        pool = r.ConnectionPool(port=self.port, max_size=1)
+        with pool.connection() as c:
+            c.close()
+        self.assertEqual(pool.size, 0)
+        self.assertEqual(pool.run(r.expr(1)), 1)
+
+        with pool.connection() as c:
+            c.socket.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(pool.run(r.expr(1)), 1)
+
+    def test_cursor_keeps_connection(self):
+        pool = r.ConnectionPool(port=self.port, max_size=1)
+        pool.run(r.db('test').table_create('t1'))
+        pool.run(r.table('t1').insert([{'id':i} for i in xrange(0, 2000)]))
+
+        cursor = pool.run(r.table('t1'))
+        self.assertRaisesRegexp(
+            r.RqlDriverError, "Timed out waiting for a connection from the pool.",
+            pool.acquire, timeout=0.1)
+        self.assertEqual(len(list(cursor)), 2000)
+        self.assertEqual(pool.run(r.expr(1)), 1)
+
+    def test_close(self):
+        pool = r.ConnectionPool(port=self.port, max_size=2)
+        pool.run(r.db('test').table_create('t1'))
+        pool.run(r.table('t1').insert([{'id':i} for i in xrange(0, 2000)]))
+
+        # Connections whose cursors are still being read are closed too
+        cursor = iter(pool.run(r.table('t1')))
+        cursor.next()
+        pool.close()
+        self.assertEqual(pool.size, 0)
+        self.assertRaisesRegexp(r.RqlDriverError, "Connection is closed.", list, cursor)
+
+    def test_late_responses_keep_connection(self):
+        pool = r.ConnectionPool(port=self.port, max_size=1)
+        pool.run(r.db('test').table_create('t1'))
+        pool.run(r.table('t1').insert([{'id':i} for i in xrange(0, 2000)]))
+
+        # The responses to the CONTINUEs sent past the end of the stream are
+        # read while the connection is in the pool, rather than making it
+        # look closed by the server
+        with pool.connection() as c:
+            self.assertEqual(len(list(r.table('t1').run(c, prefetch=4))), 2000)
+            sock = c.socket
+        sleep(0.1)
+        with pool.connection() as c2:
+            self.assertIs(c2, c)
+            self.assertIs(c.socket, sock)
+            self.assertEqual(c.ignored_responses, {})
+
+    def test_release_stops_cursors(self):
+        pool = r.ConnectionPool(port=self.port, max_size=1)
+        pool.run(r.db('test').table_create('t1'))
+        pool.run(r.table('t1').insert([{'id':i} for i in xrange(0, 2000)]))
+
+        # A cursor left unread doesn't keep its connection from the pool
+        with pool.connection() as c:
+            for row in r.table('t1').run(c):
+                break
+        with pool.connection(timeout=1) as c2:
+            self.assertIs(c2, c)
+            self.assertEqual(c.cursor_cache, {})
+            self.assertEqual(r.expr(1).run(c2), 1)
+
+    def test_idle_eviction(self):
+        pool = r.ConnectionPool(port=self.port, max_size=2, idle_timeout=0.1)
+        pool.run(r.expr(1))
+        self.assertEqual(pool.size, 1)
+        sleep(0.2)
+        pool.run(r.expr(1))
+        self.assertEqual(pool.size, 1)
+
+class TestPreparedQuery(TestWithConnection):
+    def test_point_lookups(self):
+        c = r.connect(port=self.port)
+        r.db('test').table_create('prepared').run(c)
+        r.table('prepared').insert([{'id':i, 'g':i % 3} for i in xrange(0, 10)]).run(c)
+
+        get = r.prepare(lambda key: r.table('prepared').get(key))
+        self.assertEqual([get.run(c, key=i)['id'] for i in xrange(0, 10)], range(0, 10))
+        self.assertEqual(get.run(c, 4), {'id':4, 'g':1})
+        self.assertEqual(get.run(c, key=42), None)
+
+        get_all = r.prepare(lambda a, b: r.table('prepared').get_all(a, b).order_by('id'))
+        self.assertEqual(list(get_all.run(c, 2, b=5)), [{'id':2, 'g':2}, {'id':5, 'g':2}])
+
+        # Parameters can appear anywhere in the query, any number of times
+        calc = r.prepare(lambda x: r.expr({'a':[x, x]}).merge({'b':r.expr(x) * 2}))
+        self.assertEqual(calc.run(c, x=3), {'a':[3, 3], 'b':6})
+        self.assertEqual(calc.run(c, x=4), {'a':[4, 4], 'b':8})
+
+    def test_run_options(self):
+        c = r.connect(port=self.port)
+        get = r.prepare(lambda key: r.table('prepared_opts').get(key))
+        r.db('test').table_create('prepared_opts').run(c)
+        r.db_create('prepared_db').run(c)
+        r.db('prepared_db').table_create('prepared_opts').run(c)
+        r.db('prepared_db').table('prepared_opts').insert({'id':1}).run(c)
+
+        self.assertEqual(get.run(c, key=1), None)
+        self.assertEqual(get.run(c, key=1, db='prepared_db'), {'id':1})
+        self.assertEqual(get.run(c, key=1, noreply=True), None)
+
+    def test_missing_parameter(self):
+        c = r.connect(port=self.port)
+        get = r.prepare(lambda key: r.table('prepared').get(key))
+        self.assertRaisesRegexp(
+            r.RqlDriverError, "Missing value for parameter key",
+            get.run, c)
+
+class TestInsertMany(TestWithConnection):
+    def test_insert_many(self):
+        c = r.connect(port=self.port)
+        r.db('test').table_create('insert_many').run(c)
+        t = r.db('test').table('insert_many')
+
+        res = t.insert_many(({'n':i} for i in xrange(1050)), c, batch_rows=100, max_in_flight=3)
+        self.assertEqual(res['inserted'], 1050)
+        self.assertEqual(res['errors'], 0)
+        self.assertEqual(len(set(res['generated_keys'])), 1050)
+        self.assertEqual(t.count().run(c), 1050)
+
+        # Several connections, with the batches also cut by size
+        conns = [r.connect(port=self.port), r.connect(port=self.port, multiplex=True)]
+        res = t.insert_many([{'id':i} for i in xrange(500)], conns, batch_bytes=1000)
+        self.assertEqual(res['inserted'], 500)
+        self.assertEqual(t.count().run(c), 1550)
+
+        # Duplicate keys are errors of the insert, not of the batch
+        res = t.insert_many([{'id':i} for i in xrange(490, 510)], c)
+        self.assertEqual(res['inserted'], 10)
+        self.assertEqual(res['errors'], 10)
+        self.assertIn('first_error', res)
+
+        r.db('test').table_drop('insert_many').run(c)
+
+class TestQueryCache(TestWithConnection):
+    def test_reads(self):
+        c = r.connect(port=self.port).enable_cache(2, ttl=None)
+        r.db('test').table_create('cached').run(c)
+        r.table('cached').insert([{'id':i} for i in xrange(5)]).run(c)
+
+        doc = r.table('cached').get(1).run(c)
+        doc['changed'] = True
+        self.assertEqual(r.table('cached').get(1).run(c), {'id':1})
+        self.assertEqual(list(r.table('cached').get_all(1, 2).order_by('id').run(c)), [{'id':1}, {'id':2}])
+        self.assertEqual(list(r.table('cached').get_all(1, 2).order_by('id').run(c)), [{'id':1}, {'id':2}])
+        stats = c.cache_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (2, 2, 2))
+
+        r.table('cached').get(3).run(c)
+        self.assertEqual(c.cache_stats()['evictions'], 1)
+
+        # Only deterministic reads are cached
+        r.now().run(c)
+        r.table('cached').sample(1).run(c)
+        self.assertEqual(c.cache_stats()['entries'], 2)
+
+    def test_writes(self):
+        c = r.connect(port=self.port).enable_cache(10, ttl=0.2)
+        r.db('test').table_create('cached_writes').run(c)
+        r.db('test').table_create('other').run(c)
+        r.table('cached_writes').insert({'id':1, 'n':1}).run(c)
+
+        self.assertEqual(r.table('cached_writes').get(1).run(c)['n'], 1)
+        r.table('other').insert({'id':1}).run(c)
+        self.assertEqual(c.cache_stats()['entries'], 1)
+        r.db('test').table('cached_writes').get(1).update({'n':2}).run(c)
+        self.assertEqual(c.cache_stats()['invalidations'], 1)
+        self.assertEqual(r.table('cached_writes').get(1).run(c)['n'], 2)
+
+        # Writes from another connection are seen once the result expires
+        r.table('cached_writes').get(1).update({'n':3}).run(r.connect(port=self.port))
+        self.assertEqual(r.table('cached_writes').get(1).run(c)['n'], 2)
+        sleep(0.3)
+        self.assertEqual(r.table('cached_writes').get(1).run(c)['n'], 3)
+        self.assertEqual(c.cache_stats()['expirations'], 1)
+
+class TestListeners(TestWithConnection):
+    def runTest(self):
+        for multiplex in [False, True]:
+            c = r.connect(port=self.port, multiplex=multiplex)
+            r.db('test').table_create('listened').run(c)
+            r.table('listened').insert([{'id':i} for i in xrange(0, 300)]).run(c)
+
+            finished = []
+            class Listener(object):
+                def query_finished(self, stats):
+                    finished.append(stats)
+            c.add_listener(Listener())
+            aggregator = c.add_listener(r.StatsAggregator())
+
+            r.table('listened').get(1).run(c)
+            stats = finished[-1]
+            self.assertEqual(stats.term_type, 'Get')
+            self.assertEqual(stats.batches, 1)
+            self.assertGreater(stats.bytes_sent, 0)
+            self.assertGreater(stats.bytes_received, 0)
+            self.assertGreaterEqual(stats.total_time, stats.wait_time + stats.convert_time)
+
+            # A cursor is reported once it has been read to the end
+            cursor = r.table('listened').run(c, prefetch=1)
+            self.assertEqual(finished[-1], stats)
+            self.assertEqual(len(list(cursor)), 300)
+            self.assertEqual(finished[-1].term_type, 'Table')
+            self.assertEqual(finished[-1].continues, finished[-1].batches - 1)
+
+            self.assertRaises(r.RqlRuntimeError, r.error('oops').run, c)
+            self.assertIsInstance(finished[-1].error, r.RqlRuntimeError)
+
+            summary = aggregator.summary()
+            self.assertEqual(summary['Get']['count'], 1)
+            self.assertEqual(summary['UserError']['errors'], 1)
+            self.assertIsNotNone(summary['Table']['read_time']['p99'])
+            r.db('test').table_drop('listened').run(c)
+
+class TestQueryTimeout(TestWithConnection):
+    def runTest(self):
+        slow = r.js('var x = 0; while (true) { x++; }', timeout=2)
+        for multiplex in [False, True]:
+            c = r.connect(port=self.port, multiplex=multiplex)
+            r.db('test').table_create('deadline').run(c)
+            r.table('deadline').insert([{'id':i} for i in xrange(0, 300)]).run(c)
+            cursor = iter(r.table('deadline').run(c, prefetch=1))
+            cursor.next()
+
+            self.assertRaises(r.RqlTimeoutError, slow.run, c, timeout=0.2)
+            self.assertEqual(c.timed_out, set([c.next_token - 1]))
+
+            # The server keeps running the slow query, and runs the queries
+            # sent after it on this connection once it is done
+            self.assertEqual(r.expr(1).run(c), 1)
+            results = c.run_many([r.expr(2), slow], timeout=0.2)
+            self.assertEqual(results[0], 2)
+            self.assertIsInstance(results[1], r.RqlTimeoutError)
+
+            # The late responses to the queries that timed out are dropped
+            sleep(2.5)
+            self.assertEqual(r.expr(3).run(c), 3)
+            self.assertEqual(len(list(cursor)), 299)
+            self.assertEqual(c.ignored_responses, {})
+            self.assertEqual(c.timed_out, set())
+
+            self.assertRaises(r.RqlDriverError, r.expr(1).run, c, timeout=0)
+            r.db('test').table_drop('deadline').run(c)
+
+        # The pool doesn't reuse a connection on which a query timed out
+        pool = r.ConnectionPool(port=self.port, max_size=1)
+        with pool.connection() as c:
+            self.assertRaises(r.RqlTimeoutError, slow.run, c, timeout=0.2)
+        self.assertIsNone(c.socket)
+        self.assertEqual(pool.size, 0)
+        self.assertEqual(pool.run(r.expr(1)), 1)
+
+class TestMultipleHosts(TestWithConnection):
+    def runTest(self):
+        ports = [server.cpp_port for server in self.servers.servers]
+        unreachable = ('localhost', 11221)
+        hosts = [unreachable] + ['localhost:%d' % port for port in ports]
+
+        # New connections are spread across the nodes that can be reached
+        conns = [r.connect(hosts=hosts) for i in xrange(0, 2 * len(ports))]
+        self.assertEqual(sorted(c.port for c in conns), sorted(ports * 2))
+        for c in conns:
+            self.assertEqual(r.expr(1).run(c), 1)
+
+        self.assertRaisesRegexp(
+            r.RqlDriverError, "Could not connect to any host.",
+            r.connect, hosts=[unreachable])
+
+        # A node with open cursors is passed over
+        nodes = hosts[1:]
+        busy = r.connect(hosts=nodes, balance='least_outstanding', multiplex=True)
+        r.db('test').table_create('balanced').run(busy)
+        r.table('balanced').insert([{'id':i} for i in xrange(0, 300)]).run(busy)
+        cursor = r.table('balanced').run(busy)
+        for i in xrange(0, len(ports) - 1):
+            self.assertNotEqual(r.connect(hosts=nodes, balance='least_outstanding').port, busy.port)
+        cursor.close()
+
+        pool = r.ConnectionPool(hosts=hosts, min_size=len(ports))
+        self.assertEqual(sorted(c.port for c, released_at in pool.idle), sorted(ports))
+        self.assertEqual(len(pool.run(r.table('balanced'), use_outdated=True)), 300)
+        pool.close()
+        r.db('test').table_drop('balanced').run(busy)
+
+class TestAsyncConnection(TestWithConnection):
+    def setUp(self):
+        try:
+            import trollius
+        except ImportError:
+            self.skipTest("trollius is not installed")
+        TestWithConnection.setUp(self)
+
+    def run_async(self, coroutine):
+        import trollius
+        return trollius.get_event_loop().run_until_complete(coroutine)
+
+    def test_concurrent_queries(self):
+        from trollius import From, Return, coroutine, gather
+
+        @coroutine
+        def queries():
+            c = yield From(r.connect_async(port=self.port))
+            results = yield From(gather(*[r.expr(i).run(c) for i in xrange(0, 100)]))
+            yield From(c.close())
+            raise Return(results)
+
+        self.assertEqual(self.run_async(queries()), range(0, 100))
+
+    def test_cursor(self):
+        from trollius import From, Return, coroutine
+
+        @coroutine
+        def read_table():
+            c = yield From(r.connect_async(port=self.port))
+            yield From(r.db('test').table_create('t1').run(c))
+            yield From(r.table('t1').insert([{'id':i} for i in xrange(0, 2000)]).run(c))
+
+            cursor = yield From(r.table('t1').run(c, prefetch=4))
+            # The cursor asks for the next three batches at once
+            self.assertEqual(cursor.outstanding_requests, 3)
+            count = 0
+            while (yield From(cursor.fetch_next())):
+                yield From(cursor.next())
+                count += 1
+
+            empty = False
+            try:
+                yield From(cursor.next())
+            except r.RqlCursorEmpty:
+                empty = True
+            raise Return((count, empty))
+
+        self.assertEqual(self.run_async(read_table()), (2000, True))
+
+    def test_timeout(self):
+        from trollius import From, Return, coroutine
+
+        @coroutine
+        def queries():
+            c = yield From(r.connect_async(port=self.port))
+            slow = r.js('var x = 0; while (true) { x++; }', timeout=2)
+            try:
+                yield From(slow.run(c, timeout=0.2))
+                timed_out = False
+            except r.RqlTimeoutError:
+                timed_out = True
+
+            # The next query waits for the server to give up on the slow one
+            value = yield From(r.expr(1).run(c))
+            yield From(c.noreply_wait())
+            raise Return((timed_out, value, c.ignored_responses))
+
+        self.assertEqual(self.run_async(queries()), (True, 1, {}))
+
+    def test_prepared_query(self):
+        from trollius import From, Return, coroutine
+
+        @coroutine
+        def lookups():
+            c = yield From(r.connect_async(port=self.port))
+            double = r.prepare(lambda x: r.expr(x) * 2)
+            results = [ ]
+            for i in xrange(0, 5):
+                results.append((yield From(double.run(c, x=i))))
+            raise Return(results)
+
+        self.assertEqual(self.run_async(lookups()), [0, 2, 4, 6, 8])
+
 class TestShutdown(TestWithConnection):
     def test_shutdown(self):
         c = r.connect(port=self.port)
@@ -335,6 +878,142 @@ class TestPrinting(unittest.TestCase):
         self.assertEqual(str(r.db('db1').table('tbl1').map(lambda x: x)),
                             "r.db('db1').table('tbl1').map(lambda var_1: var_1)")
 
+class TestWireEncoder(unittest.TestCase):
+    # The encoder must give exactly the bytes protobuf gives for the same query
+    def assertSameEncoding(self, term, global_opt_args={}, token=1):
+        from rethinkdb.net import start_query, serialize_start_query
+        expected = start_query(token, term, 'test', dict(global_opt_args))
+        expected.accepts_r_json = True
+        query, query_protobuf = serialize_start_query(token, term, 'test', dict(global_opt_args), True)
+        self.assertEqual(query_protobuf, expected.SerializeToString())
+
+    def test_term_classes(self):
+        import rethinkdb.ast
+        classes = [cls for cls in vars(rethinkdb.ast).values()
+                   if isinstance(cls, type) and issubclass(cls, r.RqlQuery) and hasattr(cls, 'tt')]
+        self.assertGreater(len(classes), 100)
+        for cls in classes:
+            term = cls.__new__(cls)
+            term.args = [r.expr(1), r.expr(u'caf\xe9'), r.expr([2.5, None, True])]
+            term.optargs = {'index':r.expr('id'), u'nested':r.expr({'a':False})}
+            self.assertSameEncoding(term)
+
+    def test_datums(self):
+        for value in [None, True, False, 0, -1, 2**62, -2**70, 0.1, 1e300, float('inf'),
+                      '', 'abc', u'\u2603', 'caf\xc3\xa9', 'x' * 300, range(200)]:
+            self.assertSameEncoding(r.expr(value))
+        self.assertRaises(ValueError, self.assertSameEncoding, r.expr('\xff'))
+
+    def test_queries(self):
+        self.assertSameEncoding(r.table('users').filter(lambda user: user['age'] > 21)
+                                .order_by(index=r.desc('name')).limit(10).pluck('name', 'age'))
+        self.assertSameEncoding(r.db('db1').table('tbl1').get_all(1, 2, index='id').update(
+                                {'count':r.row['count'] + 1, 'tags':['a', 'b']}, durability='soft'))
+        self.assertSameEncoding(r.expr({'x':[1, {'y':r.js('1')}]}).do(lambda v: r.branch(v, 1, 2)))
+        self.assertSameEncoding(r.now(), {'db':'other', 'use_outdated':True, 'profile':False}, token=2**40)
+
+class TestFuncCache(unittest.TestCase):
+    def test_reuses_funcs(self):
+        def query(limit):
+            return r.table('t').filter(lambda doc: doc['n'] > limit)
+        self.assertIs(query(1).args[1], query(1).args[1])
+        self.assertIsNot(query(1).args[1], query(2).args[1])
+        self.assertEqual(str(query(2)), str(query(2)))
+        # Attribute names aren't globals
+        def query():
+            return r.table('t').map(lambda doc: doc.merge({'n':doc['n'] + 1}))
+        self.assertIs(query().args[1], query().args[1])
+
+    def test_uncacheable_funcs(self):
+        # The lambda's term could change between calls
+        def query():
+            return r.table('t').filter(lambda doc: doc['n'] > random.random())
+        self.assertIsNot(query().args[1], query().args[1])
+
+        limits = [1]
+        def query():
+            return r.table('t').filter(lambda doc: doc['n'] > limits[0])
+        first = query()
+        limits[0] = 2
+        self.assertIn('r.expr(2)', str(query()))
+        self.assertIn('r.expr(1)', str(first))
+
+    def test_implicit_var(self):
+        self.assertIsInstance(r.table('t').filter(r.row['n'] > 1).args[1], r.ast.Func)
+        self.assertIsInstance(r.table('t').filter({'n':[r.row['m']]}).args[1], r.ast.Func)
+        self.assertNotIsInstance(r.table('t').filter({'n':[1]}).args[1], r.ast.Func)
+
+class TestExpr(unittest.TestCase):
+    def test_types(self):
+        class Row(dict):
+            pass
+        self.assertIsInstance(r.expr(Row(a=[1L, 2.5, None])), r.ast.MakeObj)
+        self.assertIsInstance(r.expr(Row(a=[1L, 2.5, None])).optargs['a'].args[0], r.ast.Datum)
+        self.assertIsInstance(r.expr(lambda x: x), r.ast.Func)
+        term = r.table('t')
+        self.assertIs(r.expr(term), term)
+        self.assertRaises(r.RqlDriverError, r.expr, datetime.datetime.now())
+
+    def test_deep_values(self):
+        value = 1
+        for i in xrange(2000):
+            value = [{'a':value}]
+        self.assertIsInstance(r.expr(value, 5000), r.ast.MakeArray)
+        self.assertRaises(r.RqlDriverError, r.expr, value)
+        self.assertRaises(r.RqlDriverError, r.expr, [[[1]]], 3)
+        self.assertIsInstance(r.expr([[[]]], 3), r.ast.MakeArray)
+
+    def test_json_terms(self):
+        self.assertIsInstance(r.expr([1, 2]), r.ast.MakeArray)
+        self.assertIsInstance(r.expr(range(100)), r.ast.Json)
+        # A big pure JSON value is one Json term, whatever it holds
+        term = r.expr({'rows':[{'id':i} for i in xrange(100)], 'time':r.now()})
+        self.assertIsInstance(term.optargs['rows'], r.ast.Json)
+        self.assertEqual(py_json.loads(term.optargs['rows'].args[0].data), [{'id':i} for i in xrange(100)])
+        self.assertIsInstance(r.expr([float('nan')] * 100), r.ast.MakeArray)
+        # exprJSON sends every pure JSON list and dict as Json, but not scalars
+        self.assertIsInstance(r.ast.exprJSON([None]), r.ast.Json)
+        self.assertIsInstance(r.ast.exprJSON(None), r.ast.Datum)
+
+    def test_slots(self):
+        # Including the time names, whose classes query.py makes with type()
+        for term in [r.expr(5000), r.table('t').get(1), r.monday, r.december]:
+            self.assertFalse(hasattr(term, '__dict__'))
+        class Term(r.ast.RqlQuery):
+            pass
+        self.assertTrue(hasattr(Term(), '__dict__'))
+
+class TestTimeConversion(unittest.TestCase):
+    def setUp(self):
+        self.times = [{'$reql_type$':'TIME', 'epoch_time':1375115782.24 + i * 3600.5, 'timezone':tz}
+                      for i, tz in enumerate(['+00:00', '-07:00', '+05:30', '-07:00'])]
+
+    def test_native(self):
+        converted = [r.ast.Datum._convert_pseudotype(dict(t), {}) for t in self.times]
+        for t, dt in zip(self.times, converted):
+            self.assertEqual(dt, datetime.datetime.fromtimestamp(t['epoch_time'], r.ast.RqlTzinfo(t['timezone'])))
+            self.assertEqual(dt.utcoffset(), r.ast.RqlTzinfo(t['timezone']).utcoffset(None))
+        # Times with the same offset share their tzinfo
+        self.assertIs(converted[1].tzinfo, converted[3].tzinfo)
+        self.assertIs(r.make_timezone('-07:00'), converted[1].tzinfo)
+
+    def test_epoch(self):
+        converted = [r.ast.Datum._convert_pseudotype(dict(t), {'time_format':'epoch'}) for t in self.times]
+        self.assertEqual(converted, [t['epoch_time'] for t in self.times])
+        self.assertRaises(r.RqlDriverError, r.ast.Datum._convert_pseudotype, dict(self.times[0]), {'time_format':'iso'})
+
+    def test_batch(self):
+        datums = []
+        for t in self.times:
+            datum = r.ast.p.Datum()
+            datum.type = r.ast.p.Datum.R_JSON
+            datum.r_str = r.ast.py_json.dumps({'at':t})
+            datums.append(datum)
+        self.assertEqual(r.ast.Datum.deconstruct_many(datums, {}),
+                         [r.ast.Datum.deconstruct(datum, {}) for datum in datums])
+        self.assertEqual(r.ast.Datum.deconstruct_many(datums, {'time_format':'epoch'}),
+                         [{'at':t['epoch_time']} for t in self.times])
+
 class TestBatching(TestWithConnection):
     def runTest(self):
         c = r.connect(port=self.port)
@@ -373,6 +1052,47 @@ class TestBatching(TestWithConnection):
         self.assertGreaterEqual(len(cursor.responses), 1)
         self.assertGreaterEqual(len(cursor.responses[0].response), 1)
 
+class TestColumns(TestWithConnection):
+    def runTest(self):
+        c = r.connect(port=self.port)
+        r.db('test').table_create('columns').run(c)
+        r.table('columns').insert([{'id':i, 'score':i * 0.5, 'name':'n%d' % i, 'at':r.epoch_time(i)}
+                                   for i in xrange(0, 250)]).run(c)
+        r.table('columns').insert({'id':250, 'score':None}).run(c)
+
+        rows = list(r.table('columns').order_by('id').run(c))
+        columns = r.table('columns').order_by('id').run(c).to_columns(['id', 'score', 'name', 'at', 'other'], numpy=False)
+        self.assertEqual(len(columns['id']), 251)
+        self.assertEqual(columns['score'].values.typecode, 'd')
+        self.assertEqual(columns['score'].to_list(), [row['score'] for row in rows])
+        self.assertEqual(columns['name'].to_list(), [row.get('name') for row in rows])
+        self.assertEqual(columns['at'].to_list(), [row.get('at') for row in rows])
+        self.assertEqual(list(columns['score'].mask), [0] * 250 + [1])
+        self.assertEqual(list(columns['other'].mask), [1] * 251)
+
+class TestPolling(TestWithConnection):
+    def runTest(self):
+        r.db('test').table_create('polled').run(r.connect(port=self.port))
+        r.table('polled').insert([{'id':i} for i in xrange(0, 500)]).run(r.connect(port=self.port))
+
+        for multiplex in [False, True]:
+            c = r.connect(port=self.port, multiplex=multiplex)
+            cursors = [r.table('polled').run(c) for i in xrange(0, 10)]
+            counts = [0] * len(cursors)
+            while not all(cursor.done() for cursor in cursors):
+                if multiplex:
+                    self.assertRaises(RqlDriverError, c.fileno)
+                    sleep(0.01)
+                else:
+                    select.select([c], [], [], 1)
+                c.poll()
+                for i, cursor in enumerate(cursors):
+                    counts[i] += len(cursor.ready_rows())
+            self.assertEqual(counts, [500] * len(cursors))
+            self.assertEqual(c.outstanding_queries(), 0)
+            self.assertEqual(r.expr(1).run(c), 1)
+            c.close()
+
 class TestGroupWithTimeKey(TestWithConnection):
     def runTest(self):
         c = r.connect(port=self.port)
@@ -397,6 +1117,24 @@ class TestGroupWithTimeKey(TestWithConnection):
         groups = r.table('times').group('time').coerce_to('array').run(c)
         self.assertEqual(groups, {dt1:[expected_row1],dt2:[expected_row2]})
 
+class TestLazyGroups(TestWithConnection):
+    def runTest(self):
+        c = r.connect(port=self.port)
+        r.db('test').table_create('grouped').run(c)
+        r.table('grouped').insert([{'id':i, 'tags':['a', i % 3]} for i in xrange(0, 30)]).run(c)
+
+        native = r.table('grouped').group('tags').count().run(c)
+        lazy = r.table('grouped').group('tags').count().run(c, group_format='lazy')
+        self.assertIsInstance(lazy, r.GroupedResult)
+        self.assertEqual(len(lazy), 3)
+        self.assertEqual(lazy, native)
+
+        # Keys are looked up like the native format's, but iterated over as sent
+        self.assertEqual(lazy[['a', 1]], 10)
+        self.assertEqual(lazy[('a', 1)], 10)
+        self.assertNotIn(['a', 3], lazy)
+        self.assertEqual(sorted(lazy), [(['a', 0], 10), (['a', 1], 10), (['a', 2], 10)])
+
 
 if __name__ == '__main__':
     print "Running py connection tests"
@@ -408,10 +1146,28 @@ if __name__ == '__main__':
     suite.addTest(loader.loadTestsFromTestCase(TestTimeout))
     suite.addTest(loader.loadTestsFromTestCase(TestAuthConnection))
     suite.addTest(loader.loadTestsFromTestCase(TestConnection))
+    suite.addTest(loader.loadTestsFromTestCase(TestReadBuffer))
+    suite.addTest(loader.loadTestsFromTestCase(TestMultiplexedConnection))
+    suite.addTest(TestCoalescing())
+    suite.addTest(loader.loadTestsFromTestCase(TestConnectionPool))
+    suite.addTest(loader.loadTestsFromTestCase(TestPreparedQuery))
+    suite.addTest(loader.loadTestsFromTestCase(TestInsertMany))
+    suite.addTest(loader.loadTestsFromTestCase(TestQueryCache))
+    suite.addTest(TestListeners())
+    suite.addTest(TestQueryTimeout())
+    suite.addTest(TestMultipleHosts())
+    suite.addTest(loader.loadTestsFromTestCase(TestAsyncConnection))
     suite.addTest(loader.loadTestsFromTestCase(TestShutdown))
     suite.addTest(TestPrinting())
+    suite.addTest(loader.loadTestsFromTestCase(TestWireEncoder))
+    suite.addTest(loader.loadTestsFromTestCase(TestFuncCache))
+    suite.addTest(loader.loadTestsFromTestCase(TestExpr))
+    suite.addTest(loader.loadTestsFromTestCase(TestTimeConversion))
     suite.addTest(TestBatching())
+    suite.addTest(TestColumns())
+    suite.addTest(TestPolling())
     suite.addTest(TestGroupWithTimeKey())
+    suite.addTest(TestLazyGroups())
 
     res = unittest.TextTestRunner(verbosity=2).run(suite)
 
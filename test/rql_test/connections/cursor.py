@@ -2,7 +2,9 @@
 # Tests the driver cursor API
 ###
 
+import json
 import unittest
+from StringIO import StringIO
 from os import getenv
 from sys import path, argv, exit
 path.insert(0, "../../drivers/python")
@@ -29,6 +31,44 @@ class TestCursor(unittest.TestCase):
 
         self.assertEqual(i, num_rows)
 
+    def test_prefetch(self):
+        c = r.connect(port=port)
+        cur = r.table('test').run(c, prefetch=4)
+
+        # The window bounds both the requests in flight and the batches held
+        self.assertLessEqual(cur.outstanding_requests + len(cur.responses), 5)
+        self.assertEqual(len(list(cur)), num_rows)
+
+        # Closing with CONTINUEs still in flight must leave the connection usable
+        cur = r.table('test').run(c, prefetch=4)
+        iter(cur).next()
+        cur.close()
+        self.assertEqual(c.cursor_cache, {})
+        self.assertEqual(r.expr(1).run(c), 1)
+
+        self.assertRaises(r.RqlDriverError, r.table('test').run, c, prefetch=0)
+
+    def test_batches(self):
+        batches = list(self.cur.batches())
+        self.assertTrue(all(isinstance(batch, list) for batch in batches))
+        self.assertEqual(sum(len(batch) for batch in batches), num_rows)
+
+    def test_raw_json(self):
+        c = r.connect(port=port)
+        rows = list(r.table('test').run(c, format='raw_json'))
+        self.assertEqual(sorted(json.loads(row)['id'] for row in rows), range(0, num_rows))
+
+        batches = r.table('test').run(c, format='raw_json').batches()
+        self.assertEqual(sum(len(json.loads(batch)) for batch in batches), num_rows)
+
+        self.assertEqual(json.loads(r.expr({'a':[1, None]}).run(c, format='raw_json')), {'a':[1, None]})
+        self.assertRaises(r.RqlDriverError, r.expr(1).run, c, format='xml')
+
+    def test_write_json(self):
+        out = StringIO()
+        self.cur.write_json(out)
+        self.assertEqual(len(json.loads(out.getvalue())), num_rows)
+
     def test_close(self):
         # This excercises a code path at the root of #650
         self.cur.close()